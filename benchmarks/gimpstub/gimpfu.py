@@ -0,0 +1,426 @@
+'''
+Enough of gimpfu for mm_tool_imagemagick.py to be imported, registered and
+run outside GIMP, for the benchmarks.  Images and layers hold their pixels
+in memory and pixel regions slice them the way GIMP's do.  The PDB knows
+the procedures the plug-in calls to copy, save, load and place images and
+to read paths; any other procedure, such as the progress bar, does
+nothing.  Nothing here draws.
+
+GIMP's file plug-ins are not available, so "TIFF" files are written and
+read as PAM.  ImageMagick recognises them by their content, but times for
+the TIFF transport only show the ImageMagick side of it.
+'''
+
+import os
+import tempfile
+
+PF_INT    = 0
+PF_FLOAT  = 1
+PF_STRING = 2
+PF_TEXT   = 3
+PF_BOOL   = 4
+PF_SLIDER = 5
+PF_OPTION = 6
+PF_RADIO  = 7
+
+RGB     = 0
+GRAY    = 1
+INDEXED = 2
+
+RGB_IMAGE     = 0
+RGBA_IMAGE    = 1
+GRAY_IMAGE    = 2
+GRAYA_IMAGE   = 3
+INDEXED_IMAGE = 4
+
+NORMAL_MODE = 0
+
+registered = []
+
+def register( *args ):
+
+    registered.append( args[0] )
+
+def main():
+
+    pass
+
+#----------------------------------------------------------------------------------
+
+layerbpp = { RGB_IMAGE : 3, RGBA_IMAGE : 4, GRAY_IMAGE : 1, GRAYA_IMAGE : 2 }
+
+bpptype = { 1 : GRAY_IMAGE, 2 : GRAYA_IMAGE, 3 : RGB_IMAGE, 4 : RGBA_IMAGE }
+
+# Converts packed pixels between 1 to 4 channels the way GIMP would
+
+def convertpixels( data, frombpp, tobpp ):
+
+    if frombpp == tobpp:
+        return str( data )
+
+    data = bytearray( data )
+    n = len( data ) / frombpp
+
+    if frombpp < 3:
+        gray = data[0::frombpp]
+        colour = [ gray, gray, gray ]
+    else:
+        colour = [ data[0::frombpp], data[1::frombpp], data[2::frombpp] ]
+
+    if frombpp in ( 2, 4 ):
+        alpha = data[frombpp-1::frombpp]
+    else:
+        alpha = bytearray( "\xff" * n )
+
+    out = bytearray( n * tobpp )
+
+    if tobpp < 3:
+        # the green channel is close enough to the luminance for timing
+        out[0::tobpp] = colour[1]
+    else:
+        for c in range( 3 ):
+            out[c::tobpp] = colour[c]
+
+    if tobpp in ( 2, 4 ):
+        out[tobpp-1::tobpp] = alpha
+
+    return str( out )
+
+#----------------------------------------------------------------------------------
+
+class PixelRgn( object ):
+
+    def __init__( self, drawable ):
+
+        self.drawable = drawable
+
+    def __getitem__( self, key ):
+
+        xs, ys = key
+        d = self.drawable
+
+        rows = []
+
+        for y in range( ys.start, ys.stop ):
+            start = ( y * d.width + xs.start ) * d.bpp
+            rows.append( str( d.data[ start:start + ( xs.stop - xs.start ) * d.bpp ] ) )
+
+        return "".join( rows )
+
+    def __setitem__( self, key, value ):
+
+        xs, ys = key
+        d = self.drawable
+
+        rowbytes = ( xs.stop - xs.start ) * d.bpp
+
+        for n, y in enumerate( range( ys.start, ys.stop ) ):
+            start = ( y * d.width + xs.start ) * d.bpp
+            d.data[ start:start + rowbytes ] = value[ n*rowbytes:(n+1)*rowbytes ]
+
+#----------------------------------------------------------------------------------
+
+class Layer( object ):
+
+    def __init__( self, image, name, width, height, layertype=RGBA_IMAGE, opacity=100, mode=NORMAL_MODE ):
+
+        self.image  = image
+        self.name   = name
+        self.width  = width
+        self.height = height
+        self.type   = layertype
+        self.bpp    = layerbpp[layertype]
+        self.data   = bytearray( width * height * self.bpp )
+
+        self.is_indexed = False
+        self.is_rgb     = layertype in ( RGB_IMAGE, RGBA_IMAGE )
+        self.is_gray    = layertype in ( GRAY_IMAGE, GRAYA_IMAGE )
+        self.has_alpha  = layertype in ( RGBA_IMAGE, GRAYA_IMAGE )
+
+    def get_pixel_rgn( self, x, y, width, height, dirty=True, shadow=False ):
+
+        return PixelRgn( self )
+
+    def flush( self ):
+
+        pass
+
+    def update( self, x, y, width, height ):
+
+        pass
+
+#----------------------------------------------------------------------------------
+
+class Image( object ):
+
+    def __init__( self, width, height, base_type=RGB ):
+
+        self.width     = width
+        self.height    = height
+        self.base_type = base_type
+        self.layers    = []
+        self.vectors   = []
+        self.filename  = None
+        self.parasites = {}
+
+    @property
+    def active_layer( self ):
+
+        if self.layers:
+            return self.layers[0]
+
+        return None
+
+    active_drawable = active_layer
+
+    def add_layer( self, layer, position=0 ):
+
+        layer.image = self
+        self.layers.insert( max( 0, position ), layer )
+
+    def remove_layer( self, layer ):
+
+        self.layers.remove( layer )
+
+    def parasite_find( self, name ):
+
+        return self.parasites.get( name )
+
+    def parasite_attach( self, parasite ):
+
+        self.parasites[ parasite.name ] = parasite
+
+#----------------------------------------------------------------------------------
+
+# A path is a list of strokes, each a list of ( x, y ) anchors
+
+class Vectors( object ):
+
+    def __init__( self, strokes ):
+
+        self.strokes = strokes
+
+#----------------------------------------------------------------------------------
+
+def writepam( fname, drawable ):
+
+    tupltype = { 1 : "GRAYSCALE", 2 : "GRAYSCALE_ALPHA", 3 : "RGB", 4 : "RGB_ALPHA" }[drawable.bpp]
+
+    f = open( fname, "wb" )
+    f.write( "P7\nWIDTH " + str( drawable.width ) + "\nHEIGHT " + str( drawable.height )
+             + "\nDEPTH " + str( drawable.bpp ) + "\nMAXVAL 255\nTUPLTYPE " + tupltype + "\nENDHDR\n" )
+    f.write( drawable.data )
+    f.close()
+
+def readpam( fname, image ):
+
+    f = open( fname, "rb" )
+
+    fields = {}
+
+    while True:
+        line = f.readline()
+
+        if line == "" or line.strip() == "ENDHDR":
+            break
+
+        words = line.split()
+
+        if len( words ) == 2:
+            fields[ words[0] ] = words[1]
+
+    width, height, depth = int( fields["WIDTH"] ), int( fields["HEIGHT"] ), int( fields["DEPTH"] )
+
+    data = f.read()
+    f.close()
+
+    if int( fields.get( "MAXVAL", 255 ) ) > 255:
+        # keep the high byte of each big endian sample
+        data = data[0::2]
+
+    layer = Layer( image, os.path.basename( fname ), width, height, bpptype[depth] )
+    layer.data[:] = data[ :len( layer.data ) ]
+
+    return layer
+
+#----------------------------------------------------------------------------------
+
+class _Gimp( object ):
+
+    directory = os.environ.get( "GIMPSTUB_DIRECTORY", tempfile.gettempdir() )
+
+    Image = Image
+    Layer = Layer
+
+    def __init__( self ):
+
+        self.foreground = ( 200, 100, 50 )
+        self.displays = []
+        self.messages = []
+
+    def message( self, text ):
+
+        self.messages.append( text )
+
+    def tile_height( self ):
+
+        return 64
+
+    def get_foreground( self ):
+
+        return self.foreground
+
+    def Display( self, image ):
+
+        self.displays.append( image )
+        return len( self.displays )
+
+    def displays_flush( self ):
+
+        pass
+
+    def delete( self, item ):
+
+        if item in self.displays:
+            self.displays.remove( item )
+
+#----------------------------------------------------------------------------------
+
+class _Pdb( object ):
+
+    def __getattr__( self, name ):
+
+        def call( *args ):
+            return None
+
+        return call
+
+    def gimp_temp_name( self, extension ):
+
+        fd, fname = tempfile.mkstemp( "." + extension )
+        os.close( fd )
+        os.remove( fname )
+        return fname
+
+    def gimp_image_new( self, width, height, base_type ):
+
+        return Image( width, height, base_type )
+
+    def gimp_image_duplicate( self, image ):
+
+        copy = Image( image.width, image.height, image.base_type )
+
+        for layer in reversed( image.layers ):
+            copy.add_layer( self.gimp_layer_new_from_drawable( layer, copy ), 0 )
+
+        return copy
+
+    def gimp_layer_new_from_drawable( self, drawable, image ):
+
+        layer = Layer( image, drawable.name, drawable.width, drawable.height, drawable.type )
+        layer.data[:] = drawable.data
+        return layer
+
+    def gimp_layer_new_from_visible( self, image, dest, name ):
+
+        # the top layer stands in for the composite, with alpha as GIMP gives
+        top = image.layers[0]
+
+        if image.base_type == GRAY:
+            layer = Layer( dest, name, top.width, top.height, GRAYA_IMAGE )
+        else:
+            layer = Layer( dest, name, top.width, top.height, RGBA_IMAGE )
+
+        layer.data[:] = convertpixels( top.data, top.bpp, layer.bpp )
+        return layer
+
+    def gimp_image_insert_layer( self, image, layer, parent, position ):
+
+        image.add_layer( layer, position )
+
+    def gimp_image_get_item_position( self, image, item ):
+
+        return image.layers.index( item )
+
+    def gimp_item_delete( self, item ):
+
+        pass
+
+    def gimp_image_get_colormap( self, image ):
+
+        return 0, []
+
+    def gimp_image_scale( self, image, width, height ):
+
+        # nearest neighbour is all a preview proxy needs here
+        for layer in image.layers:
+            scaled = Layer( image, layer.name, width, height, layer.type )
+
+            for y in range( height ):
+                sy = y * layer.height / height
+                for x in range( width ):
+                    sx = x * layer.width / width
+                    s = ( sy * layer.width + sx ) * layer.bpp
+                    d = ( y * width + x ) * layer.bpp
+                    scaled.data[ d:d + layer.bpp ] = layer.data[ s:s + layer.bpp ]
+
+            layer.width, layer.height, layer.data = width, height, scaled.data
+
+        image.width, image.height = width, height
+
+    def gimp_layer_add_alpha( self, layer ):
+
+        if not layer.has_alpha:
+            newtype = { RGB_IMAGE : RGBA_IMAGE, GRAY_IMAGE : GRAYA_IMAGE }[layer.type]
+
+            layer.data = bytearray( convertpixels( layer.data, layer.bpp, layerbpp[newtype] ) )
+            layer.type, layer.bpp, layer.has_alpha = newtype, layerbpp[newtype], True
+
+    def file_tiff_save( self, image, drawable, fname, rawname, compression ):
+
+        writepam( fname, drawable )
+
+    def gimp_file_save( self, image, drawable, fname, rawname ):
+
+        writepam( fname, drawable )
+
+    def gimp_file_load_layer( self, image, fname ):
+
+        return readpam( fname, image )
+
+    def file_tiff_load( self, fname, rawname ):
+
+        image = Image( 1, 1 )
+        layer = readpam( fname, image )
+
+        image.width, image.height = layer.width, layer.height
+        image.add_layer( layer, 0 )
+
+        return image
+
+    def gimp_image_get_active_vectors( self, image ):
+
+        if image.vectors:
+            return image.vectors[0]
+
+        return None
+
+    def gimp_vectors_get_strokes( self, vectors ):
+
+        if vectors == None:
+            return 0, []
+
+        return len( vectors.strokes ), range( len( vectors.strokes ) )
+
+    def gimp_vectors_stroke_get_points( self, vectors, stroke ):
+
+        # each anchor comes with its two control points, here on the anchor
+        points = []
+
+        for x, y in vectors.strokes[stroke]:
+            points.extend( [ x, y, x, y, x, y ] )
+
+        return 0, len( points ), points, False
+
+gimp = _Gimp()
+pdb  = _Pdb()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+'''
+Times the plug-in's operations end to end outside GIMP and writes the
+results as JSON, so that runs from different commits can be compared.
+
+    python benchmarks/operations.py [--sizes 256,1024] [--runs N]
+                                    [--transports pipe,raw,miff] [--ops a,b]
+                                    [--output FILE] [--compare FILE]
+                                    [--tolerance 0.25]
+
+The plug-in runs in this interpreter on top of the gimpfu stand-in in
+benchmarks/gimpstub, with an empty config directory, the result cache
+off and the timing log on, so each result also has the time of every
+phase.  Each operation runs on synthetic RGB images of the given sizes,
+once for each transport if it uses ImageMagick.  Operations which need
+ImageMagick, numpy or scipy are skipped when they are not available.
+The lens solvers are also timed on their own, without ImageMagick, for
+a single stroke and for several strokes of many points.
+
+With --compare, the medians are compared with an earlier output and the
+run fails if any is slower by more than the tolerance.
+'''
+
+import argparse
+import imp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname( os.path.abspath( __file__ ) )
+
+plugin = os.path.join( os.path.dirname( here ), "mm_tool_imagemagick.py" )
+
+#----------------------------------------------------------------------------------
+
+def loadplugin( configdir ):
+
+    os.environ["MM_TOOL_IMAGEMAGICK_DIR"] = configdir
+    os.environ["GIMPSTUB_DIRECTORY"] = configdir
+
+    sys.path.insert( 0, os.path.join( here, "gimpstub" ) )
+
+    # imported as itself so the stand-in's helpers share its module
+    module = imp.load_source( "mm_tool_imagemagick", plugin )
+
+    module.plugin_setcfgtag( "cache-size", "0" )
+    module.plugin_setcfgtag( "timing-log", "on" )
+
+    return module
+
+#----------------------------------------------------------------------------------
+
+# A deterministic RGB image with gradients and noise, so that neither
+# ImageMagick nor a cache can take a short cut.
+
+def synthetic( width, height ):
+
+    seed = 12345
+
+    row = bytearray( width * 3 )
+
+    for i in range( len( row ) ):
+        seed = ( seed * 1103515245 + 12345 ) & 0x7fffffff
+        row[i] = ( ( i / 3 ) * 255 / max( 1, width - 1 ) + ( seed >> 16 ) % 48 ) % 256
+
+    data = bytearray()
+
+    for y in range( height ):
+        shift = ( y * 7 % width ) * 3
+        data.extend( row[shift:] + row[:shift] )
+
+    return data
+
+#----------------------------------------------------------------------------------
+
+def makeimage( gimpfu, width, height, data ):
+
+    image = gimpfu.Image( width, height, gimpfu.RGB )
+    layer = gimpfu.Layer( image, "background", width, height, gimpfu.RGB_IMAGE )
+    layer.data[:] = data
+    image.add_layer( layer, 0 )
+
+    return image
+
+#----------------------------------------------------------------------------------
+
+# Points on a straight line at the given height ( 0 is the centre, 1 the
+# top ) as a lens with barrel distortion k would show them.
+
+def lenspoints( width, height, count, level=0.6, k=0.04 ):
+
+    cx, cy = width / 2.0, height / 2.0
+    norm = min( cx, cy )
+
+    points = []
+
+    for n in range( count ):
+        x = ( 0.15 + 0.7 * n / ( count - 1.0 ) ) * width - cx
+        y = -level * norm
+
+        r = ( x*x + y*y ) ** 0.5 / norm
+        scale = 1.0 - k * r * r
+
+        points.append( ( cx + x * scale, cy + y * scale ) )
+
+    return points
+
+# Several such lines from near the top to near the bottom, each a stroke,
+# with the points off by up to half a pixel as clicks would be.
+
+def lenslines( width, height, count, strokes ):
+
+    jitter = random.Random( 1 )
+
+    lines = []
+
+    for n in range( strokes ):
+        level = -0.8 + 1.6 * n / ( strokes - 1.0 )
+
+        lines.append( [ ( x + jitter.uniform( -0.5, 0.5 ), y + jitter.uniform( -0.5, 0.5 ) )
+                        for x, y in lenspoints( width, height, count, level ) ] )
+
+    return lines
+
+def addpath( gimpfu, image, points ):
+
+    image.vectors = [ gimpfu.Vectors( [ points ] ) ]
+
+def addlines( gimpfu, image, lines ):
+
+    image.vectors = [ gimpfu.Vectors( lines ) ]
+
+#----------------------------------------------------------------------------------
+
+# name : ( needs, run( plugin, gimpfu, image ) ).  Everything replaces the
+# active layer of the image it is given.
+
+def quadrilateral( gimpfu, image ):
+
+    w, h = image.width, image.height
+    addpath( gimpfu, image, [ ( 0.1*w, 0.1*h ), ( 0.9*w, 0.15*h ), ( 0.85*w, 0.9*h ), ( 0.15*w, 0.85*h ) ] )
+
+operations = [
+    ( "resize",           ( "imagemagick", ), lambda p, g, im : p.plugin_resize( im, im.active_layer, im.width / 2, 0, 1, 1 ) ),
+    ( "sketch",           ( "imagemagick", ), lambda p, g, im : p.plugin_sketch( im, im.active_layer, 5.0, 1.0, 45, 1, 1 ) ),
+    ( "charcoal",         ( "imagemagick", ), lambda p, g, im : p.plugin_charcoal( im, im.active_layer, 5.0, 1, 1 ) ),
+    ( "sepia",            ( "imagemagick", ), lambda p, g, im : p.plugin_sepia( im, im.active_layer, 80, 1, 1 ) ),
+    ( "colorspace",       ( "imagemagick", ), lambda p, g, im : p.plugin_colorspaceconversion( im, im.active_layer, 0, 1, 1 ) ),
+    ( "pipeline",         ( "imagemagick", ), lambda p, g, im : p.plugin_pipeline( im, im.active_layer, "resize " + str( im.width / 2 ) + "; sepia 80", 1, 1 ) ),
+    ( "rotate",           ( "imagemagick", ),
+      lambda p, g, im : ( addpath( g, im, [ ( 0.1*im.width, 0.2*im.height ), ( 0.9*im.width, 0.25*im.height ) ] ),
+                          p.plugin_rotate( im, im.active_layer, 0, 1, 1 ) ) ),
+    ( "perspective",      ( "imagemagick", ), lambda p, g, im : ( quadrilateral( g, im ), p.plugin_perspective( im, im.active_layer, True, 0, 1, 1 ) ) ),
+    ( "colordotproduct",  ( "numpy", ),       lambda p, g, im : p.plugin_colordotproduct( im, im.active_layer, 1, 1 ) ),
+    ( "colordistance",    ( "numpy", ),       lambda p, g, im : p.plugin_colordistance( im, im.active_layer, 1, 1 ) ),
+    ( "colordistance_lab", ( "numpy", ),      lambda p, g, im : p.plugin_colordistance_lab( im, im.active_layer, 1, 1 ) ),
+    ( "lens_b",           ( "imagemagick", "scipy" ),
+      lambda p, g, im : ( addpath( g, im, lenspoints( im.width, im.height, 3 ) ), p.plugin_lc_b( im, im.active_layer, 0, 1, 1 ) ) ),
+    ( "lens_c",           ( "imagemagick", "scipy" ),
+      lambda p, g, im : ( addpath( g, im, lenspoints( im.width, im.height, 3 ) ), p.plugin_lc_c( im, im.active_layer, 0, 1, 1 ) ) ),
+]
+
+# the solvers alone, given by the name of the plug-in function, the
+# number of points on each stroke and the number of strokes
+
+solvers = [
+    ( "solve_lens_b", "plugin_lc_b", 3, 1 ),
+    ( "solve_lens_c", "plugin_lc_c", 3, 1 ),
+    ( "solve_lenscorrection", "plugin_lenscorrection", 5, 1 ),
+    ( "solve_lenscorrection_inverse", "plugin_lenscorrection_inverse", 5, 1 ),
+    ( "solve_lens_b_lines", "plugin_lc_b", 50, 6 ),
+    ( "solve_lenscorrection_lines", "plugin_lenscorrection", 50, 6 ),
+]
+
+#----------------------------------------------------------------------------------
+
+def settransport( module, transport ):
+
+    if transport == "pipe":
+        module.plugin_setcfgtag( "transport", "pipe" )
+    else:
+        module.plugin_setcfgtag( "transport", "file" )
+        module.plugin_setcfgtag( "interchange-format", transport )
+
+#----------------------------------------------------------------------------------
+
+def lasttiming( configdir, since ):
+
+    logname = os.path.join( configdir, "mm_tool_imagemagick-timing.jsonl" )
+
+    if not os.path.exists( logname ):
+        return None
+
+    f = open( logname, "r" )
+    lines = f.readlines()
+    f.close()
+
+    if not lines:
+        return None
+
+    record = json.loads( lines[-1] )
+
+    if record["time"] < since:
+        return None
+
+    return record
+
+#----------------------------------------------------------------------------------
+
+def median( values ):
+
+    values = sorted( values )
+
+    return values[ len( values ) / 2 ]
+
+#----------------------------------------------------------------------------------
+
+# Runs one case and returns its result, run( image ) does the work
+
+def measure( gimpfu, configdir, name, size, transport, runs, data, run ):
+
+    result = { "op" : name, "size" : size, "transport" : transport }
+
+    times = []
+    phases = {}
+
+    for n in range( runs ):
+        image = makeimage( gimpfu, size, size, data )
+
+        del gimpfu.gimp.messages[:]
+
+        start = time.time()
+
+        try:
+            run( image )
+        except Exception, e:
+            result["status"] = "error"
+            result["error"] = e.__class__.__name__ + " : " + str( e )
+            return result
+
+        seconds = time.time() - start
+
+        if gimpfu.gimp.messages:
+            result["status"] = "error"
+            result["error"] = gimpfu.gimp.messages[-1]
+            return result
+
+        times.append( seconds )
+
+        record = lasttiming( configdir, start )
+
+        if record != None:
+            for phase, t in record["phases"].items():
+                phases.setdefault( phase, [] ).append( t["wall"] )
+
+    result["status"]  = "ok"
+    result["runs"]    = [ round( t, 6 ) for t in times ]
+    result["median"]  = round( median( times ), 6 )
+    result["min"]     = round( min( times ), 6 )
+    result["phases"]  = dict( [ ( phase, round( median( t ), 6 ) ) for phase, t in phases.items() ] )
+
+    return result
+
+#----------------------------------------------------------------------------------
+
+def solveonly( module, function ):
+
+    captured = []
+
+    def capture( image, src, dest, function, arg, title, tiling=None ):
+        captured.append( arg )
+
+    def run( image ):
+        saved = module.plugin_runoperation
+        module.plugin_runoperation = capture
+
+        try:
+            getattr( module, function )( image, image.active_layer, 0, 1, 1 )
+        finally:
+            module.plugin_runoperation = saved
+
+    return run
+
+#----------------------------------------------------------------------------------
+
+def compare( results, earlier, tolerance ):
+
+    before = {}
+
+    for r in earlier["results"]:
+        if r["status"] == "ok":
+            before[ ( r["op"], r["size"], r["transport"] ) ] = r["median"]
+
+    regressions = []
+
+    for r in results:
+        key = ( r["op"], r["size"], r["transport"] )
+
+        if r["status"] != "ok" or key not in before or before[key] <= 0:
+            continue
+
+        ratio = r["median"] / before[key]
+
+        sys.stderr.write( "%-30s %6d %-5s %9.4fs %9.4fs %6.2fx\n" % ( key + ( before[key], r["median"], ratio ) ) )
+
+        if ratio > 1.0 + tolerance:
+            regressions.append( key )
+
+    return regressions
+
+#----------------------------------------------------------------------------------
+
+def gitcommit():
+
+    try:
+        child = subprocess.Popen( [ "git", "rev-parse", "HEAD" ], cwd=here,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+        stdoutdata, stderrdata = child.communicate()
+    except OSError:
+        return None
+
+    if child.returncode != 0:
+        return None
+
+    return stdoutdata.strip()
+
+#----------------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser( description="Plug-in operation times." )
+    parser.add_argument( "--sizes", default="256,1024,2048", help="image edges in pixels" )
+    parser.add_argument( "--runs", type=int, default=3, help="runs of each case, the median is reported" )
+    parser.add_argument( "--transports", default="pipe,raw,miff", help="pipe or an interchange format" )
+    parser.add_argument( "--ops", help="only these operations" )
+    parser.add_argument( "--output", help="write the JSON here rather than to stdout" )
+    parser.add_argument( "--compare", help="an earlier output to compare with" )
+    parser.add_argument( "--tolerance", type=float, default=0.25, help="allowed slow down, 0.25 is 25%%" )
+    opts = parser.parse_args()
+
+    sizes = [ int( s ) for s in opts.sizes.split( "," ) ]
+    transports = opts.transports.split( "," )
+
+    wanted = None
+
+    if opts.ops != None:
+        wanted = opts.ops.split( "," )
+
+    configdir = tempfile.mkdtemp( prefix="mm_tool_imagemagick-bench-" )
+
+    # the plug-in prints as it goes, keep stdout for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    try:
+        module = loadplugin( configdir )
+        import gimpfu
+
+        info = module.plugin_iminfo()
+
+        have = { "imagemagick" : info["binary"] != None,
+                 "numpy" : module.plugin_importnumpy(),
+                 "scipy" : module.plugin_importscipy() }
+
+        results = []
+
+        for size in sizes:
+            data = synthetic( size, size )
+
+            for name, needs, run in operations:
+                if wanted != None and name not in wanted:
+                    continue
+
+                if needs == ( "numpy", ) and not have["numpy"]:
+                    # the colour operations fall back to ImageMagick
+                    needs = ( "imagemagick", )
+
+                missing = [ n for n in needs if not have[n] ]
+
+                if "imagemagick" in needs:
+                    cases = transports
+                else:
+                    cases = [ "-" ]
+
+                for transport in cases:
+                    if missing:
+                        results.append( { "op" : name, "size" : size, "transport" : transport,
+                                          "status" : "skipped", "missing" : missing } )
+                        continue
+
+                    if transport != "-":
+                        settransport( module, transport )
+
+                    sys.stderr.write( name + " " + str( size ) + " " + transport + "\n" )
+
+                    results.append( measure( gimpfu, configdir, name, size, transport, opts.runs, data,
+                                             lambda image : run( module, gimpfu, image ) ) )
+
+        # the solvers are quick, so they get more runs on a small image
+        data = synthetic( 64, 64 )
+
+        for name, function, count, strokes in solvers:
+            if ( wanted != None and name not in wanted ) or not hasattr( module, function ):
+                continue
+
+            if not have["scipy"]:
+                results.append( { "op" : name, "size" : 64, "transport" : "-",
+                                  "status" : "skipped", "missing" : [ "scipy" ] } )
+                continue
+
+            solve = solveonly( module, function )
+
+            def run( image, solve=solve, count=count, strokes=strokes ):
+                if strokes == 1:
+                    addpath( gimpfu, image, lenspoints( image.width, image.height, count ) )
+                else:
+                    addlines( gimpfu, image, lenslines( image.width, image.height, count, strokes ) )
+                solve( image )
+
+            results.append( measure( gimpfu, configdir, name, 64, "-", max( 20, opts.runs ), data, run ) )
+
+        # settings are written behind, so write them before the directory goes
+        module.plugin_flushconfig()
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree( configdir, True )
+
+    output = { "commit" : gitcommit(),
+               "time" : time.time(),
+               "python" : sys.version.split()[0],
+               "platform" : sys.platform,
+               "imagemagick" : info["version"] or None,
+               "numpy" : have["numpy"],
+               "scipy" : have["scipy"],
+               "results" : results }
+
+    text = json.dumps( output, indent=1, sort_keys=True )
+
+    if opts.output != None:
+        f = open( opts.output, "w" )
+        f.write( text + "\n" )
+        f.close()
+    else:
+        print text
+
+    if opts.compare != None:
+        f = open( opts.compare, "r" )
+        earlier = json.load( f )
+        f.close()
+
+        regressions = compare( results, earlier, opts.tolerance )
+
+        if regressions:
+            sys.stderr.write( str( len( regressions ) ) + " cases slower than allowed\n" )
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+Measures how long GIMP waits for the plug-in to start, which happens each
+time GIMP queries or runs it, and fails if it is over budget.
+
+    python benchmarks/startup.py [--runs N] [--budget SECONDS]
+
+Each run imports and registers the plug-in in a new interpreter, using
+the gimpfu stub in benchmarks/gimpstub and an empty config directory.
+The first run fills the cache of ImageMagick lists, as the first start
+after installing does, and is reported on its own.  The budget applies to
+the median of the others.  Starting must not import numpy, scipy or gtk.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname( os.path.abspath( __file__ ) )
+
+plugin = os.path.join( os.path.dirname( here ), "mm_tool_imagemagick.py" )
+
+# runs in the new interpreter and prints what it found as JSON
+probe = """
+import imp, json, sys, time
+start = time.time()
+module = imp.load_source( "mm_tool_imagemagick", %r )
+seconds = time.time() - start
+import gimpfu
+print( json.dumps( { "seconds" : seconds,
+                     "registered" : len( gimpfu.registered ),
+                     "heavy" : [ m for m in ( "numpy", "scipy", "gtk", "gobject" ) if m in sys.modules ] } ) )
+"""
+
+#----------------------------------------------------------------------------------
+
+def startup( configdir ):
+
+    env = dict( os.environ )
+    
+    env["PYTHONPATH"] = os.pathsep.join( [ os.path.join( here, "gimpstub" ), env.get( "PYTHONPATH", "" ) ] )
+    env["MM_TOOL_IMAGEMAGICK_DIR"] = configdir
+    env["GIMPSTUB_DIRECTORY"] = configdir
+    
+    child = subprocess.Popen( [ sys.executable, "-c", probe % plugin ],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              env=env
+                             )
+    
+    stdoutdata, stderrdata = child.communicate()
+    
+    if child.returncode != 0:
+        sys.stderr.write( stderrdata )
+        sys.exit( 2 )
+    
+    return json.loads( stdoutdata.strip().split( "\n" )[-1] )
+
+#----------------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser( description="Plug-in startup time." )
+    parser.add_argument( "--runs", type=int, default=10 )
+    parser.add_argument( "--budget", type=float, default=0.25, help="seconds for a warm start" )
+    opts = parser.parse_args()
+    
+    configdir = tempfile.mkdtemp( prefix="mm_tool_imagemagick-bench-" )
+    
+    try:
+        first = startup( configdir )
+        runs = [ startup( configdir ) for n in range( max( 1, opts.runs ) ) ]
+    finally:
+        shutil.rmtree( configdir, True )
+    
+    times = sorted( [ r["seconds"] for r in runs ] )
+    median = times[ len( times ) / 2 ]
+    
+    heavy = sorted( set( first["heavy"] + sum( [ r["heavy"] for r in runs ], [] ) ) )
+    
+    print json.dumps( { "first" : round( first["seconds"], 4 ),
+                        "median" : round( median, 4 ),
+                        "max" : round( times[-1], 4 ),
+                        "budget" : opts.budget,
+                        "registered" : first["registered"],
+                        "heavy_imports" : heavy }, indent=1 )
+    
+    failed = False
+    
+    if median > opts.budget:
+        sys.stderr.write( "startup took " + str( round( median, 4 ) ) + "s, the budget is " + str( opts.budget ) + "s\n" )
+        failed = True
+    
+    if heavy:
+        sys.stderr.write( "startup imported " + ", ".join( heavy ) + "\n" )
+        failed = True
+    
+    if failed:
+        return 1
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
 '''
 mm_tool_imagemagick.py
@@ -79,63 +80,332 @@ http://www.gnu.org/copyleft/gpl.html
 
 '''
 
-from gimpfu import *
+try:
+    from gimpfu import *
+    
+    gimpfu_imported = True
+except ImportError:
+    # not run by GIMP, only batch mode can work
+    gimpfu_imported = False
+
 import subprocess
 import os
 import sys
 import time
-import gtk
 import math
+import multiprocessing
+import Queue
+import re
 import shutil
+import tempfile
+import threading
+import cStringIO
+import json
+import hashlib
+import shlex
+import struct
+import imp
+import select
+import signal
+import errno
+import atexit
+
+# numpy and scipy take longer to import than the rest of the plug-in and
+# GIMP runs the module every time it starts, so here we only find out if
+# they are installed.  They are imported when an operation needs them.
+
+numpy = None
+scopt = None
+
+def plugin_havemodule( name ):
 
-try:
-    import numpy
+    try:
+        f, pathname, description = imp.find_module( name )
+    except ImportError:
+        return False
+    
+    if f != None:
+        f.close()
+    
+    return True
 
-    numpy_imported = True
+numpy_imported = plugin_havemodule( "numpy" )
+scipy_imported = numpy_imported and plugin_havemodule( "scipy" )
 
-    try:
-        import scipy.optimize as scopt
+#----------------------------------------------------------------------------------
 
-        scipy_imported = True
-    except:
-        scipy_imported = False
+def plugin_importnumpy():
+
+    global numpy, numpy_imported
     
-except ImportError:
-    numpy_imported = False
-    scipy_imported = False
+    if numpy == None:
+        try:
+            import numpy
+        except ImportError:
+            # installed but broken
+            numpy_imported = False
+    
+    return numpy_imported
 
 #----------------------------------------------------------------------------------
 
-def plugin_maketempfile( image, src ):
+def plugin_importscipy():
 
-    # Copy so the save operations doesn't affect the original
-    tempimage = pdb.gimp_image_duplicate( image )
+    global scopt, scipy_imported
     
-    if not tempimage:
-        print "mm_tool_imagemagick could not create temporary image file."
-        return None, None, None
+    if scopt == None and plugin_importnumpy():
+        try:
+            import scipy.optimize as scopt
+        except ImportError:
+            scipy_imported = False
+    
+    return scipy_imported and numpy_imported
+
+#----------------------------------------------------------------------------------
+
+# Temp file interchange formats and their file extensions.  TIFF is saved
+# by GIMP ( uncompressed ) and the others are written from pixel regions
+# by plugin_writepixels.  PNM is an alias for PAM as PAM is the only one
+# of the netpbm formats which can hold an alpha channel.
+
+plugin_interchange_exts = { "tiff" : "tif", "miff" : "miff", "pam" : "pam", "pnm" : "pam", "raw" : "raw" }
+
+#----------------------------------------------------------------------------------
+
+def plugin_interchange_format():
+
+    fmt = plugin_getcfgtag( "interchange-format" )
+    
+    if fmt == None or fmt.lower() not in plugin_interchange_exts:
+        fmt = "tiff"
+    
+    delegates = plugin_iminfo()["delegates"]
+    
+    if fmt.lower() == "tiff" and delegates and "tiff" not in delegates:
+        # built without libtiff, MIFF is always built in
+        return "miff"
+    
+    return fmt.lower()
+
+#----------------------------------------------------------------------------------
+
+def plugin_interchange_depth():
+
+    # a Q8 build would only throw the extra precision away
+    if plugin_getcfgtag( "interchange-depth" ) == "16" and plugin_iminfo()["quantum"] > 8:
+        return 16
+    else:
+        return 8
+
+#----------------------------------------------------------------------------------
+
+# RAM backed directories tried for temp files before GIMP's own temp
+# directory, which is often on a slow disk.  A directory set with the
+# temp-dir config tag is tried first.
+
+plugin_fasttempdirs = [ "/dev/shm" ]
+
+#----------------------------------------------------------------------------------
+
+def plugin_freespace( d ):
+
+    if hasattr( os, "statvfs" ):
+        st = os.statvfs( d )
+        return st.f_bavail * st.f_frsize
+    
+    if sys.platform.startswith( "win" ):
+        import ctypes
+        free = ctypes.c_ulonglong( 0 )
+        if ctypes.windll.kernel32.GetDiskFreeSpaceExW( unicode( d ), None, None, ctypes.pointer( free ) ):
+            return free.value
+    
+    # we don't know
+    return None
+
+#----------------------------------------------------------------------------------
+
+def plugin_physicalmemory():
+
+    if hasattr( plugin_physicalmemory, "size" ):
+        return plugin_physicalmemory.size
+    
+    plugin_physicalmemory.size = None
+    
+    if hasattr( os, "sysconf" ):
+        try:
+            plugin_physicalmemory.size = os.sysconf( "SC_PAGE_SIZE" ) * os.sysconf( "SC_PHYS_PAGES" )
+        except ( ValueError, OSError ):
+            pass
+    
+    elif sys.platform.startswith( "win" ):
+        import ctypes
+        
+        class MEMORYSTATUSEX( ctypes.Structure ):
+            _fields_ = [ ( "dwLength", ctypes.c_ulong ),
+                         ( "dwMemoryLoad", ctypes.c_ulong ),
+                         ( "ullTotalPhys", ctypes.c_ulonglong ),
+                         ( "ullAvailPhys", ctypes.c_ulonglong ),
+                         ( "ullTotalPageFile", ctypes.c_ulonglong ),
+                         ( "ullAvailPageFile", ctypes.c_ulonglong ),
+                         ( "ullTotalVirtual", ctypes.c_ulonglong ),
+                         ( "ullAvailVirtual", ctypes.c_ulonglong ),
+                         ( "ullAvailExtendedVirtual", ctypes.c_ulonglong ) ]
+        
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof( status )
+        
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx( ctypes.byref( status ) ):
+            plugin_physicalmemory.size = status.ullTotalPhys
+    
+    return plugin_physicalmemory.size
+
+#----------------------------------------------------------------------------------
+
+def plugin_tempspace( width, height ):
+
+    # the temp file before and after processing plus room for two Q16
+    # RGBA images in case ImageMagick spills its pixel cache to disk
+    filebytes = width * height * 4 * plugin_interchange_depth() / 8
+    
+    return 2 * filebytes + 2 * width * height * 8
+
+#----------------------------------------------------------------------------------
+
+# Picks the directory for temp files of an image of the given size and
+# points the ImageMagick pixel cache at the same place.
+
+def plugin_tempdir( width, height ):
+
+    needed = plugin_tempspace( width, height )
+    
+    cfgdir = plugin_getcfgtag( "temp-dir" )
+    
+    if cfgdir != None:
+        dirs = [ cfgdir ] + plugin_fasttempdirs
+    else:
+        dirs = plugin_fasttempdirs
+    
+    tempdir = None
+    
+    for d in dirs:
+        if not os.path.isdir( d ) or not os.access( d, os.W_OK ):
+            continue
+        
+        free = plugin_freespace( d )
+        
+        # a configured directory is trusted if we can't check it
+        if ( free == None and d == cfgdir ) or ( free != None and free >= needed ):
+            tempdir = d
+            break
+    
+    if tempdir == None and gimpfu_imported:
+        # Use the temp dir from gimp, it reflects the user's choices in gimp.rc
+        tempdir = os.path.dirname( pdb.gimp_temp_name( "tmp" ) )
+    elif tempdir == None:
+        tempdir = tempfile.gettempdir()
     
-    # Use temp file names from gimp, it reflects the user's choices in gimp.rc
-    tempfilename = pdb.gimp_temp_name( "tif" )
+    os.environ["MAGICK_TEMPORARY_PATH"] = tempdir
+    
+    plugin_sweeptemp( tempdir )
+    
+    return tempdir
+
+#----------------------------------------------------------------------------------
+
+def plugin_tempname( ext, width, height ):
+
+    prefix = "mm_tool_imagemagick-" + str( os.getpid() ) + "-"
+    
+    fd, fname = tempfile.mkstemp( "." + ext, prefix, plugin_tempdir( width, height ) )
+    
+    os.close( fd )
     
     if sys.platform.startswith( "win" ):
         # on MS Windows we can use either forward- or back- slashes
         # in file paths.
         # Backslashes can be problematic when dealing with strings
         # so let's replace them just in case.
-        tempfilename = tempfilename.replace( "\\", "/" )
+        fname = fname.replace( "\\", "/" )
+    
+    plugin_tempfiles.add( fname )
+    
+    return fname
+
+#----------------------------------------------------------------------------------
+
+# Writes the source to a temp file and returns its name, the drawable
+# written and the temporary image holding it.  Formats written from
+# pixel regions need no temporary image, so tempimage is None and so is
+# tempdrawable if it was a temporary visible layer which has now gone.
+
+def plugin_maketempfile( image, src, fmt=None ):
+
+    if fmt == None:
+        fmt = plugin_interchange_format()
+    
+    if src == 1 and not plugin_canusepixels( image, image.active_drawable ):
+        # only GIMP can save indexed images properly
+        fmt = "tiff"
+    elif not plugin_canusepixels( image, None ):
+        fmt = "tiff"
+    
+    width, height = plugin_sourcesize( image, src )
+    
+    tempfilename = plugin_tempname( plugin_interchange_exts[fmt], width, height )
+    
+    pdb.gimp_progress_set_text( "Saving a copy" )
+    
+    phase = plugin_phasestart()
+    
+    if fmt != "tiff":
+        # read straight from the source, no copy of the image is needed
+        tempdrawable, istemp = plugin_sourcedrawable( image, src )
+        
+        plugin_phaseend( "copy", phase )
+        phase = plugin_phasestart()
+        
+        plugin_writepixels( tempfilename, tempdrawable, plugin_interchange_depth() )
+        
+        plugin_phaseend( "save", phase )
+        
+        if istemp:
+            pdb.gimp_item_delete( tempdrawable )
+            tempdrawable = None
+        
+        return tempfilename, tempdrawable, None
+    
+    # Copy only what is saved into a new image so the save operations
+    # don't affect the original.  Duplicating the whole image would copy
+    # every layer, mask and channel just to save one drawable.
+    tempimage = pdb.gimp_image_new( width, height, image.base_type )
+    
+    if not tempimage:
+        print "mm_tool_imagemagick could not create temporary image file."
+        plugin_tidyup( tempfilename )
+        return None, None, None
+    
+    if image.base_type == INDEXED:
+        num_bytes, colormap = pdb.gimp_image_get_colormap( image )
+        pdb.gimp_image_set_colormap( tempimage, num_bytes, colormap )
     
     if src == 0:  
         # Get the current visible
         tempdrawable = pdb.gimp_layer_new_from_visible( image, tempimage, "visible" ) 
     else:
-        # Save in temporary.  Note: empty user entered file name
-        tempdrawable = pdb.gimp_image_get_active_drawable( tempimage )
-
+        tempdrawable = pdb.gimp_layer_new_from_drawable( image.active_drawable, tempimage )
+    
+    pdb.gimp_image_insert_layer( tempimage, tempdrawable, None, 0 )
+    
+    pdb.gimp_layer_set_offsets( tempdrawable, 0, 0 )
+    
+    plugin_phaseend( "copy", phase )
+    phase = plugin_phasestart()
+    
     # !!! Note no run-mode first parameter, and user entered filename is empty string
-    pdb.gimp_progress_set_text( "Saving a copy" )
+    # Save without compression as LZW costs more than most operations
+    pdb.file_tiff_save( tempimage, tempdrawable, tempfilename, "", 0 )
     
-    pdb.gimp_file_save( tempimage, tempdrawable, tempfilename, "" )
+    plugin_phaseend( "save", phase )
     
     return tempfilename, tempdrawable, tempimage
 
@@ -146,10 +416,22 @@ def plugin_saveresult( image, dest, tempfilename, tempimage ):
     # Get image file name
     name = image.filename
     
-    if dest == 0 :
+    phase = plugin_phasestart()
+    
+    if not tempfilename.endswith( ".tif" ):
+        # formats we wrote ourselves are read back the same way
+        if not plugin_loadpixels( image, dest, tempfilename ):
+            print "mm_tool_imagemagick could not read back temp file."
+        
+        plugin_phaseend( "load", phase )
+    
+    elif dest == 0 :
         # new image
         try: 
             newimage = pdb.file_tiff_load( tempfilename, "" )
+            
+            plugin_phaseend( "load", phase )
+            phase = plugin_phasestart()
 
             # Get exif data
             exifdata = image.parasite_find( "exif-data" )
@@ -163,6 +445,8 @@ def plugin_saveresult( image, dest, tempfilename, tempimage ):
                 newimage.filename = name
 
             gimp.Display( newimage )
+            
+            plugin_phaseend( "insert", phase )
         except: 
             print "mm_tool_imagemagick could not load tmep file as new image."
         
@@ -174,9 +458,14 @@ def plugin_saveresult( image, dest, tempfilename, tempimage ):
         try:
             newlayer = pdb.gimp_file_load_layer( image, tempfilename )
             
+            plugin_phaseend( "load", phase )
+            phase = plugin_phasestart()
+            
             image.remove_layer( image.active_layer )
             
             image.add_layer( newlayer, pos )
+            
+            plugin_phaseend( "insert", phase )
         except:
             print "mm_tool_imagemagick Could not load temp file into existing layer."
         
@@ -184,8 +473,13 @@ def plugin_saveresult( image, dest, tempfilename, tempimage ):
         # Add as a new layer in the opened image
         try:
             newlayer = pdb.gimp_file_load_layer( image, tempfilename )
+            
+            plugin_phaseend( "load", phase )
+            phase = plugin_phasestart()
         
             image.add_layer( newlayer,0 )
+            
+            plugin_phaseend( "insert", phase )
         except:
             print "mm_tool_imagemagick Could not load temp file into new layer."
 
@@ -196,1152 +490,5271 @@ def plugin_saveresult( image, dest, tempfilename, tempimage ):
 
     gimp.displays_flush()
 
-    gimp.delete( tempimage )   # delete the temporary image
+    if tempimage != None:
+        gimp.delete( tempimage )   # delete the temporary image
     
 
 #----------------------------------------------------------------------------------
 
 def plugin_tidyup( fname ):
 
+    plugin_tempfiles.discard( fname )
+
     if os.access( fname, os.F_OK ):
         os.remove( fname )
+    
+    # raw temp files have a sidecar header
+    if os.access( fname + ".hdr", os.F_OK ):
+        os.remove( fname + ".hdr" )
 
 #----------------------------------------------------------------------------------
 
-def plugin_docommand( function, arg, tempfilename, title ):
+'''
+ImageMagick is found once per session and what it can do is kept in a
+cache file, so it is only asked again when the binary found, or its
+modification time, changes.  GIMP runs the whole module each time it
+queries or runs the plug-in, so a warm start runs no commands at all.
+
+The binary is looked for in the "imagemagick-path" config setting, then
+$MAGICK_HOME, the PATH and on Windows the ImageMagick folders in Program
+Files.  ImageMagick 7's single magick program is preferred to the
+ImageMagick 6 mogrify and convert, which on Windows are only looked for
+next to mogrify as Windows has a convert of its own.
+
+The cache also holds the quantum depth, HDRI, OpenMP and thread count,
+the built-in delegates and the filter and colorspace lists.
+'''
+
+def plugin_exe( name ):
+
+    if sys.platform.startswith( "win" ):
+        return name + ".exe"
+    
+    return name
+
+#----------------------------------------------------------------------------------
+
+
+def plugin_isprogram( fname ):
+
+    return os.path.isfile( fname ) and os.access( fname, os.X_OK )
+
+#----------------------------------------------------------------------------------
+
+def plugin_imdirs():
 
-    if sys.platform.startswith( "linux" ):
-        # Command line for linux
-        command = function + " " + arg + " \"" + tempfilename + "\""
+    dirs = []
     
-    elif sys.platform.startswith( "darwin" ):
-        # Command line for OSX
-        command = function + " " + arg + " \"" + tempfilename + "\""
+    if "MAGICK_HOME" in os.environ:
+        home = os.environ["MAGICK_HOME"]
+        dirs = dirs + [ os.path.join( home, "bin" ), home ]
     
-    elif sys.platform.startswith( "win" ):
-        # On WIndows we have to find the ImageMagick directory ourselves
-        dl = os.listdir( "C:/Program Files" )
-        cmdpath = None
-        for d in dl:
-            # ImageMagick installs to a folder starting with ImageMagick
-            # but with version information after that we cannot know
-            if d.startswith("ImageMagick"):
-                cmdpath = "\"C:/Program Files/" + d + "/" + function + ".exe\""
-                break
-        command = cmdpath + " " + arg + " \" -quiet " + tempfilename + "\""
+    dirs = dirs + [ d for d in os.environ.get( "PATH", "" ).split( os.pathsep ) if d != "" ]
     
-    else:
-        # did not pick up OS from sys.platform
-        gimp.message( "OS was not identified by script : " + sys.platform )
-        return False
+    if sys.platform.startswith( "win" ) and os.path.isdir( "C:/Program Files" ):
+        # newest version first
+        for d in sorted( os.listdir( "C:/Program Files" ), reverse=True ):
+            if d.startswith( "ImageMagick" ):
+                dirs.append( "C:/Program Files/" + d )
     
-    # Invoke mogrify.
+    return dirs
 
-    pdb.gimp_progress_set_text( title )
-    pdb.gimp_progress_pulse()
+#----------------------------------------------------------------------------------
+
+# Returns the magick or mogrify binary to use and True if it is magick.
+
+def plugin_imfind():
+
+    override = plugin_getcfgtag( "imagemagick-path" )
     
-    # NOTE : Sometimes pythonw.exe fails if you do not PIPE all three
-    # of the standard channels, even if your process does not need them.
-    # so we must use stdin as well as stdout and stderr
+    if override != None and override != "":
+        if os.path.isdir( override ):
+            for name in ( "magick", "mogrify" ):
+                fname = os.path.join( override, plugin_exe( name ) )
+                if plugin_isprogram( fname ):
+                    return fname, name == "magick"
+        elif plugin_isprogram( override ):
+            return override, os.path.basename( override ).lower() in ( "magick", "magick.exe" )
+        
+        plugin_message( "ImageMagick was not found at " + override + ", looking elsewhere" )
     
-    child = subprocess.Popen( command,
-                              stderr=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE,
-                              shell=True
-                             )
+    dirs = plugin_imdirs()
+    
+    for name in ( "magick", "mogrify" ):
+        for d in dirs:
+            fname = os.path.join( d, plugin_exe( name ) )
+            if plugin_isprogram( fname ):
+                return fname, name == "magick"
+    
+    return None, False
 
+#----------------------------------------------------------------------------------
 
-    # child.communicate()
-    
-    while child.poll() is None:
-        pdb.gimp_progress_pulse()
-        time.sleep(0.2)
+'''
+Commands are lists of arguments which are run without a shell, so
+nothing needs quoting and no shell is started for each command.  The
+argument builders return lists too, and numbers go through plugin_num so
+they are written in full precision whatever the locale.
+'''
 
-#    if child.returncode != 0:
-    stdoutdata, stderrdata = child.communicate()
-    #    gimp.message( "Error return was [ " + stderrdata + "]" )
+def plugin_num( x ):
 
-##__devcode
+    if isinstance( x, ( int, long ) ):
+        return str( x )
+    
+    # repr is the shortest string which reads back as the same float
+    return repr( float( x ) )
 
-    print "+----------------------------------------------------------+"
-    print stdoutdata
-    print "+----------------------------------------------------------+"
+#----------------------------------------------------------------------------------
 
-##__end_devcode
+# Flattens its arguments into one list of strings.  Numbers are written
+# by plugin_num and None is left out.
 
-    return True
+def plugin_argv( *parts ):
+
+    argv = []
+    
+    for part in parts:
+        if part == None:
+            continue
+        elif isinstance( part, ( list, tuple ) ):
+            argv.extend( plugin_argv( *part ) )
+        elif isinstance( part, basestring ):
+            argv.append( part )
+        else:
+            argv.append( plugin_num( part ) )
+    
+    return argv
 
 #----------------------------------------------------------------------------------
 
-# run a command which returns text but does no image processing
+'''
+GIMP stops a plug-in when its progress is cancelled, so the plug-in has to
+clean up on the way out.  Every ImageMagick child gets a process group of
+its own, so it can be killed along with any delegate it has started.  On
+Linux the child is also told to die with the thread that started it, in
+case the plug-in is killed outright.  When the plug-in is terminated it
+kills the children that are still running and removes its open temp
+files.  Temp names carry the plug-in's pid, so files left behind by a
+plug-in that was killed are removed the next time a temp dir is chosen.
+'''
 
-def plugin_silentcommand( function, arg ):
+plugin_children = {}
+plugin_tempfiles = set()
+plugin_childlock = threading.Lock()
 
-    if sys.platform.startswith( "linux" ):
-        # Command line for linux
-        command = function + " " + arg
-    
-    elif sys.platform.startswith( "darwin" ):
-        # Command line for OSX
-        command = function + " " + arg
+def plugin_prctl():
+
+    if not hasattr( plugin_prctl, "call" ):
+        plugin_prctl.call = None
+        
+        if sys.platform.startswith( "linux" ):
+            try:
+                import ctypes
+                plugin_prctl.call = ctypes.CDLL( None ).prctl
+            except ( ImportError, OSError, AttributeError ):
+                pass
     
-    elif sys.platform.startswith( "win" ):
-        # On WIndows we have to find the ImageMagick directory ourselves
-        dl = os.listdir( "C:/Program Files" )
-        cmdpath = None
-        for d in dl:
-            # ImageMagick installs to a folder starting with ImageMagick
-            # but with version information after that we cannot know
-            if d.startswith("ImageMagick"):
-                cmdpath = "\"C:/Program Files/" + d + "/" + function + ".exe\""
-                break
-        command = cmdpath + " " + arg
+    return plugin_prctl.call
+
+#----------------------------------------------------------------------------------
+
+# Starts argv with all three standard channels piped and remembers the
+# child so it can be killed if the plug-in is cancelled.
+
+def plugin_popen( argv ):
+
+    setup = None
+    closefds = False
     
-    else:
-        # did not pick up OS from sys.platform
-        gimp.message( "OS was not identified by script : " + sys.platform )
-        return None
+    if not sys.platform.startswith( "win" ):
+        # looked up here, nothing may be imported between fork and exec
+        prctl = plugin_prctl()
+        
+        def setup():
+            os.setpgrp()
+            if prctl != None:
+                # PR_SET_PDEATHSIG
+                prctl( 1, signal.SIGKILL )
+        
+        # children are started from several threads at once and Python 2
+        # pipes are inherited, so a child could hold another child's stdin
+        # open and that one would never see the end of it
+        closefds = True
     
     # NOTE : Sometimes pythonw.exe fails if you do not PIPE all three
     # of the standard channels, even if your process does not need them.
     # so we must use stdin as well as stdout and stderr
     
-    child = subprocess.Popen( command,
+    child = subprocess.Popen( argv,
                               stderr=subprocess.PIPE,
                               stdout=subprocess.PIPE,
                               stdin=subprocess.PIPE,
-                              shell=True
+                              preexec_fn=setup,
+                              close_fds=closefds
                              )
-
-    # child.communicate()
     
-    stdoutdata, stderrdata = child.communicate()
-
-    return stdoutdata
+    plugin_catchsignals()
+    
+    plugin_childlock.acquire()
+    
+    for pid in plugin_children.keys():
+        if plugin_children[pid].returncode != None:
+            del plugin_children[pid]
+    
+    plugin_children[child.pid] = child
+    
+    plugin_childlock.release()
+    
+    return child
 
 #----------------------------------------------------------------------------------
 
-def plugin_resize_filters( idx ):
+def plugin_killchildren():
 
-    if not hasattr( plugin_resize_filters, "resize_filters"):
-        # initialize
-        filters = plugin_silentcommand( "mogrify", "-list filter" )
-        if filters != None:
-            plugin_resize_filters.resize_filters = filters.split("\n")
-        else:
-            # fallback in case we could not get the list from mogrify
-            plugin_resize_filters.resize_filters = [ "Lanczos",
-                "Catrom",
-                "Mitchell",
-                "Cubic",
-                "Point",
-                "Box",
-                "Triangle",
-                "Hermite",
-                "Gaussian",
-                "Quadratic",
-                "Blackman",
-                "Hanning",
-                "Kaiser",
-                "Hamming",
-                "Bartlett",
-                "Parzen",
-                "Welsh",
-                "Bohman"
-                ]
+    # no lock, this runs in a signal handler which may have interrupted
+    # the main thread while it held it
+    children = [ c for c in plugin_children.values() if c.returncode == None ]
+    
+    if len( children ) == 0:
+        return
+    
+    for sig in ( signal.SIGTERM, getattr( signal, "SIGKILL", None ) ):
+        for child in children:
+            try:
+                if sys.platform.startswith( "win" ):
+                    # delegates started by ImageMagick are not reached here
+                    child.kill()
+                elif child.returncode == None:
+                    os.killpg( child.pid, sig )
+            except OSError:
+                pass
+        
+        if sig == None or sys.platform.startswith( "win" ):
+            break
+        
+        # SIGTERM lets ImageMagick remove its own pixel cache files
+        deadline = time.time() + 0.5
+        
+        while time.time() < deadline and [ c for c in children if c.poll() == None ]:
+            time.sleep( 0.02 )
 
-    if idx == -1:
-        return plugin_resize_filters.resize_filters
-    else:
-        f = plugin_resize_filters.resize_filters[idx]
-        plugin_setcfgtag( "default-filter", f )
+#----------------------------------------------------------------------------------
 
-        return f
+# Also run from a signal handler, so it only kills the children and
+# removes the temp files.  The config is not written here as the handler
+# may have interrupted plugin_flushconfig holding the lock, a cancelled
+# run just loses its settings.
+
+def plugin_cleanup():
+
+    plugin_killchildren()
+    
+    for fname in list( plugin_tempfiles ):
+        try:
+            plugin_tidyup( fname )
+        except OSError:
+            pass
 
 #----------------------------------------------------------------------------------
 
-def plugin_color_spaces( idx ):
+def plugin_cancelled( signum, frame ):
 
-    if not hasattr( plugin_color_spaces, "colorspaces"):
-        # initialize
-        cspaces = plugin_silentcommand( "mogrify", "-list colorspace" )
-        if cspaces != None:
-            plugin_color_spaces.colorspaces = cspaces.split("\n")
-        else:
-            # fallback in case we could not get the list from mogrify
-            plugin_color_spaces.colorspaces = [ "RGB", "HSV", "Lab" ]
-
-    if idx == -1:
-        return plugin_color_spaces.colorspaces
-    else:
-        f = plugin_color_spaces.colorspaces[idx]
-
-        return f
-
-#----------------------------------------------------------------------------------
-
-def getstrokes( image, numpointswanted ):
-
-    vectors = pdb.gimp_image_get_active_vectors(image)
-    
-    nstrokes, strokes = pdb.gimp_vectors_get_strokes(vectors)
-    
-    if nstrokes == 0:
-        # must be at least one stroke or we have no points
-        gimp.message( "No strokes found" )
-        return None
-    
-    stoke_type, n_points, p, closed = pdb.gimp_vectors_stroke_get_points(vectors, strokes[0])
+    plugin_cleanup()
     
-    if n_points != 6*numpointswanted:
-        # Note that 2 (x,y) ordinate pairs becomes 6 values per ordinate pair
-        gimp.message( "Found " + str(n_points/6) + " points, need " + str(numpointswanted) )
-        return None
-        
-    return p
+    if sys.platform.startswith( "win" ):
+        os._exit( 1 )
     
+    # die the way the signal would have killed us
+    signal.signal( signum, signal.SIG_DFL )
+    os.kill( os.getpid(), signum )
+
 #----------------------------------------------------------------------------------
 
-def plugin_resize( image, drawable, size, filtertouse, src, dest ):
+# libgimp installs its own handlers when the plug-in starts, so ours are
+# installed when the first child is started rather than at import.
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
-    
-    if tempfilename == None:
+def plugin_catchsignals():
+
+    if getattr( plugin_catchsignals, "done", False ):
         return
     
-    width  = tempdrawable.width
-    height = tempdrawable.height
+    # only the main thread may set a signal handler
+    if threading.current_thread().name != "MainThread":
+        return
     
-    arg = "-filter " + plugin_resize_filters( filtertouse )
+    plugin_catchsignals.done = True
     
-    if height > width:
-        arg = arg + " -resize x" + str(size) + " "
-    else :
-        arg = arg + " -resize " + str(size) + " "
+    for name in ( "SIGTERM", "SIGHUP", "SIGINT" ):
+        if hasattr( signal, name ):
+            try:
+                signal.signal( getattr( signal, name ), plugin_cancelled )
+            except ( ValueError, RuntimeError ):
+                pass
     
-    plugin_setcfgtag( "default-resize", str(size) )
+    atexit.register( plugin_cleanup )
 
-    pdb.gimp_image_undo_group_start(image)
+#----------------------------------------------------------------------------------
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Resizing" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+# Removes temp files left by plug-ins which are no longer running
 
-    pdb.gimp_image_undo_group_end(image)
+def plugin_sweeptemp( tempdir ):
 
+    if sys.platform.startswith( "win" ):
+        # os.kill can't ask whether a process is alive
+        return
     
-#----------------------------------------------------------------------------------
-
-def plugin_sketch( image, drawable, radius, sigma, angle, src, dest ):
-
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    if not hasattr( plugin_sweeptemp, "dirs" ):
+        plugin_sweeptemp.dirs = set()
     
-    if tempfilename == None:
+    if tempdir in plugin_sweeptemp.dirs:
+        return
+    
+    plugin_sweeptemp.dirs.add( tempdir )
+    
+    try:
+        names = os.listdir( tempdir )
+    except OSError:
         return
     
-    arg = "-sketch " + str(radius) + "x" + str(sigma) + "+" + str(angle)
+    for name in names:
+        m = re.match( r"mm_tool_imagemagick-(\d+)-", name )
+        
+        if m == None or int( m.group( 1 ) ) == os.getpid():
+            continue
+        
+        try:
+            os.kill( int( m.group( 1 ) ), 0 )
+            continue
+        except OSError, e:
+            if e.errno == errno.EPERM:
+                # alive but someone else's
+                continue
+        
+        try:
+            os.remove( os.path.join( tempdir, name ) )
+        except OSError:
+            pass
 
-    pdb.gimp_image_undo_group_start(image)
+#----------------------------------------------------------------------------------
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Sketching" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+# Starts argv, or returns None after saying why it could not.
 
-    pdb.gimp_image_undo_group_end(image)
+def plugin_spawn( argv ):
 
+    try:
+        return plugin_popen( argv )
+    except OSError, e:
+        plugin_message( "mm_tool_imagemagick could not run " + argv[0] + " : " + str( e ) )
+        return None
 
 #----------------------------------------------------------------------------------
 
-def plugin_charcoal( image, drawable, thickness, src, dest ):
+# Runs a command and returns what it printed
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+def plugin_runtext( argv ):
+
+    child = plugin_spawn( argv )
     
-    if tempfilename == None:
-        return
+    if child == None:
+        return None
     
-    arg = "-charcoal " + str(thickness)
-
-    pdb.gimp_image_undo_group_start(image)
+    stdoutdata, stderrdata = child.communicate()
+    
+    return stdoutdata
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Charcoal rendering" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_end(image)
+def plugin_listlines( text ):
 
+    if text == None:
+        return []
+    
+    return [ line.strip() for line in text.split( "\n" ) if line.strip() != "" ]
 
 #----------------------------------------------------------------------------------
 
-def plugin_sepia( image, drawable, threshold, src, dest ):
+def plugin_improbe( binary ):
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    # magick takes the same -list and -version options as mogrify
+    version = plugin_listlines( plugin_runtext( [ binary, "-version" ] ) )
     
-    if tempfilename == None:
-        return
+    info = { "version" : "", "quantum" : 16, "hdri" : False, "openmp" : False,
+             "threads" : 1, "delegates" : [] }
     
-    arg = "-sepia-tone " + str(threshold) + "%"
-
-    pdb.gimp_image_undo_group_start(image)
-
-    if plugin_docommand( "mogrify", arg, tempfilename, "Sepia tone rendering" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
+    for line in version:
+        if line.startswith( "Version:" ):
+            info["version"] = line
+            
+            q = re.search( r" Q(\d+)", line )
+            if q != None:
+                info["quantum"] = int( q.group( 1 ) )
+            
+            if "HDRI" in line:
+                info["hdri"] = True
         
-    plugin_tidyup( tempfilename )
-
-    pdb.gimp_image_undo_group_end(image)
-
+        elif line.startswith( "Features:" ):
+            info["hdri"] = info["hdri"] or "HDRI" in line.split()
+            info["openmp"] = "OpenMP" in line
+        
+        elif line.startswith( "Delegates" ):
+            info["delegates"] = line.split( ":", 1 )[1].split()
+    
+    threads = re.search( r"Thread:\s*(\d+)", plugin_runtext( [ binary, "-list", "resource" ] ) or "" )
+    
+    if threads != None:
+        info["threads"] = int( threads.group( 1 ) )
+    
+    info["filter"]     = plugin_listlines( plugin_runtext( [ binary, "-list", "filter" ] ) )
+    info["colorspace"] = plugin_listlines( plugin_runtext( [ binary, "-list", "colorspace" ] ) )
+    
+    return info
 
 #----------------------------------------------------------------------------------
 
-def plugin_perspective( image, drawable, force, filtertouse, src, dest ):
+# Returns what is known about ImageMagick, with binary None if it was
+# not found.
 
-    # get points for transform from image
+def plugin_iminfo():
+
+    if hasattr( plugin_iminfo, "info" ):
+        return plugin_iminfo.info
     
-    p = getstrokes( image, 4 )
+    binary, ismagick = plugin_imfind()
     
-    if p == None:
-        return
+    mtime = None
     
-    # if force flag is True then we map the points to the top and bottom of
-    # the time by projecting lines from the points we have.  This will produce
-    # a perspective correction suitable for focing building verticals to be
-    # vertical in the final image ( assuming you choose points on the
-    # correct lines in the image ).
+    if binary != None:
+        mtime = os.path.getmtime( binary )
     
-    q = []
+    cachename = os.path.join( plugin_configdir(), "mm_tool_imagemagick-im.json" )
     
-    if force == True:
-        # map the points to the top and bottom of the image
-        
-        w = drawable.width
-        h = drawable.height
-        
-        # it's possible the lines could be vertical
-        # which will error when we divide by zero
+    try:
+        f = open( cachename, "r" )
+        info = json.load( f )
+        f.close()
         
-        if p[6] == p[0]:
-            q.append( p[0] )
-            q.append( 0 )
-            q.append( p[0] )
-            q.append( h-1 )
-        else:
-            a = ( p[7] - p[1] ) / ( p[6] - p[0] )
-            b = p[7] - ( a * p[6] )
-            
-            q.append( -b/a )
-            q.append( 0 )
-            q.append( ( h-1-b ) / a )
-            q.append( h-1 )
+        if info["binary"] == binary and info["mtime"] == mtime and info["filter"] and info["colorspace"]:
+            # json gives unicode but GIMP and the commands want plain strings
+            for tag in ( "binary", "version" ):
+                info[tag] = str( info[tag] )
             
-        if p[18] == p[12]:
-            q.append( p[18] )
-            q.append( 0 )
-            q.append( p[18] )
-            q.append( h-1 )
-        else:
-            a = ( p[19] - p[13] ) / ( p[18] - p[12] )
-            b = p[19] - ( a * p[18] )
+            for tag in ( "filter", "colorspace", "delegates" ):
+                info[tag] = [ str( x ) for x in info[tag] ]
             
-            # note the code that follows expects the order to anti-clockwise
-            # so these are added in a different order
-            q.append( ( h-1-b ) / a )
-            q.append( h-1 )
-            q.append( -b/a )
-            q.append( 0 )
-        
+            plugin_iminfo.info = info
+            return info
+    except ( IOError, ValueError, KeyError, TypeError ):
+        pass
+    
+    if binary != None:
+        info = plugin_improbe( binary )
     else:
-        # just use the points we're given
-        q.append( p[0] )
-        q.append( p[1] )
-        q.append( p[6] )
-        q.append( p[7] )
-        q.append( p[12] )
-        q.append( p[13] )
-        q.append( p[18] )
-        q.append( p[19] )
+        info = { "version" : "", "quantum" : 16, "hdri" : False, "openmp" : False,
+                 "threads" : 1, "delegates" : [], "filter" : [], "colorspace" : [] }
     
-    # need to work out the box to map to
-    # we do this by using the middle two x and y ordinates of the
-    # given points.  We map to this.
+    info["binary"] = binary
+    info["mtime"] = mtime
+    info["magick"] = ismagick
     
-    # routine assume points were entered from top-left quadrant anti-clockwise
+    # a failed probe is not worth remembering
+    if binary != None and info["filter"] and info["colorspace"]:
+        try:
+            f = open( cachename, "w" )
+            json.dump( info, f, indent=1 )
+            f.close()
+        except IOError:
+            print "mm_tool_imagemagick could not write " + cachename
     
-    xa = sorted( [ q[0], q[2], q[4], q[6] ] )
-    ya = sorted( [ q[1], q[3], q[5], q[7] ] )
+    plugin_iminfo.info = info
     
-    # do the transformation
+    return info
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+#----------------------------------------------------------------------------------
+
+def plugin_commandpath( function ):
+
+    if not ( sys.platform.startswith( "linux" ) or sys.platform.startswith( "darwin" ) or sys.platform.startswith( "win" ) ):
+        # did not pick up OS from sys.platform
+        plugin_message( "OS was not identified by script : " + sys.platform )
+        return None
     
-    if tempfilename == None:
-        return
+    info = plugin_iminfo()
+    
+    if info["binary"] == None:
+        if sys.platform.startswith( "win" ):
+            return None
+        
+        # leave it to the system to say it is missing
+        return [ function ]
+    
+    if info["magick"]:
+        # convert's replacement in ImageMagick 7 is magick itself
+        if function == "convert":
+            return [ info["binary"] ]
+        
+        return [ info["binary"], function ]
     
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " -distort Perspective \""
-    arg = arg + str(q[0]) + "," + str(q[1]) + " " + str(xa[1]) + "," + str(ya[1]) + " "
-    arg = arg + str(q[2]) + "," + str(q[3]) + " " + str(xa[1]) + "," + str(ya[2]) + " "
-    arg = arg + str(q[4]) + "," + str(q[5]) + " " + str(xa[2]) + "," + str(ya[2]) + " "
-    arg = arg + str(q[6]) + "," + str(q[7]) + " " + str(xa[2]) + "," + str(ya[1]) + " "
-    arg = arg + "\""
+    return [ os.path.join( os.path.dirname( info["binary"] ), plugin_exe( function ) ) ]
 
-    pdb.gimp_image_undo_group_start(image)
+#----------------------------------------------------------------------------------
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Perspective Transform" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-    
-    plugin_tidyup( tempfilename )
+def plugin_message( text ):
 
-    pdb.gimp_image_undo_group_end(image)
+    if gimpfu_imported:
+        gimp.message( text )
+    else:
+        sys.stderr.write( text + "\n" )
 
 #----------------------------------------------------------------------------------
 
-def plugin_rotate( image, drawable, filtertouse , src, dest ):
+'''
+A child is waited for by a thread which drains both of its output pipes
+while it works, so it can never block on a full pipe, and which wakes the
+main thread as soon as the child is done.  On POSIX it writes a byte to a
+pipe the main thread selects on, on Windows select cannot wait on a pipe
+so an Event is used instead.  Meanwhile the main thread updates the
+progress bar every plugin_pulseinterval seconds, so a quick command
+returns without waiting for the next update.
+
+A child run with -monitor reports each stage of its work on stderr as
+lines like "resize image[name]: 12 of 99, 12% complete" which end in a
+carriage return.  These are parsed as they arrive and shown as the
+stage and its percentage, everything else on stderr is kept as errors.
+'''
 
-    # get points for transform from image
-    
-    p = getstrokes(image,2)
-    
-    if p == None:
-        return
-    
-    # calculate angle
+plugin_pulseinterval = 0.2
 
-    # note that y ordinates are opposite from what you expect
-    # in maths, as the top is zero and the bottom is positive
-    
-    y7 = image.height - 1 - p[7]
-    y1 = image.height - 1 - p[1]
+plugin_monitorline = re.compile( r"\s*(.*?)(\[.*\])?: (\d+) of (\d+), (\d+)% complete" )
+
+def plugin_monitor( f, errors, progress ):
+
+    pending = ""
     
-    if p[6] > p[0]:
-        angle0 = math.atan2( y7-y1, p[6]-p[0] )
-    else:
-        angle0 = math.atan2( y1-y7, p[0]-p[6] )
+    while True:
+        # whatever has arrived, a buffered read would wait for more
+        data = os.read( f.fileno(), 4096 )
+        
+        if data == "":
+            break
+        
+        lines = re.split( r"[\r\n]", pending + data )
+        pending = lines.pop()
+        
+        for line in lines:
+            m = plugin_monitorline.match( line )
+            
+            if m != None:
+                progress["stage"] = m.group( 1 )
+                progress["fraction"] = min( 1.0, int( m.group( 5 ) ) / 100.0 )
+            elif line.strip() != "":
+                errors.append( line + "\n" )
     
-    angle0 = 180.0 * angle0 / math.pi
+    if pending.strip() != "":
+        errors.append( pending )
+
+#----------------------------------------------------------------------------------
+
+def plugin_waitchild( child, title=None ):
+
+    output = []
+    errors = []
+    progress = {}
     
-    if angle0 > 0 :
-        if angle0 > 45:
-            angle = angle0 - 90
-        else:
-            angle = angle0
+    if sys.platform.startswith( "win" ):
+        done = threading.Event()
+        wakeread, wakewrite = None, None
     else:
-        absangle = math.fabs( angle0 )
+        done = None
+        wakeread, wakewrite = os.pipe()
     
-        if absangle > 45:
-            angle = 90 - absangle
+    def waiter():
+        try:
+            child.stdin.close()
+            
+            drainer = threading.Thread( target=plugin_drain, args=( child.stdout, output ) )
+            drainer.daemon = True
+            drainer.start()
+            
+            plugin_monitor( child.stderr, errors, progress )
+            
+            drainer.join()
+            child.wait()
+        finally:
+            if done != None:
+                done.set()
+            else:
+                os.write( wakewrite, "x" )
+    
+    thread = threading.Thread( target=waiter )
+    thread.daemon = True
+    thread.start()
+    
+    stage = None
+    
+    while True:
+        if done != None:
+            if done.wait( plugin_pulseinterval ):
+                break
         else:
-            angle = angle0
+            try:
+                if select.select( [ wakeread ], [], [], plugin_pulseinterval )[0]:
+                    break
+            except select.error:
+                # interrupted by a signal, just wait again
+                continue
+        
+        stage = plugin_showprogress( progress, title, stage )
     
-    # do the transformation
-
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    thread.join()
     
-    if tempfilename == None:
-        return
+    if wakeread != None:
+        os.close( wakeread )
+        os.close( wakewrite )
     
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " +distort SRT \"" + str(angle) + "\" "
+    return "".join( output ), "".join( errors )
 
-    pdb.gimp_image_undo_group_start(image)
-
-    if plugin_docommand( "mogrify", arg, tempfilename, "Rotation" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_end(image)
+# Shows what plugin_monitor has found so far on the progress bar and
+# returns the stage shown, which is passed back in the next time.
 
+def plugin_showprogress( progress, title, stage ):
 
-#----------------------------------------------------------------------------------
+    if "fraction" in progress:
+        if title != None and progress["stage"] != stage:
+            stage = progress["stage"]
+            pdb.gimp_progress_set_text( title + " : " + stage )
+        
+        pdb.gimp_progress_update( progress["fraction"] )
+    else:
+        pdb.gimp_progress_pulse()
+    
+    return stage
+
+#----------------------------------------------------------------------------------
+
+# Like child.communicate( data ) for a child run with -monitor, which
+# fills progress as it goes.  Returns stdout and whatever else came on
+# stderr.  May run in any thread, it does not talk to GIMP.
+
+def plugin_communicate( child, data, progress ):
+
+    output = []
+    errors = []
+    
+    def writer():
+        try:
+            child.stdin.write( data )
+            child.stdin.close()
+        except IOError:
+            # the child has exited early, stderr will tell us why
+            pass
+    
+    feeder = threading.Thread( target=writer )
+    feeder.daemon = True
+    feeder.start()
+    
+    drainer = threading.Thread( target=plugin_drain, args=( child.stdout, output ) )
+    drainer.daemon = True
+    drainer.start()
+    
+    plugin_monitor( child.stderr, errors, progress )
+    
+    feeder.join()
+    drainer.join()
+    child.wait()
+    
+    return "".join( output ), "".join( errors )
+
+#----------------------------------------------------------------------------------
+
+# Waits until a piped child starts to write its result, showing its
+# progress meanwhile.  convert reads all of its input before it writes
+# anything, so the work is done by then.  MS Windows can not select on
+# a pipe so there it just returns and the read waits instead.
+
+def plugin_waitoutput( child, progress, title ):
+
+    if sys.platform.startswith( "win" ):
+        return
+    
+    stage = None
+    
+    while True:
+        try:
+            if select.select( [ child.stdout ], [], [], plugin_pulseinterval )[0]:
+                break
+        except select.error:
+            # interrupted by a signal, just wait again
+            continue
+        
+        stage = plugin_showprogress( progress, title, stage )
+
+#----------------------------------------------------------------------------------
+
+# Returns the whole argument list run on a temp file and the name to give
+# ImageMagick for it, or None if a raw file has lost its sidecar.
+
+def plugin_commandarg( arg, tempfilename ):
+
+    if tempfilename.endswith( ".raw" ):
+        # raw has no header so the geometry comes from the sidecar and
+        # ImageMagick writes the new geometry back to it afterwards
+        geometry = plugin_readsidecar( tempfilename )
+        
+        if geometry == None:
+            return None
+        
+        width, height, rawdepth = geometry
+        
+        arg = plugin_argv( "-size", plugin_num( width ) + "x" + plugin_num( height ), "-depth", rawdepth, "-endian", "MSB", arg )
+        arg = plugin_argv( arg, "-write", "info:" + tempfilename + ".hdr" )
+        
+        return arg, "rgba:" + tempfilename
+    
+    return plugin_argv( arg, "-depth", plugin_interchange_depth(), "-compress", "None" ), tempfilename
+
+#----------------------------------------------------------------------------------
+
+def plugin_docommand( function, arg, tempfilename, title ):
+
+    cmdpath = plugin_commandpath( function )
+    
+    if cmdpath == None:
+        return False
+    
+    commandarg = plugin_commandarg( arg, tempfilename )
+    
+    if commandarg == None:
+        return False
+    
+    arg, target = commandarg
+    
+    # -monitor reports how far each stage has got on stderr
+    command = plugin_argv( cmdpath, "-monitor", arg, target )
+    
+    # Invoke mogrify.
+
+    pdb.gimp_progress_set_text( title )
+    pdb.gimp_progress_pulse()
+    
+    phase = plugin_phasestart()
+    
+    child = plugin_spawn( command )
+    
+    if child == None:
+        return False
+    
+    stdoutdata, stderrdata = plugin_waitchild( child, title )
+    
+    plugin_phaseend( "command", phase )
+
+##__devcode
+
+    print "+----------------------------------------------------------+"
+    print stdoutdata
+    print "+----------------------------------------------------------+"
+
+##__end_devcode
+
+    # a failed or cancelled run leaves a truncated or unchanged file which
+    # must not be loaded or cached
+    if child.returncode != 0:
+        plugin_message( "mm_tool_imagemagick " + function + " failed :\n\n" + stderrdata )
+        return False
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+# run a command which returns text but does no image processing
+
+def plugin_silentcommand( function, arg ):
+
+    cmdpath = plugin_commandpath( function )
+    
+    if cmdpath == None:
+        return None
+    
+    return plugin_runtext( plugin_argv( cmdpath, arg ) )
+
+#----------------------------------------------------------------------------------
+
+'''
+The pipe transport avoids the temp file altogether.  The source drawable
+is read in strips using a pixel region and written as raw pixels to the
+stdin of convert.  The processed image comes back on stdout as a PAM
+( which is raw pixels with a small text header giving the geometry, as
+many operations change the size of the image ) and is written straight
+into the destination layer.
+'''
+
+# ImageMagick raw formats indexed by drawable bytes per pixel
+
+plugin_rawmaps = { 1 : "gray", 3 : "rgb", 4 : "rgba" }
+
+# PAM tuple types indexed by drawable bytes per pixel
+
+plugin_tupltypes = { 1 : "GRAYSCALE", 2 : "GRAYSCALE_ALPHA", 3 : "RGB", 4 : "RGB_ALPHA" }
+
+#----------------------------------------------------------------------------------
+
+def plugin_usepipe( image, src, function ):
+
+    if plugin_getcfgtag( "transport" ) != "pipe":
+        return False
+    
+    # only single file operations can be streamed
+    if function != "mogrify":
+        return False
+    
+    if src == 1:
+        return plugin_canusepixels( image, image.active_drawable )
+    else:
+        return plugin_canusepixels( image, None )
+
+#----------------------------------------------------------------------------------
+
+# Pixels read from a pixel region are indices for indexed drawables and
+# results read back as pixels can't be put into an indexed image.
+
+def plugin_canusepixels( image, drawable ):
+
+    if image.base_type == INDEXED:
+        return False
+    
+    if drawable != None and drawable.is_indexed:
+        return False
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+def plugin_sourcesize( image, src ):
+
+    if src == 0:
+        return image.width, image.height
+    else:
+        drawable = image.active_drawable
+        return drawable.width, drawable.height
+
+#----------------------------------------------------------------------------------
+
+# Returns the drawable to read pixels from and a flag which is True
+# when it is a temporary layer the caller must delete.
+
+def plugin_sourcedrawable( image, src ):
+
+    if src == 0:
+        # Get the current visible
+        return pdb.gimp_layer_new_from_visible( image, image, "visible" ), True
+    else:
+        return image.active_drawable, False
+
+#----------------------------------------------------------------------------------
+
+def plugin_readstrips( drawable ):
+
+    width  = drawable.width
+    height = drawable.height
+    
+    rgn = drawable.get_pixel_rgn( 0, 0, width, height, False, False )
+    
+    step = gimp.tile_height()
+    
+    for y in range( 0, height, step ):
+        yield y, rgn[ 0:width, y:min( y+step, height ) ]
+
+#----------------------------------------------------------------------------------
+
+def plugin_drain( f, chunks ):
+
+    # used in a thread to stop a child blocking on a full pipe
+    while True:
+        data = f.read( 65536 )
+        if data == "":
+            break
+        chunks.append( data )
+
+#----------------------------------------------------------------------------------
+
+# Reads a PAM header and returns width, height, channels and bytes per
+# sample or None if the stream is not a PAM.
+
+def plugin_readpamheader( f ):
+
+    if f.readline().strip() != "P7":
+        return None
+    
+    hdr = {}
+    
+    while True:
+        line = f.readline()
+        
+        if line == "":
+            return None
+        
+        line = line.strip()
+        
+        if line == "ENDHDR":
+            break
+        
+        if line == "" or line.startswith( "#" ):
+            continue
+        
+        key, sep, val = line.partition( " " )
+        hdr[key] = val.strip()
+    
+    try:
+        width    = int( hdr["WIDTH"] )
+        height   = int( hdr["HEIGHT"] )
+        channels = int( hdr["DEPTH"] )
+        maxval   = int( hdr["MAXVAL"] )
+    except ( KeyError, ValueError ):
+        return None
+    
+    if maxval > 255:
+        return width, height, channels, 2
+    else:
+        return width, height, channels, 1
+
+#----------------------------------------------------------------------------------
+
+# Converts a strip of pixels between gray and RGB with or without alpha.
+# Extended slice assignment on a bytearray does the work at C speed.
+
+def plugin_convertpixels( data, fromch, toch ):
+
+    if fromch == toch:
+        return data
+    
+    npixels = len( data ) / fromch
+    
+    out = bytearray( npixels * toch )
+    
+    fromcolor = 1 if fromch < 3 else 3
+    tocolor   = 1 if toch < 3 else 3
+    
+    if fromcolor == tocolor:
+        for c in range( tocolor ):
+            out[c::toch] = data[c::fromch]
+    elif fromcolor == 1:
+        for c in range( tocolor ):
+            out[c::toch] = data[0::fromch]
+    else:
+        # RGB to gray only happens if ImageMagick ignored -type so the
+        # green channel is a reasonable stand in for the luminance
+        out[0::toch] = data[1::fromch]
+    
+    if toch == 2 or toch == 4:
+        if fromch == 2 or fromch == 4:
+            out[toch-1::toch] = data[fromch-1::fromch]
+        else:
+            out[toch-1::toch] = "\xff" * npixels
+    
+    return str( out )
+
+#----------------------------------------------------------------------------------
+
+def plugin_newlayer( image, dest, width, height, channels, name ):
+
+    if dest == 0:
+        if channels < 3:
+            newimage = gimp.Image( width, height, GRAY )
+        else:
+            newimage = gimp.Image( width, height, RGB )
+    else:
+        newimage = image
+    
+    # result layers always have alpha as most operations can create it
+    if newimage.base_type == GRAY:
+        layertype = GRAYA_IMAGE
+    else:
+        layertype = RGBA_IMAGE
+    
+    layer = gimp.Layer( newimage, name, width, height, layertype, 100, NORMAL_MODE )
+    
+    return layer, newimage
+
+#----------------------------------------------------------------------------------
+
+def plugin_placelayer( image, dest, layer, newimage ):
+
+    if dest == 0 :
+        # new image
+        newimage.add_layer( layer, 0 )
+        
+        # Get exif data
+        exifdata = image.parasite_find( "exif-data" )
+        
+        # Write exif data
+        if exifdata != None:  
+            newimage.parasite_attach( exifdata )
+        
+        # Write name
+        if image.filename != None:
+            newimage.filename = image.filename
+        
+        gimp.Display( newimage )
+        
+    elif dest == 1:
+        # Replace current layer
+        pos = pdb.gimp_image_get_item_position( image, image.active_layer )
+        
+        image.remove_layer( image.active_layer )
+        
+        image.add_layer( layer, pos )
+        
+    elif dest == 2:
+        # Add as a new layer in the opened image
+        image.add_layer( layer, 0 )
+    
+    gimp.displays_flush()
+
+#----------------------------------------------------------------------------------
+
+# Reads width x height pixels from f and writes them to a new layer
+# which is placed according to dest.
+
+def plugin_storepixels( image, dest, f, width, height, channels, samplebytes, name ):
+
+    layer, newimage = plugin_newlayer( image, dest, width, height, channels, name )
+    
+    rgn = layer.get_pixel_rgn( 0, 0, width, height, True, False )
+    
+    step = gimp.tile_height()
+    
+    rowbytes = width * channels * samplebytes
+    
+    for y in range( 0, height, step ):
+        rows = min( step, height-y )
+        
+        data = f.read( rows * rowbytes )
+        
+        if len( data ) != rows * rowbytes:
+            # short read, the child has failed part way through
+            if dest == 0:
+                gimp.delete( newimage )
+            else:
+                gimp.delete( layer )
+            return False
+        
+        if samplebytes == 2:
+            # samples are big endian so keep the most significant byte
+            data = data[0::2]
+        
+        rgn[ 0:width, y:y+rows ] = plugin_convertpixels( data, channels, layer.bpp )
+        
+        pdb.gimp_progress_update( float( y+rows ) / height )
+    
+    layer.flush()
+    layer.update( 0, 0, width, height )
+    
+    plugin_placelayer( image, dest, layer, newimage )
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+def plugin_widen( data ):
+
+    # 8 to 16 bits, b*257 is the exact scaling and is just b repeated
+    out = bytearray( 2 * len( data ) )
+    out[0::2] = data
+    out[1::2] = data
+    
+    return str( out )
+
+#----------------------------------------------------------------------------------
+
+# Writes the drawable to fname in the format given by its extension.
+# Raw files are always RGBA and get a sidecar header with the geometry.
+
+def plugin_writepixels( fname, drawable, depth ):
+
+    width  = drawable.width
+    height = drawable.height
+    bpp    = drawable.bpp
+    
+    geometry = str(width) + "x" + str(height)
+    
+    if fname.endswith( ".raw" ):
+        channels = 4
+        header = ""
+        
+        f = open( fname + ".hdr", "w" )
+        f.write( "RGBA " + geometry + " " + str(depth) + "-bit\n" )
+        f.close()
+        
+    elif fname.endswith( ".miff" ):
+        channels = bpp
+        
+        if bpp < 3:
+            colorspace = "Gray"
+        else:
+            colorspace = "sRGB"
+        
+        if bpp == 2 or bpp == 4:
+            matte = "True"
+        else:
+            matte = "False"
+        
+        header = "id=ImageMagick  version=1.0\nclass=DirectClass  colors=0  matte=" + matte + "\n"
+        header = header + "columns=" + str(width) + "  rows=" + str(height) + "  depth=" + str(depth) + "\n"
+        header = header + "colorspace=" + colorspace + "  compression=None  endian=MSB\n\f\n:\x1a"
+        
+    else:
+        channels = bpp
+        
+        header = "P7\nWIDTH " + str(width) + "\nHEIGHT " + str(height) + "\nDEPTH " + str(bpp)
+        header = header + "\nMAXVAL " + str( ( 1 << depth ) - 1 ) + "\nTUPLTYPE " + plugin_tupltypes[bpp] + "\nENDHDR\n"
+    
+    f = open( fname, "wb" )
+    
+    f.write( header )
+    
+    for y, strip in plugin_readstrips( drawable ):
+        strip = plugin_convertpixels( strip, bpp, channels )
+        
+        if depth == 16:
+            strip = plugin_widen( strip )
+        
+        f.write( strip )
+    
+    f.close()
+
+#----------------------------------------------------------------------------------
+
+# Returns width, height and depth from a raw sidecar.  This is either the
+# one we wrote or the info: line ImageMagick wrote after processing, and
+# both have the geometry and depth as separate words.
+
+def plugin_readsidecar( fname ):
+
+    f = open( fname + ".hdr", "r" )
+    info = " " + f.readline() + " "
+    f.close()
+    
+    size  = re.search( r"\s(\d+)x(\d+)\s", info )
+    depth = re.search( r"\s(\d+)-bit\s", info )
+    
+    if size == None or depth == None:
+        return None
+    
+    return int( size.group(1) ), int( size.group(2) ), int( depth.group(1) )
+
+#----------------------------------------------------------------------------------
+
+# Reads a MIFF header and returns width, height, channels and bytes per
+# sample or None if it is not an uncompressed DirectClass RGB or gray image.
+
+def plugin_readmiffheader( f ):
+
+    text = ""
+    
+    while not text.endswith( ":\x1a" ):
+        c = f.read( 1 )
+        if c == "":
+            return None
+        text = text + c
+    
+    hdr = {}
+    
+    for key, val in re.findall( r"([\w-]+)=(\{[^}]*\}|\S+)", text ):
+        hdr[key.lower()] = val.lower()
+    
+    if hdr.get( "class", "directclass" ) != "directclass":
+        return None
+    
+    if hdr.get( "compression", "none" ) not in ( "none", "undefined" ):
+        return None
+    
+    if hdr.get( "endian", "msb" ) != "msb":
+        return None
+    
+    # IM6 says matte, IM7 says alpha-trait
+    alpha = hdr.get( "matte" ) == "true" or hdr.get( "alpha-trait", "undefined" ) != "undefined"
+    
+    colorspace = hdr.get( "colorspace", "srgb" )
+    
+    if colorspace == "gray":
+        channels = 1
+    elif colorspace in ( "cmyk", "cmy" ):
+        return None
+    else:
+        channels = 3
+    
+    if alpha:
+        channels = channels + 1
+    
+    try:
+        width  = int( hdr["columns"] )
+        height = int( hdr["rows"] )
+        depth  = int( hdr.get( "depth", "8" ) )
+    except ( KeyError, ValueError ):
+        return None
+    
+    if depth == 16:
+        return width, height, channels, 2
+    elif depth == 8:
+        return width, height, channels, 1
+    
+    return None
+
+#----------------------------------------------------------------------------------
+
+# Reads a temp file written by plugin_writepixels ( and processed by
+# mogrify ) into the destination.
+
+def plugin_loadpixels( image, dest, fname ):
+
+    f = open( fname, "rb" )
+    
+    if fname.endswith( ".raw" ):
+        geometry = plugin_readsidecar( fname )
+        
+        if geometry != None:
+            width, height, depth = geometry
+            geometry = width, height, 4, depth / 8
+        
+    elif fname.endswith( ".miff" ):
+        geometry = plugin_readmiffheader( f )
+        
+    else:
+        geometry = plugin_readpamheader( f )
+    
+    result = False
+    
+    if geometry != None:
+        width, height, channels, samplebytes = geometry
+        result = plugin_storepixels( image, dest, f, width, height, channels, samplebytes, os.path.basename( fname ) )
+    
+    f.close()
+    
+    return result
+
+#----------------------------------------------------------------------------------
+
+# Returns the header to send before raw pixels from a drawable with
+# the given bytes per pixel and the convert input spec to read them.
+
+def plugin_rawinput( width, height, bpp ):
+
+    if bpp in plugin_rawmaps:
+        header = ""
+        inspec = [ "-size", str(width) + "x" + str(height), "-depth", "8", plugin_rawmaps[bpp] + ":-" ]
+    else:
+        # there is no raw map for gray with alpha so give it a PAM header
+        header = "P7\nWIDTH " + str(width) + "\nHEIGHT " + str(height) + "\nDEPTH 2\nMAXVAL 255\nTUPLTYPE GRAYSCALE_ALPHA\nENDHDR\n"
+        inspec = [ "pam:-" ]
+    
+    return header, inspec
+
+#----------------------------------------------------------------------------------
+
+def plugin_pamoutput( image, dest ):
+
+    # gray results are expanded when read back but RGB can't be reduced
+    # so make sure a gray image gets a gray result
+    if dest != 0 and image.base_type == GRAY:
+        return [ "-colorspace", "Gray", "-depth", "8", "pam:-" ]
+    else:
+        return [ "-depth", "8", "pam:-" ]
+
+#----------------------------------------------------------------------------------
+
+def plugin_pipecommand( image, src, dest, arg, title ):
+
+    drawable, istemp = plugin_sourcedrawable( image, src )
+    
+    return plugin_pipedrawable( image, dest, drawable, istemp, arg, title )
+
+#----------------------------------------------------------------------------------
+
+# Streams drawable through convert into the destination.  A temporary
+# drawable is deleted as soon as it has been sent.
+
+def plugin_pipedrawable( image, dest, drawable, istemp, arg, title ):
+
+    cmdpath = plugin_commandpath( "convert" )
+    
+    if cmdpath == None:
+        return False
+    
+    width  = drawable.width
+    height = drawable.height
+    
+    # nothing is written to disk but ImageMagick may spill its pixel cache
+    plugin_tempdir( width, height )
+    
+    header, inspec = plugin_rawinput( width, height, drawable.bpp )
+    
+    # -monitor reports how far each stage has got on stderr
+    command = plugin_argv( cmdpath, "-monitor", inspec, arg, plugin_pamoutput( image, dest ) )
+    
+    pdb.gimp_progress_set_text( title )
+    pdb.gimp_progress_pulse()
+    
+    key = plugin_cachekeydrawable( drawable, header, plugin_argv( inspec, arg, plugin_pamoutput( image, dest ) ) )
+    
+    if key != None:
+        cachename = plugin_tempname( "pam", width, height )
+        
+        if plugin_cachefetch( key, cachename ):
+            if istemp:
+                pdb.gimp_item_delete( drawable )
+            
+            f = open( cachename, "rb" )
+            
+            geometry = plugin_readpamheader( f )
+            
+            result = False
+            
+            if geometry != None:
+                w, h, channels, samplebytes = geometry
+                result = plugin_storepixels( image, dest, f, w, h, channels, samplebytes, title )
+            
+            f.close()
+            plugin_tidyup( cachename )
+            
+            return result
+    
+    child = plugin_spawn( command )
+    
+    if child == None:
+        if istemp:
+            pdb.gimp_item_delete( drawable )
+        
+        if key != None:
+            plugin_tidyup( cachename )
+        
+        return False
+    
+    errors = []
+    progress = {}
+    
+    drainer = threading.Thread( target=plugin_monitor, args=( child.stderr, errors, progress ) )
+    drainer.daemon = True
+    drainer.start()
+    
+    # convert reads all of its input before it writes any output, so
+    # we can feed stdin completely before reading stdout without any
+    # risk of the two pipes deadlocking.
+    
+    phase = plugin_phasestart()
+    
+    try:
+        child.stdin.write( header )
+        
+        for y, strip in plugin_readstrips( drawable ):
+            child.stdin.write( strip )
+            pdb.gimp_progress_pulse()
+        
+        child.stdin.close()
+    except IOError:
+        # the child has exited early, stderr will tell us why
+        pass
+    
+    if istemp:
+        pdb.gimp_item_delete( drawable )
+    
+    plugin_phaseend( "send", phase )
+    phase = plugin_phasestart()
+    
+    plugin_waitoutput( child, progress, title )
+    
+    result = False
+    
+    output = child.stdout
+    
+    if key != None:
+        # keep the output so it can go in the cache
+        output = open( cachename, "w+b" )
+        shutil.copyfileobj( child.stdout, output )
+        output.seek( 0 )
+    
+    geometry = plugin_readpamheader( output )
+    
+    if geometry != None:
+        w, h, channels, samplebytes = geometry
+        result = plugin_storepixels( image, dest, output, w, h, channels, samplebytes, title )
+    
+    child.stdout.close()
+    child.wait()
+    drainer.join()
+    
+    plugin_phaseend( "receive", phase )
+    
+    if key != None:
+        output.close()
+        
+        if result and child.returncode == 0:
+            plugin_cachestore( key, cachename )
+        
+        plugin_tidyup( cachename )
+    
+    if not result:
+        gimp.message( "mm_tool_imagemagick did not get an image back from convert :\n\n" + "".join( errors ) )
+    
+    return result
+
+#----------------------------------------------------------------------------------
+
+'''
+Tiled mode splits the source into tiles which overlap by a margin derived
+from the operation ( its filter radius or thickness ) and runs a convert
+for each tile, several at a time.  Only the interior of each processed
+tile is written to the destination, so for a local filter the result is
+the same as processing the whole image at once.  Operations which
+look at the whole image, such as sketch and charcoal which normalize
+their result, are not tiled at all.
+
+Only the main thread talks to GIMP.  The worker threads just drive the
+convert children, which is where the work is done.
+'''
+
+def plugin_usetiles( image, src, function, tiling, force=False ):
+
+    if tiling == None or function != "mogrify":
+        return False
+    
+    if plugin_getcfgtag( "tile-mode" ) != "on" and not force:
+        return False
+    
+    if src == 1 and not plugin_canusepixels( image, image.active_drawable ):
+        return False
+    elif not plugin_canusepixels( image, None ):
+        return False
+    
+    # not worth it unless there is more than one tile
+    width, height = plugin_sourcesize( image, src )
+    size = plugin_tilesize( tiling )
+    
+    return width > size or height > size
+
+#----------------------------------------------------------------------------------
+
+def plugin_tilesize( margin ):
+
+    size = plugin_getcfgtag( "tile-size" )
+    
+    if size == None:
+        size = 1024
+    else:
+        size = int( size )
+    
+    # keep the overlap small compared to the tile
+    return max( size, 8 * margin )
+
+#----------------------------------------------------------------------------------
+
+def plugin_tileworkers():
+
+    workers = plugin_getcfgtag( "tile-workers" )
+    
+    if workers != None:
+        return max( 1, int( workers ) )
+    
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+#----------------------------------------------------------------------------------
+
+# The half width of the kernel ImageMagick uses for a blur.  This is the
+# radius when it is given, otherwise it is found from sigma ( this is a
+# little wider than ImageMagick's own estimate for Q16 to be safe ).
+
+def plugin_blurmargin( radius, sigma ):
+
+    if radius > 0:
+        return int( math.ceil( radius ) )
+    
+    return int( math.ceil( 5.0 * sigma ) ) + 1
+
+#----------------------------------------------------------------------------------
+
+def plugin_tileworker( jobs, results ):
+
+    while True:
+        job = jobs.get()
+        
+        if job == None:
+            break
+        
+        index, command, data, progress = job
+        
+        # not plugin_spawn, only the main thread may talk to GIMP
+        try:
+            child = plugin_popen( command )
+        except OSError, e:
+            results.put( ( index, "", str( e ) ) )
+            continue
+        
+        stdoutdata, stderrdata = plugin_communicate( child, data, progress )
+        
+        results.put( ( index, stdoutdata, stderrdata ) )
+
+#----------------------------------------------------------------------------------
+
+def plugin_tiledcommand( image, src, dest, arg, title, margin ):
+
+    cmdpath = plugin_commandpath( "convert" )
+    
+    if cmdpath == None:
+        return False
+    
+    drawable, istemp = plugin_sourcedrawable( image, src )
+    
+    width  = drawable.width
+    height = drawable.height
+    bpp    = drawable.bpp
+    
+    size    = plugin_tilesize( margin )
+    workers = plugin_tileworkers()
+    
+    plugin_tempdir( size + 2*margin, workers * ( size + 2*margin ) )
+    
+    tiles = []
+    
+    for ty in range( 0, height, size ):
+        for tx in range( 0, width, size ):
+            tiles.append( ( tx, ty, min( size, width-tx ), min( size, height-ty ) ) )
+    
+    layer, newimage = plugin_newlayer( image, dest, width, height, 4, title )
+    outspec = plugin_pamoutput( image, dest )
+    
+    srcrgn = drawable.get_pixel_rgn( 0, 0, width, height, False, False )
+    dstrgn = layer.get_pixel_rgn( 0, 0, width, height, True, False )
+    
+    # ImageMagick's own threads would compete with the other tiles
+    arg = plugin_argv( "-limit", "thread", "1", arg )
+    
+    jobs    = Queue.Queue()
+    results = Queue.Queue()
+    
+    threads = []
+    
+    for i in range( workers ):
+        t = threading.Thread( target=plugin_tileworker, args=( jobs, results ) )
+        t.daemon = True
+        t.start()
+        threads.append( t )
+    
+    pdb.gimp_progress_set_text( title )
+    
+    windows = {}
+    running = {}
+    
+    submitted = 0
+    done = 0
+    result = True
+    errors = ""
+    
+    while done < len( tiles ):
+        # only read a few tiles ahead to bound the memory used
+        while submitted < len( tiles ) and submitted - done < 2 * workers:
+            tx, ty, tw, th = tiles[submitted]
+            
+            x0 = max( 0, tx - margin )
+            y0 = max( 0, ty - margin )
+            x1 = min( width, tx + tw + margin )
+            y1 = min( height, ty + th + margin )
+            
+            windows[submitted] = ( x0, y0, x1, y1 )
+            
+            header, inspec = plugin_rawinput( x1-x0, y1-y0, bpp )
+            
+            command = plugin_argv( cmdpath, "-monitor", inspec, arg, outspec )
+            
+            running[submitted] = {}
+            
+            jobs.put( ( submitted, command, header + srcrgn[ x0:x1, y0:y1 ], running[submitted] ) )
+            
+            submitted = submitted + 1
+        
+        try:
+            index, stdoutdata, stderrdata = results.get( True, plugin_pulseinterval )
+        except Queue.Empty:
+            # the tiles done and how far those running have got
+            fraction = sum( [ p.get( "fraction", 0.0 ) for p in running.values() ] )
+            pdb.gimp_progress_update( ( done + fraction ) / len( tiles ) )
+            continue
+        
+        running.pop( index )
+        
+        done = done + 1
+        
+        if not result:
+            # just wait for the tiles already running
+            continue
+        
+        tx, ty, tw, th = tiles[index]
+        x0, y0, x1, y1 = windows.pop( index )
+        
+        geometry = plugin_readpamheader( cStringIO.StringIO( stdoutdata ) )
+        
+        if geometry == None or geometry[0] != x1-x0 or geometry[1] != y1-y0:
+            result = False
+            errors = stderrdata
+            # stop reading more tiles, only those already sent come back
+            tiles = tiles[:submitted]
+            continue
+        
+        channels = geometry[2]
+        
+        rowbytes = ( x1-x0 ) * channels
+        offset = len( stdoutdata ) - ( y1-y0 ) * rowbytes + ( tx-x0 ) * channels
+        
+        rows = []
+        
+        for r in range( ty-y0, ty-y0+th ):
+            start = offset + r * rowbytes
+            rows.append( stdoutdata[ start:start + tw * channels ] )
+        
+        dstrgn[ tx:tx+tw, ty:ty+th ] = plugin_convertpixels( "".join( rows ), channels, layer.bpp )
+        
+        pdb.gimp_progress_update( float( done ) / len( tiles ) )
+    
+    for t in threads:
+        jobs.put( None )
+    
+    for t in threads:
+        t.join()
+    
+    if istemp:
+        pdb.gimp_item_delete( drawable )
+    
+    if not result:
+        gimp.message( "mm_tool_imagemagick did not get a tile back from convert :\n\n" + errors )
+        
+        if dest == 0:
+            gimp.delete( newimage )
+        else:
+            gimp.delete( layer )
+        
+        return False
+    
+    layer.flush()
+    layer.update( 0, 0, width, height )
+    plugin_placelayer( image, dest, layer, newimage )
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+'''
+Results are cached on disk keyed by a hash of the source pixels and the
+exact command, so running the same operation again on the same layer
+loads the earlier result without starting ImageMagick.  The cache is kept
+within "cache-size" MB ( 0 turns it off ) by removing the least recently
+used results first.  A hit touches the file, so its modification time is
+the time it was last used.
+'''
+
+def plugin_cachedir():
+
+    return os.path.join( plugin_configdir(), "mm_tool_imagemagick-cache" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_cachebudget():
+
+    size = plugin_getcfgtag( "cache-size" )
+    
+    try:
+        if size != None:
+            return int( float( size ) * 1024 * 1024 )
+    except ValueError:
+        pass
+    
+    return 256 * 1024 * 1024
+
+#----------------------------------------------------------------------------------
+
+# Returns the cache key for a source file and command, or None when the
+# cache is turned off.
+
+def plugin_cachekeyfile( fname, command ):
+
+    if plugin_cachebudget() <= 0:
+        return None
+    
+    h = hashlib.sha1()
+    
+    f = open( fname, "rb" )
+    
+    while True:
+        data = f.read( 1048576 )
+        if data == "":
+            break
+        h.update( data )
+    
+    f.close()
+    
+    # raw files keep their geometry in the sidecar
+    if os.path.exists( fname + ".hdr" ):
+        f = open( fname + ".hdr", "rb" )
+        h.update( f.read() )
+        f.close()
+    
+    h.update( "\0" + os.path.splitext( fname )[1] + "\0" + "\0".join( command ) )
+    
+    return h.hexdigest()
+
+#----------------------------------------------------------------------------------
+
+def plugin_cachekeydrawable( drawable, header, command ):
+
+    if plugin_cachebudget() <= 0:
+        return None
+    
+    h = hashlib.sha1( header )
+    
+    for y, strip in plugin_readstrips( drawable ):
+        h.update( strip )
+    
+    h.update( "\0" + "\0".join( command ) )
+    
+    return h.hexdigest()
+
+#----------------------------------------------------------------------------------
+
+# Copies a cached result to fname and returns True, or counts a miss.
+
+def plugin_cachefetch( key, fname ):
+
+    if key == None:
+        return False
+    
+    cached = os.path.join( plugin_cachedir(), key )
+    
+    try:
+        shutil.copyfile( cached, fname )
+        
+        if os.path.exists( cached + ".hdr" ):
+            shutil.copyfile( cached + ".hdr", fname + ".hdr" )
+        
+        os.utime( cached, None )
+    except ( IOError, OSError ):
+        plugin_countcfgtag( "cache-misses" )
+        return False
+    
+    plugin_countcfgtag( "cache-hits" )
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+def plugin_cachestore( key, fname ):
+
+    if key == None:
+        return
+    
+    cachedir = plugin_cachedir()
+    
+    try:
+        if not os.path.isdir( cachedir ):
+            os.makedirs( cachedir )
+        
+        cached = os.path.join( cachedir, key )
+        
+        if os.path.exists( fname + ".hdr" ):
+            shutil.copyfile( fname + ".hdr", cached + ".hdr" )
+        
+        # copy then rename so another GIMP never reads half a result
+        shutil.copyfile( fname, cached + ".part" )
+        
+        if os.path.exists( cached ):
+            os.remove( cached )
+        
+        os.rename( cached + ".part", cached )
+    except ( IOError, OSError ):
+        print "mm_tool_imagemagick could not store result in cache."
+        return
+    
+    plugin_cachetrim( plugin_cachebudget() )
+
+#----------------------------------------------------------------------------------
+
+def plugin_cacheusage():
+
+    cachedir = plugin_cachedir()
+    
+    if not os.path.isdir( cachedir ):
+        return []
+    
+    entries = []
+    
+    for name in os.listdir( cachedir ):
+        if name.endswith( ".hdr" ) or name.endswith( ".part" ):
+            continue
+        
+        fname = os.path.join( cachedir, name )
+        
+        try:
+            st = os.stat( fname )
+        except OSError:
+            continue
+        
+        entries.append( ( st.st_mtime, st.st_size, fname ) )
+    
+    return entries
+
+#----------------------------------------------------------------------------------
+
+def plugin_cachetrim( budget ):
+
+    entries = plugin_cacheusage()
+    
+    total = sum( [ e[1] for e in entries ] )
+    
+    # oldest use first
+    for mtime, size, fname in sorted( entries ):
+        if total <= budget:
+            break
+        
+        plugin_tidyup( fname )
+        
+        total = total - size
+
+#----------------------------------------------------------------------------------
+
+'''
+Each operation estimates how much memory ImageMagick will need from the
+size of the source and the options it uses, and passes explicit -limit
+values so that the pixel cache of a large job stays in memory rather
+than spilling to disk.  The policy comes from the "limit-memory",
+"limit-map", "limit-disk" and "limit-thread" tags.  Each one is either a
+value for -limit such as "2GiB" or "4", "auto" ( the default ), or
+"none" to leave ImageMagick's own default.  With auto, memory is allowed
+3/4 of the physical memory and map all of it, shared between the jobs
+running at once, while disk and thread are left alone.
+
+If the estimate is more than the physical memory the "memory-strategy"
+tag says what to do.  "warn" ( the default ) says so and carries on,
+"tile" runs the operation in tiles if it can be tiled and warns if not,
+and "abort" does not run the operation at all.
+'''
+
+# How many images of the source size ImageMagick holds at once for an
+# option, the source and the result are two.  An operation holds as
+# many as its hungriest option.
+
+plugin_memorycopies = { "-resize" : 2, "-distort" : 3, "+distort" : 3, "-fx" : 3,
+                        "-sketch" : 4, "-charcoal" : 5, "-hald-clut" : 2, "-compose" : 3 }
+
+def plugin_memoryestimate( width, height, channels, arg ):
+
+    info = plugin_iminfo()
+    
+    if info["hdri"]:
+        samplebytes = 4
+    else:
+        samplebytes = max( 1, info["quantum"] / 8 )
+    
+    if not info["magick"]:
+        # ImageMagick 6 keeps four samples per pixel whatever the image
+        channels = 4
+    
+    copies = max( [ 2 ] + [ plugin_memorycopies.get( a, 2 ) for a in arg ] )
+    
+    return width * height * channels * samplebytes * copies
+
+#----------------------------------------------------------------------------------
+
+# The -limit options for the policy, share is how many jobs run at once
+
+def plugin_limitargs( share=1 ):
+
+    physical = plugin_physicalmemory()
+    
+    args = []
+    
+    for resource in ( "memory", "map", "disk", "thread" ):
+        value = plugin_getcfgtag( "limit-" + resource )
+        
+        if value == None or value == "auto":
+            value = None
+            
+            if physical != None and resource == "memory":
+                value = str( physical * 3 / 4 / max( 1, share ) )
+            elif physical != None and resource == "map":
+                value = str( physical / max( 1, share ) )
+        elif value == "none":
+            value = None
+        
+        if value != None:
+            args.extend( [ "-limit", resource, value ] )
+    
+    return args
+
+#----------------------------------------------------------------------------------
+
+# Checks the estimate against the physical memory and returns "run",
+# "tile" or None if the operation should not be run.
+
+def plugin_memorycheck( image, src, function, arg, title, tiling ):
+
+    physical = plugin_physicalmemory()
+    
+    if physical == None:
+        return "run"
+    
+    width, height = plugin_sourcesize( image, src )
+    
+    if src == 1:
+        channels = image.active_drawable.bpp
+    else:
+        channels = 4
+    
+    estimate = plugin_memoryestimate( width, height, channels, arg )
+    
+    if estimate <= physical:
+        return "run"
+    
+    strategy = plugin_getcfgtag( "memory-strategy" )
+    
+    need = title + " needs about " + str( estimate / 1048576 ) + " MB but there is only " + str( physical / 1048576 ) + " MB of memory"
+    
+    if strategy == "abort":
+        plugin_message( need + ", so it has not been run." )
+        return None
+    
+    if strategy == "tile" and plugin_usetiles( image, src, function, tiling, True ):
+        return "tile"
+    
+    plugin_message( need + ".  ImageMagick will use a disk cache which will be slow." )
+    
+    return "run"
+
+#----------------------------------------------------------------------------------
+
+'''
+With "timing-log" on, every operation appends a JSON line to
+mm_tool_imagemagick-timing.jsonl in the GIMP directory.  The line gives the
+operation, its arguments, the source size and the wall and CPU time of
+each phase it went through ( copy, save, command, load, insert, send,
+receive, tiles, cache, numpy, lut ) as well as the total.  CPU time
+includes ImageMagick once it has been waited for.  A phase which happens
+more than once, such as a save, is added up.  Only the main thread
+records phases.
+'''
+
+plugin_timing = None
+
+def plugin_clock():
+
+    t = os.times()
+    
+    # our own CPU and that of the children we have waited for
+    return time.time(), t[0] + t[1] + t[2] + t[3]
+
+#----------------------------------------------------------------------------------
+
+# Starts a record unless timing is off or one is already running, and
+# says whether it did so the caller knows to end it.
+
+def plugin_timingstart( title, arg, width, height ):
+
+    global plugin_timing
+    
+    if plugin_timing != None or plugin_getcfgtag( "timing-log" ) != "on":
+        return False
+    
+    plugin_timing = { "time" : time.time(), "operation" : title, "arg" : plugin_argv( arg ),
+                      "width" : width, "height" : height,
+                      "transport" : plugin_getcfgtag( "transport" ) or "file",
+                      "phases" : {}, "start" : plugin_clock() }
+    
+    return True
+
+#----------------------------------------------------------------------------------
+
+def plugin_phasestart():
+
+    if plugin_timing == None:
+        return None
+    
+    return plugin_clock()
+
+#----------------------------------------------------------------------------------
+
+def plugin_phaseend( name, start ):
+
+    if start == None or plugin_timing == None:
+        return
+    
+    wall, cpu = plugin_clock()
+    
+    phase = plugin_timing["phases"].setdefault( name, { "wall" : 0.0, "cpu" : 0.0 } )
+    
+    phase["wall"] = phase["wall"] + wall - start[0]
+    phase["cpu"]  = phase["cpu"] + cpu - start[1]
+
+#----------------------------------------------------------------------------------
+
+def plugin_timingend( started ):
+
+    global plugin_timing
+    
+    if not started or plugin_timing == None:
+        return
+    
+    record = plugin_timing
+    plugin_timing = None
+    
+    wall, cpu = plugin_clock()
+    start = record.pop( "start" )
+    
+    record["total"] = { "wall" : wall - start[0], "cpu" : cpu - start[1] }
+    
+    for phase in record["phases"].values() + [ record["total"] ]:
+        phase["wall"] = round( phase["wall"], 6 )
+        phase["cpu"]  = round( phase["cpu"], 6 )
+    
+    logname = os.path.join( plugin_configdir(), "mm_tool_imagemagick-timing.jsonl" )
+    
+    try:
+        # one write per line so records from several GIMPs don't mix
+        f = open( logname, "a" )
+        f.write( json.dumps( record ) + "\n" )
+        f.close()
+    except IOError:
+        print "mm_tool_imagemagick could not write " + logname
+
+#----------------------------------------------------------------------------------
+
+# Runs a single mogrify style operation from the source to the
+# destination using whichever transport is configured.  Operations which
+# can be tiled pass tiling as the margin their tiles must overlap by.
+
+def plugin_runoperation( image, src, dest, function, arg, title, tiling=None ):
+
+    width, height = plugin_sourcesize( image, src )
+    
+    started = plugin_timingstart( title, arg, width, height )
+    
+    try:
+        plugin_dooperation( image, src, dest, function, arg, title, tiling )
+    finally:
+        plugin_timingend( started )
+
+#----------------------------------------------------------------------------------
+
+def plugin_dooperation( image, src, dest, function, arg, title, tiling ):
+
+    check = plugin_memorycheck( image, src, function, arg, title, tiling )
+    
+    if check == None:
+        return
+    
+    if check == "tile" or plugin_usetiles( image, src, function, tiling ):
+        pdb.gimp_image_undo_group_start(image)
+        
+        phase = plugin_phasestart()
+        plugin_tiledcommand( image, src, dest, arg, title, tiling )
+        plugin_phaseend( "tiles", phase )
+        
+        pdb.gimp_image_undo_group_end(image)
+        return
+    
+    # tiles are small and set their own thread limit
+    arg = plugin_argv( plugin_limitargs(), arg )
+    
+    if plugin_usepipe( image, src, function ):
+        pdb.gimp_image_undo_group_start(image)
+        
+        plugin_pipecommand( image, src, dest, arg, title )
+        
+        pdb.gimp_image_undo_group_end(image)
+        return
+    
+    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    
+    if tempfilename == None:
+        return
+    
+    pdb.gimp_image_undo_group_start(image)
+    
+    phase = plugin_phasestart()
+    
+    # the key is what plugin_docommand will run, less the temp file name
+    # which is different every time
+    commandarg = plugin_commandarg( arg, tempfilename )
+    key = None
+    
+    if commandarg != None:
+        command = [ a.replace( tempfilename, "" ) for a in plugin_argv( function, commandarg[0] ) ]
+        key = plugin_cachekeyfile( tempfilename, command )
+    
+    hit = plugin_cachefetch( key, tempfilename )
+    plugin_phaseend( "cache", phase )
+    
+    if hit:
+        plugin_saveresult( image, dest, tempfilename, tempimage )
+    
+    elif plugin_docommand( function, arg, tempfilename, title ) == True:
+        phase = plugin_phasestart()
+        plugin_cachestore( key, tempfilename )
+        plugin_phaseend( "cache", phase )
+        
+        plugin_saveresult( image, dest, tempfilename, tempimage )
+        
+    plugin_tidyup( tempfilename )
+
+    pdb.gimp_image_undo_group_end(image)
+
+#----------------------------------------------------------------------------------
+
+def plugin_resize_filters( idx ):
+
+    if not hasattr( plugin_resize_filters, "resize_filters"):
+        # initialize
+        filters = plugin_iminfo()["filter"]
+        if filters:
+            plugin_resize_filters.resize_filters = filters
+        else:
+            # fallback in case we could not get the list from mogrify
+            plugin_resize_filters.resize_filters = [ "Lanczos",
+                "Catrom",
+                "Mitchell",
+                "Cubic",
+                "Point",
+                "Box",
+                "Triangle",
+                "Hermite",
+                "Gaussian",
+                "Quadratic",
+                "Blackman",
+                "Hanning",
+                "Kaiser",
+                "Hamming",
+                "Bartlett",
+                "Parzen",
+                "Welsh",
+                "Bohman"
+                ]
+
+    if idx == -1:
+        return plugin_resize_filters.resize_filters
+    else:
+        f = plugin_resize_filters.resize_filters[idx]
+        plugin_setcfgtag( "default-filter", f )
+
+        return f
+
+#----------------------------------------------------------------------------------
+
+def plugin_color_spaces( idx ):
+
+    if not hasattr( plugin_color_spaces, "colorspaces"):
+        # initialize
+        cspaces = plugin_iminfo()["colorspace"]
+        if cspaces:
+            plugin_color_spaces.colorspaces = cspaces
+        else:
+            # fallback in case we could not get the list from mogrify
+            plugin_color_spaces.colorspaces = [ "RGB", "HSV", "Lab" ]
+
+    if idx == -1:
+        return plugin_color_spaces.colorspaces
+    else:
+        f = plugin_color_spaces.colorspaces[idx]
+
+        return f
+
+#----------------------------------------------------------------------------------
+
+def getstrokes( image, numpointswanted ):
+
+    vectors = pdb.gimp_image_get_active_vectors(image)
+    
+    nstrokes, strokes = pdb.gimp_vectors_get_strokes(vectors)
+    
+    if nstrokes == 0:
+        # must be at least one stroke or we have no points
+        gimp.message( "No strokes found" )
+        return None
+    
+    stoke_type, n_points, p, closed = pdb.gimp_vectors_stroke_get_points(vectors, strokes[0])
+    
+    if n_points != 6*numpointswanted:
+        # Note that 2 (x,y) ordinate pairs becomes 6 values per ordinate pair
+        gimp.message( "Found " + str(n_points/6) + " points, need " + str(numpointswanted) )
+        return None
+        
+    return p
+    
+#----------------------------------------------------------------------------------
+
+# The lens corrections use every stroke of the path, each one drawn along
+# something that should be straight.  A stroke needs three points to say
+# anything about how it curves.
+
+def getlines( image ):
+
+    vectors = pdb.gimp_image_get_active_vectors(image)
+    
+    nstrokes, strokes = pdb.gimp_vectors_get_strokes(vectors)
+    
+    if nstrokes == 0:
+        gimp.message( "No strokes found" )
+        return None
+    
+    lines = []
+    
+    for stroke in strokes:
+        stoke_type, n_points, p, closed = pdb.gimp_vectors_stroke_get_points(vectors, stroke)
+        
+        if n_points < 6*3:
+            gimp.message( "Found a stroke with " + str(n_points/6) + " points, each needs at least 3" )
+            return None
+        
+        lines.append( p )
+    
+    return lines
+    
+#----------------------------------------------------------------------------------
+
+# The argument builders are shared by the plug-in operations and batch
+# mode.  Batch mode does not know the image size before it starts.
+
+def plugin_resize_arg( size, filtername, width=None, height=None ):
+
+    if width == None:
+        # fit the longer edge whichever it is
+        geometry = plugin_num( size ) + "x" + plugin_num( size )
+    elif height > width:
+        geometry = "x" + plugin_num( size )
+    else :
+        geometry = plugin_num( size )
+    
+    return plugin_argv( "-filter", filtername, "-resize", geometry )
+
+#----------------------------------------------------------------------------------
+
+def plugin_resize( image, drawable, size, filtertouse, src, dest ):
+
+    width, height = plugin_sourcesize( image, src )
+    
+    arg = plugin_resize_arg( size, plugin_resize_filters( filtertouse ), width, height )
+    
+    plugin_setcfgtag( "default-resize", str(size) )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Resizing" )
+
+    
+#----------------------------------------------------------------------------------
+
+def plugin_sketch_arg( radius, sigma, angle ):
+
+    return plugin_argv( "-sketch", plugin_num( radius ) + "x" + plugin_num( sigma ) + "+" + plugin_num( angle ) )
+
+#----------------------------------------------------------------------------------
+
+def plugin_sketch( image, drawable, radius, sigma, angle, src, dest ):
+
+    arg = plugin_sketch_arg( radius, sigma, angle )
+
+    # never tiled : the texture comes from random noise and is normalized
+    # over whatever convert is given, so each tile would get its own and
+    # the seams would show
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Sketching" )
+
+
+#----------------------------------------------------------------------------------
+
+def plugin_charcoal_arg( thickness ):
+
+    return plugin_argv( "-charcoal", thickness )
+
+#----------------------------------------------------------------------------------
+
+def plugin_charcoal( image, drawable, thickness, src, dest ):
+
+    arg = plugin_charcoal_arg( thickness )
+
+    # never tiled : charcoal normalizes over the whole image, and the steps
+    # before that differ between ImageMagick 6 and 7, so tiles done in parts
+    # could not be relied on to match
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Charcoal rendering" )
+
+
+#----------------------------------------------------------------------------------
+
+def plugin_sepia_arg( threshold ):
+
+    return plugin_argv( "-sepia-tone", plugin_num( threshold ) + "%" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_sepia( image, drawable, threshold, src, dest ):
+
+    arg = plugin_sepia_arg( threshold )
+    
+    if plugin_uselut():
+        plugin_lutoperation( image, src, dest, arg, "Sepia tone rendering" )
+        return
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Sepia tone rendering" )
+
+
+#----------------------------------------------------------------------------------
+
+def plugin_perspective_arg( image, drawable, force, filtername ):
+
+    # get points for transform from image
+    
+    p = getstrokes( image, 4 )
+    
+    if p == None:
+        return None
+    
+    # if force flag is True then we map the points to the top and bottom of
+    # the time by projecting lines from the points we have.  This will produce
+    # a perspective correction suitable for focing building verticals to be
+    # vertical in the final image ( assuming you choose points on the
+    # correct lines in the image ).
+    
+    q = []
+    
+    if force == True:
+        # map the points to the top and bottom of the image
+        
+        w = drawable.width
+        h = drawable.height
+        
+        # it's possible the lines could be vertical
+        # which will error when we divide by zero
+        
+        if p[6] == p[0]:
+            q.append( p[0] )
+            q.append( 0 )
+            q.append( p[0] )
+            q.append( h-1 )
+        else:
+            a = ( p[7] - p[1] ) / ( p[6] - p[0] )
+            b = p[7] - ( a * p[6] )
+            
+            q.append( -b/a )
+            q.append( 0 )
+            q.append( ( h-1-b ) / a )
+            q.append( h-1 )
+            
+        if p[18] == p[12]:
+            q.append( p[18] )
+            q.append( 0 )
+            q.append( p[18] )
+            q.append( h-1 )
+        else:
+            a = ( p[19] - p[13] ) / ( p[18] - p[12] )
+            b = p[19] - ( a * p[18] )
+            
+            # note the code that follows expects the order to anti-clockwise
+            # so these are added in a different order
+            q.append( ( h-1-b ) / a )
+            q.append( h-1 )
+            q.append( -b/a )
+            q.append( 0 )
+        
+    else:
+        # just use the points we're given
+        q.append( p[0] )
+        q.append( p[1] )
+        q.append( p[6] )
+        q.append( p[7] )
+        q.append( p[12] )
+        q.append( p[13] )
+        q.append( p[18] )
+        q.append( p[19] )
+    
+    # need to work out the box to map to
+    # we do this by using the middle two x and y ordinates of the
+    # given points.  We map to this.
+    
+    # routine assume points were entered from top-left quadrant anti-clockwise
+    
+    xa = sorted( [ q[0], q[2], q[4], q[6] ] )
+    ya = sorted( [ q[1], q[3], q[5], q[7] ] )
+    
+    # do the transformation
+
+    pairs = [ ( q[0], q[1] ), ( xa[1], ya[1] ),
+              ( q[2], q[3] ), ( xa[1], ya[2] ),
+              ( q[4], q[5] ), ( xa[2], ya[2] ),
+              ( q[6], q[7] ), ( xa[2], ya[1] ) ]
+    
+    points = " ".join( [ plugin_num( x ) + "," + plugin_num( y ) for x, y in pairs ] )
+
+    return plugin_argv( "-matte", "-virtual-pixel", "transparent", "-filter", filtername, "-distort", "Perspective", points )
+
+#----------------------------------------------------------------------------------
+
+def plugin_perspective( image, drawable, force, filtertouse, src, dest ):
+
+    arg = plugin_perspective_arg( image, drawable, force, plugin_resize_filters( filtertouse ) )
+    
+    if arg == None:
+        return
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Perspective Transform" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_rotate_arg( image, filtername ):
+
+    # get points for transform from image
+    
+    p = getstrokes(image,2)
+    
+    if p == None:
+        return None
+    
+    # calculate angle
+
+    # note that y ordinates are opposite from what you expect
+    # in maths, as the top is zero and the bottom is positive
+    
+    y7 = image.height - 1 - p[7]
+    y1 = image.height - 1 - p[1]
+    
+    if p[6] > p[0]:
+        angle0 = math.atan2( y7-y1, p[6]-p[0] )
+    else:
+        angle0 = math.atan2( y1-y7, p[0]-p[6] )
+    
+    angle0 = 180.0 * angle0 / math.pi
+    
+    if angle0 > 0 :
+        if angle0 > 45:
+            angle = angle0 - 90
+        else:
+            angle = angle0
+    else:
+        absangle = math.fabs( angle0 )
+    
+        if absangle > 45:
+            angle = 90 - absangle
+        else:
+            angle = angle0
+    
+    # do the transformation
+
+    return plugin_argv( "-matte", "-virtual-pixel", "transparent", "-filter", filtername, "+distort", "SRT", plugin_num( angle ) )
+
+#----------------------------------------------------------------------------------
+
+def plugin_rotate( image, drawable, filtertouse , src, dest ):
+
+    arg = plugin_rotate_arg( image, plugin_resize_filters( filtertouse ) )
+    
+    if arg == None:
+        return
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Rotation" )
+
+
+#----------------------------------------------------------------------------------
+
+def plugin_barrel_arg( coeffs, filtername, distortion="Barrel" ):
+
+    return plugin_argv( "-matte", "-virtual-pixel", "transparent", "-filter", filtername,
+                        "-distort", distortion, " ".join( [ plugin_num( x ) for x in coeffs ] ) )
+
+#----------------------------------------------------------------------------------
+
+##__devcode
+
+def plugin_lenscorrection( image, drawable, filtertouse , src, dest ):
+
+    if not plugin_importscipy():
+        gimp.message( "Lens correction needs scipy" )
+        return
+
+    # get points for transform from image
+    
+    lines = getlines( image )
+    
+    if lines == None:
+        return
+    
+    # solve the equation
+    #
+    # We wish to obtain values for the tansform R = r*( A*r*r*r + B*r*r + C*r*r + D )
+    #
+    # From logical considerations we get :
+    #
+    #   B = F*F + E*E - 2 - 2*A
+    #   C = 3 + A - F*F - 2*E*E
+    #   D = E*E
+    #
+    # And we fit to that equation
+    
+    # Note the guess values refer to A,E,F in that order, lc_solve
+    # adds a p and q for each line
+    #
+    coeffs = lc_solve( "Barrel", lc_fn2, lc_jac2, lc_barrel2, [ 0, 1, 1 ], image, lines )
+    
+    if coeffs == None:
+        return
+    
+    A, B, C, D = coeffs
+    
+    print "co-effs = ", A, B, C, D
+    
+    # C now contains the values we need for the ImageMagick barrel distortion correction
+    
+    # do the transformation
+
+    plugin_savelensprofile( image, [ A, B, C, D ], "Barrel" )
+    
+    arg = plugin_barrel_arg( [ A, B, C, D ], plugin_resize_filters( filtertouse ) )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Barrel" )
+
+#--------------------------
+
+def lc_fn( V, RSC ):
+    
+    ( A, G1, H1, p, q ) = V
+    ( R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ) = RSC
+    
+    B = G1*G1-2-2*A
+    
+    C = 3-A-H1*H1
+    
+    eq0 = A*( (q/(s0-p*c0))**4 ) + B*( (q/(s0-p*c0))**3 ) + C*( (q/(s0-p*c0))**2 ) + ( 1-(A+B+C) )*q/(s0-p*c0) - R0
+    eq1 = A*( (q/(s1-p*c1))**4 ) + B*( (q/(s1-p*c1))**3 ) + C*( (q/(s1-p*c1))**2 ) + ( 1-(A+B+C) )*q/(s1-p*c1) - R1
+    eq2 = A*( (q/(s2-p*c2))**4 ) + B*( (q/(s2-p*c2))**3 ) + C*( (q/(s2-p*c2))**2 ) + ( 1-(A+B+C) )*q/(s2-p*c2) - R2
+    eq3 = A*( (q/(s3-p*c3))**4 ) + B*( (q/(s3-p*c3))**3 ) + C*( (q/(s3-p*c3))**2 ) + ( 1-(A+B+C) )*q/(s3-p*c3) - R3
+    eq4 = A*( (q/(s4-p*c4))**4 ) + B*( (q/(s4-p*c4))**3 ) + C*( (q/(s4-p*c4))**2 ) + ( 1-(A+B+C) )*q/(s4-p*c4) - R4
+    '''
+    eq0 = A*(q**4) + B*(q**3)*(s0-p*c0) + C*(q**2)*((s0-p*c0)**2) + (1-(A+B+C))*q*((s0-p*c0)**3) - R0*((s0-p*c0)**4)
+    eq1 = A*(q**4) + B*(q**3)*(s1-p*c1) + C*(q**2)*((s1-p*c1)**2) + (1-(A+B+C))*q*((s1-p*c1)**3) - R1*((s1-p*c1)**4)
+    eq2 = A*(q**4) + B*(q**3)*(s2-p*c2) + C*(q**2)*((s2-p*c2)**2) + (1-(A+B+C))*q*((s2-p*c2)**3) - R2*((s2-p*c2)**4)
+    eq3 = A*(q**4) + B*(q**3)*(s3-p*c3) + C*(q**2)*((s3-p*c3)**2) + (1-(A+B+C))*q*((s3-p*c3)**3) - R3*((s3-p*c3)**4)
+    eq4 = A*(q**4) + B*(q**3)*(s4-p*c4) + C*(q**2)*((s4-p*c4)**2) + (1-(A+B+C))*q*((s4-p*c4)**3) - R4*((s4-p*c4)**4)
+    '''
+
+    return [ eq0, eq1, eq2, eq3, eq4 ]
+
+
+#--------------------------
+
+def lc_fn2( M, p, q, R, s, c ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = F*F + D - 2 - 2*A
+    C = 1 - A - B - D
+    
+    r = q/(s-p*c)
+    
+    return ( ( ( A*r + B )*r + C )*r + D )*r - R
+
+def lc_jac2( M, p, q, R, s, c ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = F*F + D - 2 - 2*A
+    C = 1 - A - B - D
+    
+    r, drdp, drdq = lc_line( p, q, s, c )
+    t = r - 1
+    dfdr = ( ( 4*A*r + 3*B )*r + 2*C )*r + D
+    
+    # B and C move with A, E and F as well
+    return ( [ r*r*t*t, 2*E*r*t*t, 2*F*r*r*t ], dfdr*drdp, dfdr*drdq )
+
+def lc_barrel2( M ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = F*F + D - 2 - 2*A
+    C = 1 - A - B - D
+    
+    return [ A, B, C, D ]
+
+##__end_devcode
+
+#--------------------------
+
+def plugin_lc_b( image, drawable, filtertouse , src, dest ):
+
+    '''
+    Try to correct lens distortion my matching three or more points
+    on each curve of the path to R = r*( (1-E+E)*r*r + E*E )
+    '''
+
+    if not plugin_importscipy():
+        gimp.message( "Lens correction needs scipy" )
+        return
+
+    # get points for transform from image
+    
+    lines = getlines( image )
+    
+    if lines == None:
+        return
+    
+    # solve the equation
+    
+    # start from no distortion, E = 1.  At E = 0 the model does not
+    # change with E at all and the solver stays there.
+    
+    coeffs = lc_solve( "Quadratic model", lc_fn_b, lc_jac_b, lc_barrel_b, [ 1.0 ], image, lines )
+    
+    if coeffs == None:
+        return
+    
+    # C now contains the values we need for the ImageMagick barrel distortion correction
+    
+    # do the transformation
+
+    plugin_savelensprofile( image, coeffs, "Quadratic model" )
+    
+    arg = plugin_barrel_arg( coeffs, plugin_resize_filters( filtertouse ) )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Barrel" )
+    
+#--------------------------
+
+def lc_fn_b( M, p, q, R, s, c ):
+    
+    ( E, ) = M
+    
+    D = E*E
+    
+    # fitting R = r*( (1-E*E)*r*r + E*E )
+    
+    r = q/(s-p*c)
+    
+    return ( (1-D)*r*r + D )*r - R
+
+def lc_jac_b( M, p, q, R, s, c ):
+    
+    ( E, ) = M
+    
+    D = E*E
+    
+    r, drdp, drdq = lc_line( p, q, s, c )
+    dfdr = 3*(1-D)*r*r + D
+    
+    return ( [ 2*E*r*( 1 - r*r ) ], dfdr*drdp, dfdr*drdq )
+
+def lc_barrel_b( M ):
+    
+    D = M[0]*M[0]
+    
+    return [ 0.0, 1.0 - D, 0.0, D ]
+
+
+#--------------------------
+
+def plugin_lc_c( image, drawable, filtertouse , src, dest ):
+
+    '''
+    Try to correct lens distorion by mapping three or more points
+    on each curve of the path to a line.
+    Use the model :  R = r*( C*r + 1 - C )
+    '''
+
+    if not plugin_importscipy():
+        gimp.message( "Lens correction needs scipy" )
+        return
+
+    # get points for transform from image
+    
+    lines = getlines( image )
+    
+    if lines == None:
+        return
+    
+    # solve the equation
+    
+    coeffs = lc_solve( "Linear model", lc_fn_c, lc_jac_c, lc_barrel_c, [ 0.0 ], image, lines )
+    
+    if coeffs == None:
+        return
+        
+    # C now contains the values we need for the ImageMagick barrel distortion correction
+    
+    # do the transformation
+
+    plugin_savelensprofile( image, coeffs, "Linear model" )
+    
+    arg = plugin_barrel_arg( coeffs, plugin_resize_filters( filtertouse ) )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Barrel" )
+    
+#--------------------------
+
+def lc_fn_c( M, p, q, R, s, c ):
+    
+    ( C, ) = M
+    
+    # fitting R = r*( C*r + 1 - C ), which leaves the residual a radius
+    # like the other models
+    
+    r = q/(s-p*c)
+    
+    return ( C*r + 1 - C )*r - R
+
+def lc_jac_c( M, p, q, R, s, c ):
+    
+    ( C, ) = M
+    
+    r, drdp, drdq = lc_line( p, q, s, c )
+    dfdr = 2*C*r + 1 - C
+    
+    return ( [ r*( r - 1 ) ], dfdr*drdp, dfdr*drdq )
+
+def lc_barrel_c( M ):
+    
+    return [ 0.0, 0.0, M[0], 1.0 - M[0] ]
+
+
+#--------------------------
+
+# The normalized radius, sine and cosine of each point about the middle
+# of the image, and the line it is on, as arrays so the models work on
+# any number of points.  A stroke steeper than 45 degrees is turned a
+# quarter so the slope p of its line stays small and a vertical one does
+# not divide by zero.  Only the angles change, the models see radii.
+# Steepness is measured to the anchor furthest from the first, as a
+# closed stroke ends where it starts, and a stroke with no length says
+# nothing about a line and is left out.
+
+def lc_points( image, lines ):
+
+    cx = image.width / 2.0
+    cy = image.height / 2.0
+    
+    norm = min( cx, cy )
+    
+    xs = []
+    ys = []
+    
+    for p in lines:
+        x = numpy.array( p[0::6], dtype=float ) - cx
+        y = numpy.array( p[1::6], dtype=float ) - cy
+        
+        far = numpy.argmax( numpy.hypot( x - x[0], y - y[0] ) )
+        
+        if x[far] == x[0] and y[far] == y[0]:
+            continue
+        
+        if abs( y[far] - y[0] ) > abs( x[far] - x[0] ):
+            x, y = y, -x
+        
+        xs.append( x )
+        ys.append( y )
+    
+    if not xs:
+        empty = numpy.zeros( 0 )
+        return ( empty, empty, empty, numpy.zeros( 0, dtype=int ) )
+    
+    x = numpy.concatenate( xs )
+    y = numpy.concatenate( ys )
+    R = numpy.hypot( x, y )
+    
+    line = numpy.concatenate( [ numpy.repeat( k, len( xs[k] ) ) for k in range( len( xs ) ) ] )
+    
+    return ( R / norm, y / R, x / R, line )
+
+#--------------------------
+
+# Every model maps the point at angle ( s, c ) to the line through it,
+# which is at radius r = q/( s - p*c ).  This gives r and how it moves
+# with p and q for the Jacobians.
+
+def lc_line( p, q, s, c ):
+
+    u = s-p*c
+    r = q/u
+    
+    return ( r, r*c/u, 1.0/u )
+
+#--------------------------
+
+# The unknowns V are the model's m parameters followed by p and q for
+# each line.  Each point takes the p and q of its own line, so the model
+# functions work the same for one line or many.
+#
+# A model's residual is a distance along the ray from the middle of the
+# image.  Times the sine of the angle the ray meets the line at it is
+# roughly the distance from the line, which is what a click is off by,
+# and a line passing near the middle no longer swamps the others.
+
+def lc_residuals( V, model, m, R, s, c, line ):
+
+    p = V[m::2][line]
+    q = V[m+1::2][line]
+    
+    w = ( s-p*c ) / numpy.hypot( 1, p )
+    
+    return model[0]( V[:m].tolist(), p, q, R, s, c ) * w
+
+#--------------------------
+
+# The Jacobian has a row per unknown.  A line's p and q only move the
+# residuals of its own points.
+
+def lc_jacobian( V, model, m, R, s, c, line ):
+
+    M = V[:m].tolist()
+    p = V[m::2][line]
+    q = V[m+1::2][line]
+    
+    h = numpy.hypot( 1, p )
+    w = ( s-p*c ) / h
+    dwdp = -( c + w*p/h ) / h
+    
+    f = model[0]( M, p, q, R, s, c )
+    cols, dfdp, dfdq = model[1]( M, p, q, R, s, c )
+    
+    n = numpy.arange( len( R ) )
+    
+    J = numpy.zeros( ( len( V ), len( R ) ) )
+    J[:m] = numpy.array( cols ) * w
+    J[ m + 2*line, n ] = dfdp*w + f*dwdp
+    J[ m + 2*line + 1, n ] = dfdq*w
+    
+    return J
+
+#--------------------------
+
+# The first guess for each line goes through the first anchor of its
+# stroke and the one furthest from it.  lc_points has turned the stroke
+# so that these differ most in x.
+
+def lc_guess( R, s, c, line ):
+
+    guess = []
+    
+    for k in numpy.unique( line ):
+        points = numpy.flatnonzero( line == k )
+        x = R[points]*c[points]
+        y = R[points]*s[points]
+        
+        far = numpy.argmax( numpy.hypot( x - x[0], y - y[0] ) )
+        
+        p0 = ( y[far] - y[0] ) / ( x[far] - x[0] )
+        q0 = y[0] - p0*x[0]
+        
+        guess.extend( [ p0, q0 ] )
+    
+    return guess
+
+#--------------------------
+
+# With as many points as unknowns, one line with just enough points, the
+# model goes through them all and fsolve finds it.  With more it is
+# fitted by least squares, with a loss that counts residuals of more than
+# a couple of pixels, a misplaced click, for less.  scipy before 0.17 only
+# has plain least squares.
+#
+# A job is one start of one solve, kept to plain values so it can go to
+# another process.  Returns the unknowns, whether they converged, the
+# cost that was minimized, the work done and the solver's message.
+
+def lc_solveone( job ):
+
+    V0, args, fscale = job
+    
+    R = args[2]
+    
+    if len( R ) == len( V0 ):
+        V, info, ier, msg = scopt.fsolve( lc_residuals, V0, args, fprime=lc_jacobian, col_deriv=True, full_output=True )
+        converged = ier == 1
+        cost = 0.5 * numpy.sum( info["fvec"]**2 )
+        nfev, njev = info["nfev"], info.get( "njev", 0 )
+    elif hasattr( scopt, "least_squares" ):
+        result = scopt.least_squares( lc_residuals, V0, lambda V, *a : lc_jacobian( V, *a ).T, args=args,
+                                      loss="soft_l1", f_scale=fscale )
+        V, msg = result.x, result.message
+        converged = result.status > 0
+        cost = result.cost
+        nfev, njev = result.nfev, result.njev or 0
+    else:
+        V, covx, info, msg, ier = scopt.leastsq( lc_residuals, V0, args, Dfun=lc_jacobian, col_deriv=True, full_output=True )
+        converged = ier in ( 1, 2, 3, 4 )
+        cost = 0.5 * numpy.sum( info["fvec"]**2 )
+        nfev, njev = info["nfev"], info.get( "njev", 0 )
+    
+    # a step into a pole can "converge" on nonsense
+    converged = converged and numpy.all( numpy.isfinite( V ) ) and numpy.isfinite( cost )
+    
+    return ( V, converged, cost, nfev, njev, " ".join( msg.split() ) )
+
+#--------------------------
+
+# The first start is the guess, the others are spread around it so that
+# a solve which wanders off from the guess is not the only one we have.
+# The spread is fixed so the same path always gives the same result.
+
+def lc_starts( V0, m, count ):
+
+    rng = numpy.random.RandomState( 1 )
+    
+    starts = [ numpy.array( V0, dtype=float ) ]
+    
+    for n in range( count - 1 ):
+        V = starts[0].copy()
+        V[:m] = V[:m] + rng.normal( 0, 0.1, m )
+        V[m::2] = V[m::2] + rng.normal( 0, 0.02, len( V[m::2] ) )
+        V[m+1::2] = V[m+1::2] * ( 1 + rng.normal( 0, 0.02, len( V[m+1::2] ) ) )
+        starts.append( V )
+    
+    return starts
+
+#--------------------------
+
+# The plug-in's signal handlers would clean up after the parent
+
+def lc_workerinit():
+
+    for signum in ( signal.SIGTERM, signal.SIGINT, signal.SIGHUP ):
+        signal.signal( signum, signal.SIG_DFL )
+
+#--------------------------
+
+# Starting worker processes costs more than a few small solves, so they
+# are only used when there is enough work, and never on MS Windows where
+# they would start another copy of GIMP's Python.
+
+plugin_lcparallel = 4000
+
+def lc_solvestarts( jobs ):
+
+    work = len( jobs ) * len( jobs[0][1][2] )
+    
+    try:
+        processes = min( len( jobs ), multiprocessing.cpu_count() )
+    except NotImplementedError:
+        processes = 1
+    
+    if sys.platform.startswith( "win" ) or processes < 2 or work < plugin_lcparallel:
+        return [ lc_solveone( job ) for job in jobs ]
+    
+    pool = None
+    
+    try:
+        pool = multiprocessing.Pool( processes, lc_workerinit )
+        results = pool.map( lc_solveone, jobs )
+        pool.close()
+        pool.join()
+    except Exception, e:
+        # anything the pool cannot do is done here instead
+        print "mm_tool_imagemagick solving in one process : " + str( e )
+        
+        if pool != None:
+            pool.terminate()
+        
+        results = [ lc_solveone( job ) for job in jobs ]
+    
+    return results
+
+#--------------------------
+
+# Whether the Barrel co-efficients could be a lens : the radius scale
+# A*r*r*r + B*r*r + C*r + D stays between a half and two out to the
+# corners.  A few points on a line through the middle fit almost anything.
+
+def lc_plausible( coeffs, image ):
+    
+    A, B, C, D = coeffs
+    
+    r = numpy.linspace( 0.0, math.hypot( image.width, image.height )/min( image.width, image.height ), 64 )
+    k = ( ( A*r + B )*r + C )*r + D
+    
+    return bool( numpy.all( numpy.isfinite( k ) ) and numpy.all( k >= 0.5 ) and numpy.all( k <= 2.0 ) )
+
+#--------------------------
+
+# Solves from several starts and keeps the converged, plausible solution
+# with the lowest cost, the earliest start on a tie.  A single stroke of
+# five points for the three parameter models has no points to spare, so
+# the fit follows every wobble of the path and is taken even when it is
+# not plausible, as it always was.  The one parameter models can only
+# bend a line one way and are always held to it.  Returns the Barrel
+# co-efficients, or None when no start will do so the caller does not
+# run ImageMagick on nonsense.
+
+def lc_solve( title, fn, jac, barrel, guess, image, lines ):
+
+    start = time.time()
+    
+    R, s, c, line = lc_points( image, lines )
+    
+    V0 = guess + lc_guess( R, s, c, line )
+    
+    if len( R ) < len( V0 ):
+        gimp.message( "Found " + str( len( R ) ) + " points on " + str( len( numpy.unique( line ) ) ) +
+                      " lines, need at least " + str( len( V0 ) ) )
+        return None
+    
+    m = len( guess )
+    args = ( ( fn, jac ), m, R, s, c, line )
+    norm = min( image.width, image.height ) / 2.0
+    
+    try:
+        count = max( 1, int( plugin_getcfgtag( "lens-starts" ) or 8 ) )
+    except ValueError:
+        count = 8
+    
+    results = lc_solvestarts( [ ( V, args, 2.0/norm ) for V in lc_starts( V0, m, count ) ] )
+    
+    converged = [ n for n in range( count ) if results[n][1] ]
+    plausible = [ n for n in converged if lc_plausible( barrel( results[n][0][:m] ), image ) ]
+    
+    if plausible or len( R ) > len( V0 ) or m == 1:
+        converged = plausible
+
+##__devcode
+
+    if converged and not plausible:
+        print title + " has no points to spare, using an implausible solution"
+
+##__end_devcode
+
+    if not converged:
+
+##__devcode
+
+        print title + " found no plausible solution, first start : " + results[0][5]
+
+##__end_devcode
+
+        gimp.message( title + " did not converge to a plausible correction from any of " + str( count ) +
+                      " starting points.  " +
+                      "Try more points or lines further from the middle of the image." )
+        return None
+    
+    # exact fits all cost next to nothing, within a hundredth of a pixel
+    # prefer the start nearest the guess
+    tol = 0.5 * len( R ) * ( 0.01/norm )**2
+    lowest = min( [ results[n][2] for n in converged ] )
+    best = min( [ n for n in converged if results[n][2] <= lowest + tol ] )
+    V = results[best][0]
+
+##__devcode
+
+    nfev = sum( [ r[3] for r in results ] )
+    njev = sum( [ r[4] for r in results ] )
+    
+    print title + " solved from " + str( len( R ) ) + " points with " + str( nfev ) + \
+          " evaluations and " + str( njev ) + " Jacobians in " + \
+          "%.2f" % ( 1000.0 * ( time.time() - start ) ) + " ms, " + str( len( converged ) ) + \
+          " of " + str( count ) + " starts converged, using start " + str( best + 1 ) + " : " + results[best][5]
+    
+    # how far each line is from straight, in pixels
+    e = lc_residuals( V, *args ) * norm
+    
+    for k in numpy.unique( line ):
+        ek = e[ line == k ]
+        print "    line %d : %d points, rms %.2f px, largest %.2f px" % \
+              ( k + 1, len( ek ), math.sqrt( numpy.mean( ek*ek ) ), numpy.max( numpy.abs( ek ) ) )
+
+##__end_devcode
+
+    return barrel( V[:m].tolist() )
+
+#-----------------------------------
+
+##__devcode
+
+def plugin_lenscorrection_inverse( image, drawable, filtertouse , src, dest ):
+
+    if not plugin_importscipy():
+        gimp.message( "Lens correction needs scipy" )
+        return
+
+    # get points for transform from image
+    
+    lines = getlines( image )
+    
+    if lines == None:
+        return
+    
+    # solve the equation
+    #
+    # We wish to obtain values for the transform R = r/( A*r*r*r + B*r*r + C*r*r + D )
+    #
+    # From logical considerations we get :
+    #
+    #   B = E*E - F*F - 2*A
+    #   C = 1 + A + F*F - 2*E*E
+    #   D = E*E
+    #
+    # And we fit to that equation
+    
+    # Note the guess values refer to A,E,F in that order, lc_solve
+    # adds a p and q for each line
+    #
+    coeffs = lc_solve( "Barrel inverse", lc_fninv, lc_jacinv, lc_barrelinv, [ 0, 1, 1 ], image, lines )
+    
+    if coeffs == None:
+        return
+    
+    A, B, C, D = coeffs
+    
+    print "co-effs = ", A, B, C, D
+    
+    # C now contains the values we need for the ImageMagick barrel distortion correction
+    
+    # do the transformation
+
+    arg = plugin_barrel_arg( [ A, B, C, D ], plugin_resize_filters( filtertouse ), "BarrelInverse" )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Barrel" )
+
+#--------------------------
+
+def lc_fninv( M, p, q, R, s, c ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = D - F*F - 2*A
+    C = 1 - A - B - D
+    
+    r = q/(s-p*c)
+    
+    return r/( ( ( A*r + B )*r + C )*r + D ) - R
+
+def lc_jacinv( M, p, q, R, s, c ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = D - F*F - 2*A
+    C = 1 - A - B - D
+    
+    r, drdp, drdq = lc_line( p, q, s, c )
+    t = r - 1
+    den = ( ( A*r + B )*r + C )*r + D
+    
+    # f = r/den so each parameter moves f by -r/den^2 times how it moves den
+    k = -r/( den*den )
+    dfdr = ( den - r*( ( 3*A*r + 2*B )*r + C ) )/( den*den )
+    
+    return ( [ k*r*t*t, k*2*E*t*t, -k*2*F*r*t ], dfdr*drdp, dfdr*drdq )
+
+def lc_barrelinv( M ):
+    
+    ( A, E, F ) = M
+    
+    D = E*E
+    B = D - F*F - 2*A
+    C = 1 - A - B - D
+    
+    return [ A, B, C, D ]
+
+#--------------------------
+
+##__end_devcode
+    
+#----------------------------------------------------------------------------------
+
+'''
+Lens profiles remember the Barrel coefficients fitted to a path under
+the camera, lens and focal length in the image's EXIF data.  They are
+kept in mm_tool_imagemagick-lensprofiles.json in the config directory as
+
+    { camera : { lens : { focal length : { "coeffs" : [ A, B, C, D ], ... } } } }
+
+so later photos from the same camera and lens are corrected with no path
+and no solver, in GIMP or in batch mode.  The camera is its make and
+model, as models are only unique within a make.  Between two focal
+lengths fitted with the same correction model the coefficients are
+interpolated.  When the two were fitted with different models, whose
+coefficients mean different things, the nearest is taken.  Outside
+them only a focal length within 10% of the nearest is taken, a zoom
+lens changes too much for more.  ImageMagick scales the coefficients to the image, so
+one profile serves every size with the same shape.
+'''
+
+plugin_exifnames = { 0x010F : "Make", 0x0110 : "Model", 0x8769 : "ExifIFD",
+                     0x920A : "FocalLength", 0xA434 : "LensModel" }
+
+#----------------------------------------------------------------------------------
+
+# Reads the tags we want from one IFD of the TIFF structured EXIF data
+# which starts at base in the file f.
+
+def plugin_exififd( f, base, order, offset, tags ):
+
+    f.seek( base + offset )
+    count = struct.unpack( order + "H", f.read( 2 ) )[0]
+    entries = f.read( 12 * count )
+    
+    for n in range( len( entries ) / 12 ):
+        tag, kind, number, value = struct.unpack( order + "HHI4s", entries[ 12*n : 12*n + 12 ] )
+        
+        # ascii, short, long and rational are all we need
+        size = { 2 : 1, 3 : 2, 4 : 4, 5 : 8 }.get( kind )
+        
+        if tag not in plugin_exifnames or size == None or number == 0:
+            continue
+        
+        if size * number > 4:
+            f.seek( base + struct.unpack( order + "I", value )[0] )
+            value = f.read( size * number )
+        
+        name = plugin_exifnames[tag]
+        
+        if kind == 2:
+            tags[name] = value[:number].split( "\0" )[0].strip().decode( "utf-8", "replace" )
+        elif kind == 3:
+            tags[name] = struct.unpack( order + "H", value[:2] )[0]
+        elif kind == 4:
+            tags[name] = struct.unpack( order + "I", value[:4] )[0]
+        else:
+            num, den = struct.unpack( order + "II", value[:8] )
+            if den != 0:
+                tags[name] = num / float( den )
+
+#----------------------------------------------------------------------------------
+
+def plugin_exiftags( f, base ):
+
+    tags = {}
+    
+    try:
+        f.seek( base )
+        head = f.read( 8 )
+        
+        if head[:2] == "II":
+            order = "<"
+        elif head[:2] == "MM":
+            order = ">"
+        else:
+            return tags
+        
+        plugin_exififd( f, base, order, struct.unpack( order + "I", head[4:8] )[0], tags )
+        
+        if "ExifIFD" in tags:
+            plugin_exififd( f, base, order, tags["ExifIFD"], tags )
+    except ( struct.error, IOError ):
+        # cut short or corrupt, keep what we have
+        pass
+    
+    return tags
+
+#----------------------------------------------------------------------------------
+
+# EXIF data straight from a file.  JPEG keeps it in an APP1 segment and
+# TIFF based raw files are TIFF structured themselves.  Only the parts
+# holding the tags are read.
+
+def plugin_fileexif( fname ):
+
+    try:
+        f = open( fname, "rb" )
+    except IOError:
+        return {}
+    
+    tags = {}
+    
+    try:
+        head = f.read( 4 )
+        
+        if head[:2] == "\xff\xd8":
+            pos = 2
+            
+            while True:
+                f.seek( pos )
+                marker = f.read( 4 )
+                
+                # stop at the end or the image data, EXIF comes before
+                if len( marker ) < 4 or marker[0] != "\xff" or marker[1] in ( "\xd9", "\xda" ):
+                    break
+                
+                if marker[1] == "\xe1" and f.read( 6 ) == "Exif\0\0":
+                    tags = plugin_exiftags( f, pos + 10 )
+                    break
+                
+                pos = pos + 2 + struct.unpack( ">H", marker[2:] )[0]
+        
+        elif head in ( "II*\0", "MM\0*" ):
+            tags = plugin_exiftags( f, 0 )
+    except IOError:
+        pass
+    
+    f.close()
+    
+    return tags
+
+#----------------------------------------------------------------------------------
+
+def plugin_imageexif( image ):
+
+    exifdata = image.parasite_find( "exif-data" )
+    
+    if exifdata != None:
+        data = exifdata.data
+        
+        if data.startswith( "Exif\0\0" ):
+            return plugin_exiftags( cStringIO.StringIO( data ), 6 )
+        
+        return plugin_exiftags( cStringIO.StringIO( data ), 0 )
+    
+    # GIMP 2.10 keeps it as metadata rather than a parasite
+    if image.filename != None:
+        return plugin_fileexif( image.filename )
+    
+    return {}
+
+#----------------------------------------------------------------------------------
+
+# The camera, lens and focal length, or None without a camera model or
+# focal length.  Compacts have no lens model and use "".  Many models
+# already start with the make and are not given it twice.
+
+def plugin_lenskey( tags ):
+
+    make   = tags.get( "Make", u"" )
+    camera = tags.get( "Model", u"" )
+    focal  = tags.get( "FocalLength" )
+    
+    if camera == u"" or not focal:
+        return None
+    
+    if make != u"" and not camera.lower().startswith( make.lower() ):
+        camera = make + u" " + camera
+    
+    return ( camera, tags.get( "LensModel", u"" ), float( focal ) )
+
+#----------------------------------------------------------------------------------
+
+def plugin_lensname( key ):
+
+    camera, lens, focal = key
+    
+    if lens == u"":
+        lens = u"its lens"
+    
+    return ( camera + u" with " + lens + u" at " + u"%g" % focal + u"mm" ).encode( "utf-8" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_lensprofilefile():
+
+    return os.path.join( plugin_configdir(), "mm_tool_imagemagick-lensprofiles.json" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_readlensprofiles():
+
+    try:
+        f = open( plugin_lensprofilefile(), "r" )
+        profiles = json.load( f )
+        f.close()
+    except ( IOError, ValueError ):
+        return {}
+    
+    return profiles
+
+#----------------------------------------------------------------------------------
+
+# Files the coefficients a path was fitted to, if the image says what
+# took it.  A later fit at the same focal length replaces an earlier one.
+
+def plugin_savelensprofile( image, coeffs, title ):
+
+    key = plugin_lenskey( plugin_imageexif( image ) )
+    
+    if key == None:
+        return
+    
+    camera, lens, focal = key
+    
+    fname = plugin_lensprofilefile()
+    
+    try:
+        lock = plugin_lockconfig( fname )
+    except IOError:
+        print "mm_tool_imagemagick could not write " + fname
+        return
+    
+    try:
+        # read again under the lock in case another GIMP added one
+        profiles = plugin_readlensprofiles()
+        
+        profiles.setdefault( camera, {} ).setdefault( lens, {} )[ plugin_num( focal ) ] = \
+            { "coeffs" : [ float( x ) for x in coeffs ], "model" : title,
+              "width" : image.width, "height" : image.height, "time" : time.time() }
+        
+        plugin_writeatomic( fname, json.dumps( profiles, indent=1, sort_keys=True ) + "\n" )
+        
+        print "mm_tool_imagemagick saved the lens profile for " + plugin_lensname( key )
+    except ( IOError, OSError ):
+        print "mm_tool_imagemagick could not write " + fname
+    finally:
+        plugin_unlockconfig( lock )
+
+#----------------------------------------------------------------------------------
+
+def plugin_lensprofile( key ):
+
+    camera, lens, focal = key
+    
+    entries = plugin_readlensprofiles().get( camera, {} ).get( lens, {} )
+    
+    fitted = sorted( [ ( float( f ), entry["coeffs"], entry.get( "model" ) ) for f, entry in entries.items() ] )
+    
+    if not fitted:
+        return None
+    
+    nearest, coeffs, model = min( fitted, key=lambda entry : abs( entry[0] - focal ) )
+    
+    for n in range( len( fitted ) - 1 ):
+        f0, c0, m0 = fitted[n]
+        f1, c1, m1 = fitted[n+1]
+        
+        if f0 <= focal <= f1:
+            if m0 != m1:
+                return coeffs
+            
+            t = ( focal - f0 ) / ( f1 - f0 )
+            return [ a + t*( b - a ) for a, b in zip( c0, c1 ) ]
+    
+    if abs( nearest - focal ) <= 0.1 * focal:
+        return coeffs
+    
+    return None
+
+#----------------------------------------------------------------------------------
+
+# Returns the arguments and None, or None and what is missing.
+
+def plugin_lensprofile_arg( tags, filtername ):
+
+    key = plugin_lenskey( tags )
+    
+    if key == None:
+        return ( None, "No camera model or focal length in the EXIF data" )
+    
+    coeffs = plugin_lensprofile( key )
+    
+    if coeffs == None:
+        return ( None, "No lens profile for " + plugin_lensname( key ) )
+    
+    return ( plugin_barrel_arg( coeffs, filtername ), None )
+
+#----------------------------------------------------------------------------------
+
+def plugin_applylensprofile( image, drawable, filtertouse, src, dest ):
+
+    arg, error = plugin_lensprofile_arg( plugin_imageexif( image ), plugin_resize_filters( filtertouse ) )
+    
+    if arg == None:
+        gimp.message( error )
+        return
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Lens profile" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_colorspace_arg( spacename ):
+
+    return plugin_argv( "-colorspace", spacename, "-set", "colorspace", "RGB" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_colorspaceconversion( image, drawable, spaceto, src, dest ):
+
+    arg = plugin_colorspace_arg( plugin_color_spaces(spaceto) )
+    
+    print "Color space = ", plugin_color_spaces(spaceto) 
+    
+    if plugin_uselut():
+        plugin_lutoperation( image, src, dest, arg, "Colorspace Conversion" )
+        return
+    
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Colorspace Conversion" )
+
+
+#----------------------------------------------------------------------------------
+
+'''
+When numpy is available the color distance and dot product operations
+are done here rather than with -fx, which ImageMagick interprets for
+every pixel.  The source is read in strips, each strip is worked out in
+one go as an array and written straight to the result layer, so there
+is no temp file and no subprocess.  The values are the same as the -fx
+expressions give.  Alpha is left as it was, as -fx leaves it.
+
+The LAB distance is the CIE 1976 difference between each pixel and the
+foreground color with both taken as sRGB, scaled so that the distance
+from black to white ( 100 ) is full intensity.  Without numpy the same
+distance is worked out by -fx on ImageMagick's own Lab.
+'''
+
+plugin_srgbtoxyz = [ [ 0.4124564, 0.3575761, 0.1804375 ],
+                     [ 0.2126729, 0.7151522, 0.0721750 ],
+                     [ 0.0193339, 0.1191920, 0.9503041 ] ]
+
+plugin_d65white = [ 0.95047, 1.0, 1.08883 ]
+
+#----------------------------------------------------------------------------------
+
+# rgb is an array of rows of r, g, b from 0 to 1
+
+def plugin_rgbtolab( rgb ):
+
+    lin = numpy.where( rgb <= 0.04045, rgb / 12.92, ( ( rgb + 0.055 ) / 1.055 ) ** 2.4 )
+    
+    xyz = numpy.dot( lin, numpy.array( plugin_srgbtoxyz ).T ) / numpy.array( plugin_d65white )
+    
+    f = numpy.where( xyz > 0.008856, numpy.maximum( xyz, 0.0 ) ** ( 1.0 / 3.0 ), 7.787 * xyz + 16.0 / 116.0 )
+    
+    lab = numpy.empty_like( f )
+    
+    lab[:,0] = 116.0 * f[:,1] - 16.0
+    lab[:,1] = 500.0 * ( f[:,0] - f[:,1] )
+    lab[:,2] = 200.0 * ( f[:,1] - f[:,2] )
+    
+    return lab
+
+#----------------------------------------------------------------------------------
+
+# Returns the result from 0 to 1 for each row of rgb
+
+def plugin_numpyvalues( function, rgb, fg ):
+
+    fg = numpy.array( [ float( fg[0] ), float( fg[1] ), float( fg[2] ) ] )
+    
+    if function == "dotproduct":
+        v = numpy.sqrt( numpy.dot( rgb, fg ) ) / 15.97
+    
+    elif function == "distance":
+        v = numpy.sqrt( ( ( rgb - fg / 255.0 ) ** 2 ).sum( 1 ) )
+    
+    else:
+        lab = plugin_rgbtolab( rgb ) - plugin_rgbtolab( fg.reshape( 1, 3 ) / 255.0 )
+        v = numpy.sqrt( ( lab ** 2 ).sum( 1 ) ) / 100.0
+    
+    return numpy.clip( v, 0.0, 1.0 )
+
+#----------------------------------------------------------------------------------
+
+def plugin_usenumpy( image, src ):
+
+    if not plugin_importnumpy():
+        return False
+    
+    if src == 1:
+        return plugin_canusepixels( image, image.active_drawable )
+    
+    return plugin_canusepixels( image, None )
+
+#----------------------------------------------------------------------------------
+
+def plugin_numpyoperation( image, src, dest, function, title ):
+
+    width, height = plugin_sourcesize( image, src )
+    
+    started = plugin_timingstart( title, [ function ], width, height )
+    
+    try:
+        plugin_donumpyoperation( image, src, dest, function, title )
+    finally:
+        plugin_timingend( started )
+
+#----------------------------------------------------------------------------------
+
+def plugin_donumpyoperation( image, src, dest, function, title ):
+
+    drawable, istemp = plugin_sourcedrawable( image, src )
+    
+    width  = drawable.width
+    height = drawable.height
+    bpp    = drawable.bpp
+    
+    fg = gimp.get_foreground()
+    
+    pdb.gimp_image_undo_group_start(image)
+    
+    pdb.gimp_progress_set_text( title )
+    
+    phase = plugin_phasestart()
+    
+    # the result is gray, a gray new image is enough to hold it
+    layer, newimage = plugin_newlayer( image, dest, width, height, 2, title )
+    
+    rgn = layer.get_pixel_rgn( 0, 0, width, height, True, False )
+    
+    for y, strip in plugin_readstrips( drawable ):
+        pixels = numpy.frombuffer( strip, dtype=numpy.uint8 ).reshape( -1, bpp )
+        
+        if bpp < 3:
+            rgb = numpy.repeat( pixels[:,0:1], 3, axis=1 ) / 255.0
+        else:
+            rgb = pixels[:,0:3] / 255.0
+        
+        out = numpy.empty( ( pixels.shape[0], 2 ), dtype=numpy.uint8 )
+        
+        out[:,0] = ( plugin_numpyvalues( function, rgb, fg ) * 255.0 + 0.5 ).astype( numpy.uint8 )
+        
+        if bpp == 2 or bpp == 4:
+            out[:,1] = pixels[:,bpp-1]
+        else:
+            out[:,1] = 255
+        
+        rows = pixels.shape[0] / width
+        
+        rgn[ 0:width, y:y+rows ] = plugin_convertpixels( out.tostring(), 2, layer.bpp )
+        
+        pdb.gimp_progress_update( float( y+rows ) / height )
+    
+    if istemp:
+        pdb.gimp_item_delete( drawable )
+    
+    plugin_phaseend( "numpy", phase )
+    phase = plugin_phasestart()
+    
+    layer.flush()
+    layer.update( 0, 0, width, height )
+    
+    plugin_placelayer( image, dest, layer, newimage )
+    
+    plugin_phaseend( "insert", phase )
+    
+    pdb.gimp_image_undo_group_end(image)
+
+#----------------------------------------------------------------------------------
+
+'''
+LUT mode ( "lut-mode" on ) speeds up operations which only map each
+color to another color, sepia and colorspace conversion.  ImageMagick
+runs the operation once on an identity HALD image, which holds every
+color of a cube sampled "lut-level" squared times along each edge, and
+the result is cached keyed by the argument and ImageMagick version.  The
+LUT is then applied to the source by trilinear lookup with numpy, or by
+one -hald-clut pass when numpy is not available.
+'''
+
+def plugin_uselut():
+
+    return plugin_getcfgtag( "lut-mode" ) == "on"
+
+#----------------------------------------------------------------------------------
+
+def plugin_lutlevel():
+
+    level = plugin_getcfgtag( "lut-level" )
+    
+    if level != None and level.isdigit():
+        # level 12 is already 144 samples per edge, 16 would need gigabytes
+        # as floats when the LUT is read back
+        return min( 12, max( 2, int( level ) ) )
+    
+    return 8
 
-##__devcode
+#----------------------------------------------------------------------------------
 
-def plugin_lenscorrection( image, drawable, filtertouse , src, dest ):
+def plugin_imversion():
 
-    # get points for transform from image
+    return plugin_iminfo()["version"]
+
+#----------------------------------------------------------------------------------
+
+# Returns the name of the LUT file for arg, making it if it is not
+# already in the cache, or None if it could not be made.
+
+def plugin_makelut( arg ):
+
+    level = plugin_lutlevel()
     
-    p = getstrokes(image,5)
+    key = hashlib.sha1( plugin_imversion() + "\0" + str(level) + "\0" + "\0".join( arg ) ).hexdigest()
     
-    if p == None:
-        return
+    lutdir = os.path.join( plugin_configdir(), "mm_tool_imagemagick-luts" )
     
-    # Note that radi are normalized (!)
+    lutname = os.path.join( lutdir, key + ".pam" )
     
-    cx = image.width / 2.0
-    cy = image.height / 2.0
+    if os.path.exists( lutname ):
+        return lutname
     
-    norm = cx
-    if cy < norm:
-        norm = cy
+    # another GIMP may make the directory at the same time
+    try:
+        os.makedirs( lutdir )
+    except OSError:
+        if not os.path.isdir( lutdir ):
+            return None
     
-    g = ( cx, cy, norm )
+    part = lutname + ".part"
     
-    R0, s0, c0 = lc_rsc( p, 0, g )
-    R1, s1, c1 = lc_rsc( p, 1, g )
-    R2, s2, c2 = lc_rsc( p, 2, g )
-    R3, s3, c3 = lc_rsc( p, 3, g )
-    R4, s4, c4 = lc_rsc( p, 4, g )
+    pdb.gimp_progress_set_text( "Making LUT" )
+    pdb.gimp_progress_pulse()
     
-    print R0, R1, R2, R3, R4
+    plugin_silentcommand( "convert", plugin_argv( "hald:" + str(level), arg, "-depth", "16", "pam:" + part ) )
     
-    # solve the equation
-    #
-    # We wish to obtain values for the tansform R = r*( A*r*r*r + B*r*r + C*r*r + D )
-    #
-    # From logical considerations we get :
-    #
-    #   B = F*F + E*E - 2 - 2*A
-    #   C = 3 + A - F*F - 2*E*E
-    #   D = E*E
-    #
-    # And we fit to that equation
+    if not os.path.exists( part ) or os.path.getsize( part ) == 0:
+        plugin_tidyup( part )
+        return None
     
-    # initial estimate for line we map to
+    if os.path.exists( lutname ):
+        os.remove( lutname )
     
-    p0 = ( R4*s4 - R0*s0 ) / ( R4*c4 - R0*c0 )
-    q0 = R0*s0 - p0*R0*c0
+    os.rename( part, lutname )
     
-    # Note the guess values refer to A,E,F,p,q in that order
-    #
-    guess = [ 0, 1, 1, p0, q0 ]
+    return lutname
+
+#----------------------------------------------------------------------------------
+
+# Reads a HALD LUT into an array indexed [ blue, green, red ] giving
+# red, green and blue from 0 to 255.  Red varies fastest in a HALD image.
+
+def plugin_readlut( lutname ):
+
+    f = open( lutname, "rb" )
     
-    # print guess
+    geometry = plugin_readpamheader( f )
     
-    t = [ R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ]
+    if geometry == None:
+        f.close()
+        return None
     
-    # V, covx, info, ier, msg = scopt.leastsq( lc_fn2, guess, t, full_output=True )
-    V, info, ier, msg = scopt.fsolve( lc_fn2, guess, t, full_output=True )
+    width, height, channels, samplebytes = geometry
     
-    D = V[1]*V[1]
-    A = V[0]
-    B = V[2]*V[2] + D - 2 - 2*A
-    C = 1 - A - B - D
+    if samplebytes == 2:
+        lut = numpy.fromfile( f, dtype=">u2", count=width*height*channels ) / 257.0
+    else:
+        lut = numpy.fromfile( f, dtype=numpy.uint8, count=width*height*channels ) * 1.0
     
-    print "co-effs = ", A, B, C, D
+    f.close()
     
-    print info['fvec']
-    print info['nfev']
+    lut = lut.reshape( -1, channels )
     
-    # C now contains the values we need for the ImageMagick barrel distortion correction
+    if channels < 3:
+        lut = numpy.repeat( lut[:,0:1], 3, axis=1 )
     
-    # do the transformation
+    cube = int( round( ( width * height ) ** ( 1.0 / 3.0 ) ) )
+    
+    return lut[:,0:3].reshape( cube, cube, cube, 3 )
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+#----------------------------------------------------------------------------------
+
+def plugin_lutlookup( lut, rgb ):
+
+    n = lut.shape[0] - 1
     
-    if tempfilename == None:
+    p = rgb * ( n / 255.0 )
+    
+    i = numpy.minimum( p.astype( numpy.int32 ), n-1 )
+    
+    f = p - i
+    
+    r0 = i[:,0]
+    g0 = i[:,1]
+    b0 = i[:,2]
+    
+    fr = f[:,0:1]
+    fg = f[:,1:2]
+    fb = f[:,2:3]
+    
+    c00 = lut[ b0, g0, r0 ] * ( 1 - fr ) + lut[ b0, g0, r0+1 ] * fr
+    c01 = lut[ b0, g0+1, r0 ] * ( 1 - fr ) + lut[ b0, g0+1, r0+1 ] * fr
+    c10 = lut[ b0+1, g0, r0 ] * ( 1 - fr ) + lut[ b0+1, g0, r0+1 ] * fr
+    c11 = lut[ b0+1, g0+1, r0 ] * ( 1 - fr ) + lut[ b0+1, g0+1, r0+1 ] * fr
+    
+    c0 = c00 * ( 1 - fg ) + c01 * fg
+    c1 = c10 * ( 1 - fg ) + c11 * fg
+    
+    return c0 * ( 1 - fb ) + c1 * fb
+
+#----------------------------------------------------------------------------------
+
+def plugin_lutoperation( image, src, dest, arg, title ):
+
+    width, height = plugin_sourcesize( image, src )
+    
+    started = plugin_timingstart( title, arg, width, height )
+    
+    try:
+        plugin_dolutoperation( image, src, dest, arg, title )
+    finally:
+        plugin_timingend( started )
+
+#----------------------------------------------------------------------------------
+
+def plugin_dolutoperation( image, src, dest, arg, title ):
+
+    phase = plugin_phasestart()
+    lutname = plugin_makelut( arg )
+    plugin_phaseend( "lut", phase )
+    
+    if lutname == None:
+        # let the operation report what is wrong with it the usual way
+        plugin_runoperation( image, src, dest, "mogrify", arg, title )
+        return
+    
+    if plugin_usenumpy( image, src ):
+        phase = plugin_phasestart()
+        plugin_lutapply( image, src, dest, plugin_readlut( lutname ), title )
+        plugin_phaseend( "numpy", phase )
         return
     
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " -distort Barrel"
-    arg = arg + " \""+ str(A) + " " + str(B) + " " + str(C) + " " + str(D) + "\" "
+    arg = [ lutname, "-hald-clut" ]
+    
+    pdb.gimp_image_undo_group_start(image)
+    
+    if plugin_usepipe( image, src, "mogrify" ):
+        plugin_pipecommand( image, src, dest, arg, title )
+    else:
+        # the LUT is a second input so the temp file must describe itself
+        tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src, "tiff" )
+        
+        if tempfilename != None:
+            if plugin_docommand( "convert", plugin_argv( tempfilename, arg ), tempfilename, title ) == True:
+                plugin_saveresult( image, dest, tempfilename, tempimage )
+            
+            plugin_tidyup( tempfilename )
+    
+    pdb.gimp_image_undo_group_end(image)
 
+#----------------------------------------------------------------------------------
+
+def plugin_lutapply( image, src, dest, lut, title ):
+
+    drawable, istemp = plugin_sourcedrawable( image, src )
+    
+    width  = drawable.width
+    height = drawable.height
+    bpp    = drawable.bpp
+    
     pdb.gimp_image_undo_group_start(image)
+    
+    pdb.gimp_progress_set_text( title )
+    
+    layer, newimage = plugin_newlayer( image, dest, width, height, 4, title )
+    
+    rgn = layer.get_pixel_rgn( 0, 0, width, height, True, False )
+    
+    for y, strip in plugin_readstrips( drawable ):
+        pixels = numpy.frombuffer( strip, dtype=numpy.uint8 ).reshape( -1, bpp )
+        
+        if bpp < 3:
+            rgb = numpy.repeat( pixels[:,0:1], 3, axis=1 ) * 1.0
+        else:
+            rgb = pixels[:,0:3] * 1.0
+        
+        out = numpy.empty( ( pixels.shape[0], 4 ), dtype=numpy.uint8 )
+        
+        out[:,0:3] = numpy.clip( plugin_lutlookup( lut, rgb ) + 0.5, 0, 255 ).astype( numpy.uint8 )
+        
+        if bpp == 2 or bpp == 4:
+            out[:,3] = pixels[:,bpp-1]
+        else:
+            out[:,3] = 255
+        
+        rows = pixels.shape[0] / width
+        
+        rgn[ 0:width, y:y+rows ] = plugin_convertpixels( out.tostring(), 4, layer.bpp )
+        
+        pdb.gimp_progress_update( float( y+rows ) / height )
+    
+    if istemp:
+        pdb.gimp_item_delete( drawable )
+    
+    layer.flush()
+    layer.update( 0, 0, width, height )
+    
+    plugin_placelayer( image, dest, layer, newimage )
+    
+    pdb.gimp_image_undo_group_end(image)
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Barrel" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
+#----------------------------------------------------------------------------------
+
+def plugin_colordotproduct_arg( fg ):
+
+    # use the -fx command to process the image
+    
+    return plugin_argv( "-fx", "(sqrt( u.r*" + plugin_num( fg[0] ) + " + u.g*" + plugin_num( fg[1] ) + "+ u.b*" + plugin_num( fg[2] ) + " ))/15.97" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_colordotproduct( image, drawable, src, dest ):
+
+    if plugin_usenumpy( image, src ):
+        plugin_numpyoperation( image, src, dest, "dotproduct", "Color Dot Product" )
+        return
+    
+    # get the current foreground color
+    
+    fg = gimp.get_foreground()
+    
+    arg = plugin_colordotproduct_arg( fg )
+    
+    # -fx here only looks at the pixel itself so tiles need no overlap
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Color Dot Product", 0 )
+
+
+#----------------------------------------------------------------------------------
+
+def plugin_colordistance_arg( fg ):
+
+    r = float(fg[0])/255.0
+    g = float(fg[1])/255.0
+    b = float(fg[2])/255.0
+    
+    # use the -fx command to process the image
+    
+    return plugin_argv( "-fx", "(sqrt( ( u.r-" + plugin_num( r ) + ")^2 + ( u.g-" + plugin_num( g ) + ")^2 + ( u.b-" + plugin_num( b ) + ")^2 ))" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_colordistance( image, drawable, src, dest ):
+
+    if plugin_usenumpy( image, src ):
+        plugin_numpyoperation( image, src, dest, "distance", "Color Distance" )
+        return
+    
+    # get the current foreground color
+    
+    fg = gimp.get_foreground()
+    
+    arg = plugin_colordistance_arg( fg )
+    
+    # -fx here only looks at the pixel itself so tiles need no overlap
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Color Distance", 0 )
+
+
+#----------------------------------------------------------------------------------
+
+# The CIE 1976 Lab of an 8 bit sRGB color, as plugin_rgbtolab does for
+# arrays but without numpy.
+
+def plugin_colortolab( fg ):
+
+    lin = []
+    
+    for c in fg[0:3]:
+        c = float( c ) / 255.0
         
-    plugin_tidyup( tempfilename )
+        if c <= 0.04045:
+            lin.append( c / 12.92 )
+        else:
+            lin.append( ( ( c + 0.055 ) / 1.055 ) ** 2.4 )
+    
+    f = []
+    
+    for i in range( 3 ):
+        v = sum( [ plugin_srgbtoxyz[i][j] * lin[j] for j in range( 3 ) ] ) / plugin_d65white[i]
+        
+        if v > 0.008856:
+            f.append( v ** ( 1.0 / 3.0 ) )
+        else:
+            f.append( 7.787 * v + 16.0 / 116.0 )
+    
+    return [ 116.0 * f[1] - 16.0, 500.0 * ( f[0] - f[1] ), 200.0 * ( f[1] - f[2] ) ]
 
-    pdb.gimp_image_undo_group_end(image)
+#----------------------------------------------------------------------------------
+
+def plugin_colordistance_lab_arg( fg ):
+
+    L, a, b = plugin_colortolab( fg )
+    
+    # ImageMagick keeps L/100 and a/255 + 0.5 and b/255 + 0.5.  Calling the
+    # result sRGB stops it being converted back, so -fx writes the distance
+    # as the plug-in's numpy code does, with 100 as full intensity.
     
-    print msg
+    return plugin_argv( "-colorspace", "Lab", "-set", "colorspace", "sRGB",
+                        "-fx", "min( 1, sqrt( ( 100*u.r-(" + plugin_num( L ) + ") )^2 + ( 255*u.g-127.5-(" + plugin_num( a ) +
+                        ") )^2 + ( 255*u.b-127.5-(" + plugin_num( b ) + ") )^2 )/100 )" )
 
-#--------------------------
+#----------------------------------------------------------------------------------
 
-def lc_fn( V, RSC ):
+def plugin_colordistance_lab( image, drawable, src, dest ):
+
+    if plugin_usenumpy( image, src ):
+        plugin_numpyoperation( image, src, dest, "lab", "Color Distance LAB" )
+        return
     
-    ( A, G1, H1, p, q ) = V
-    ( R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ) = RSC
+    # get the current foreground color
     
-    B = G1*G1-2-2*A
+    fg = gimp.get_foreground()
     
-    C = 3-A-H1*H1
+    arg = plugin_colordistance_lab_arg( fg )
     
-    eq0 = A*( (q/(s0-p*c0))**4 ) + B*( (q/(s0-p*c0))**3 ) + C*( (q/(s0-p*c0))**2 ) + ( 1-(A+B+C) )*q/(s0-p*c0) - R0
-    eq1 = A*( (q/(s1-p*c1))**4 ) + B*( (q/(s1-p*c1))**3 ) + C*( (q/(s1-p*c1))**2 ) + ( 1-(A+B+C) )*q/(s1-p*c1) - R1
-    eq2 = A*( (q/(s2-p*c2))**4 ) + B*( (q/(s2-p*c2))**3 ) + C*( (q/(s2-p*c2))**2 ) + ( 1-(A+B+C) )*q/(s2-p*c2) - R2
-    eq3 = A*( (q/(s3-p*c3))**4 ) + B*( (q/(s3-p*c3))**3 ) + C*( (q/(s3-p*c3))**2 ) + ( 1-(A+B+C) )*q/(s3-p*c3) - R3
-    eq4 = A*( (q/(s4-p*c4))**4 ) + B*( (q/(s4-p*c4))**3 ) + C*( (q/(s4-p*c4))**2 ) + ( 1-(A+B+C) )*q/(s4-p*c4) - R4
-    '''
-    eq0 = A*(q**4) + B*(q**3)*(s0-p*c0) + C*(q**2)*((s0-p*c0)**2) + (1-(A+B+C))*q*((s0-p*c0)**3) - R0*((s0-p*c0)**4)
-    eq1 = A*(q**4) + B*(q**3)*(s1-p*c1) + C*(q**2)*((s1-p*c1)**2) + (1-(A+B+C))*q*((s1-p*c1)**3) - R1*((s1-p*c1)**4)
-    eq2 = A*(q**4) + B*(q**3)*(s2-p*c2) + C*(q**2)*((s2-p*c2)**2) + (1-(A+B+C))*q*((s2-p*c2)**3) - R2*((s2-p*c2)**4)
-    eq3 = A*(q**4) + B*(q**3)*(s3-p*c3) + C*(q**2)*((s3-p*c3)**2) + (1-(A+B+C))*q*((s3-p*c3)**3) - R3*((s3-p*c3)**4)
-    eq4 = A*(q**4) + B*(q**3)*(s4-p*c4) + C*(q**2)*((s4-p*c4)**2) + (1-(A+B+C))*q*((s4-p*c4)**3) - R4*((s4-p*c4)**4)
-    '''
+    # -fx here only looks at the pixel itself so tiles need no overlap
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Color Distance LAB", 0 )
 
-    return [ eq0, eq1, eq2, eq3, eq4 ]
 
+#----------------------------------------------------------------------------------
+
+def plugin_usercommand_arg( text ):
 
-#--------------------------
+    # split the way a shell would, newlines are just spaces to shlex
+    if sys.platform.startswith( "win" ):
+        # keep the backslashes in Windows paths
+        text = text.replace( "\\", "\\\\" )
+    
+    try:
+        return shlex.split( text )
+    except ValueError:
+        # an unclosed quote, let ImageMagick complain about the words
+        return text.split()
+
+#----------------------------------------------------------------------------------
+
+def plugin_usercommand( image, drawable, src, dest, arg ):
+
+    arg = plugin_usercommand_arg( arg )
+
+    plugin_runoperation( image, src, dest, "mogrify", arg, "User Command" )
+
+#----------------------------------------------------------------------------------
+
+'''
+A pipeline is several operations done by one convert, so the image is
+exported, decoded, encoded and loaded back only once.  Steps are given
+one per line, or separated by ";", as the operation name followed by its
+values, for example :
+
+    resize 1200 Lanczos
+    rotate
+    sepia 80
+
+The steps are :
+
+    resize SIZE [FILTER]
+    sketch [RADIUS [SIGMA [ANGLE]]]
+    charcoal [THICKNESS]
+    sepia [THRESHOLD]
+    colorspace NAME
+    colordistance
+    colordotproduct
+    rotate [FILTER]                     ( from path )
+    perspective [force|points] [FILTER] ( from path )
+    command ANYTHING
+
+The path steps measure the path on the source image, so rotate cannot
+follow a perspective and perspective cannot follow any change of
+geometry.  Rotation only needs the angle, which a resize does not change.
+'''
+
+plugin_pipeline_geometry = ( "resize", "rotate", "perspective" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_pipeline_steps( text ):
+
+    steps = []
+    
+    for line in text.replace( ";", "\n" ).split( "\n" ):
+        line = line.strip()
+        
+        if line == "":
+            continue
+        
+        parts = line.split( None, 1 )
+        
+        if len( parts ) == 1:
+            steps.append( ( parts[0].lower(), "" ) )
+        else:
+            steps.append( ( parts[0].lower(), parts[1] ) )
+    
+    return steps
+
+#----------------------------------------------------------------------------------
+
+# Builds the convert arguments for all the steps.  Without an image, as
+# in batch mode, the steps needing a path or the foreground color are
+# refused.  Returns None after telling the user what is wrong.
+
+def plugin_pipeline_arg( text, image=None, drawable=None, size=None ):
+
+    steps = plugin_pipeline_steps( text )
+    
+    if len( steps ) == 0:
+        plugin_message( "Pipeline has no steps" )
+        return None
+    
+    width = None
+    height = None
+    
+    if size != None:
+        width, height = size
+    
+    defaultfilter = plugin_getcfgtag( "default-filter" )
+    
+    if defaultfilter == None:
+        defaultfilter = "Lanczos"
+    
+    args = []
+    done = []
+    
+    for name, rest in steps:
+        values = rest.split()
+        
+        try:
+            if name == "resize":
+                if len( values ) > 1:
+                    filtername = values[1]
+                else:
+                    filtername = defaultfilter
+                
+                size = int( values[0] )
+                
+                args.append( plugin_resize_arg( size, filtername, width, height ) )
+                
+                if width != None:
+                    # later resizes still need to know which edge is longer
+                    if height > width:
+                        width, height = int( round( width * size / float( height ) ) ), size
+                    else:
+                        width, height = size, int( round( height * size / float( width ) ) )
+            
+            elif name == "sketch":
+                v = [ float( x ) for x in values ] + [ 5.0, 1.0, 45 ][ len( values ): ]
+                args.append( plugin_sketch_arg( v[0], v[1], v[2] ) )
+            
+            elif name == "charcoal":
+                v = [ float( x ) for x in values ] + [ 5.0 ][ len( values ): ]
+                args.append( plugin_charcoal_arg( v[0] ) )
+            
+            elif name == "sepia":
+                v = [ float( x ) for x in values ] + [ 80 ][ len( values ): ]
+                args.append( plugin_sepia_arg( v[0] ) )
+            
+            elif name == "colorspace":
+                args.append( plugin_colorspace_arg( values[0] ) )
+            
+            elif name in ( "colordistance", "colordotproduct" ):
+                if image == None:
+                    plugin_message( "Pipeline step " + name + " needs the foreground color from GIMP" )
+                    return None
+                
+                if name == "colordistance":
+                    args.append( plugin_colordistance_arg( gimp.get_foreground() ) )
+                else:
+                    args.append( plugin_colordotproduct_arg( gimp.get_foreground() ) )
+            
+            elif name in ( "rotate", "perspective" ):
+                if image == None:
+                    plugin_message( "Pipeline step " + name + " needs a path in GIMP" )
+                    return None
+                
+                if name == "rotate" and "perspective" in done:
+                    plugin_message( "Pipeline step rotate cannot follow perspective" )
+                    return None
+                
+                if name == "perspective" and [ d for d in done if d in plugin_pipeline_geometry ]:
+                    plugin_message( "Pipeline step perspective must come before any resize or rotate" )
+                    return None
+                
+                force = True
+                
+                if name == "perspective" and len( values ) > 0 and values[0] in ( "force", "points" ):
+                    force = ( values[0] == "force" )
+                    values = values[1:]
+                
+                if len( values ) > 0:
+                    filtername = values[0]
+                else:
+                    filtername = defaultfilter
+                
+                if name == "rotate":
+                    arg = plugin_rotate_arg( image, filtername )
+                else:
+                    arg = plugin_perspective_arg( image, drawable, force, filtername )
+                
+                if arg == None:
+                    return None
+                
+                args.append( arg )
+                
+                # the canvas changes so later resizes fall back to fitting both edges
+                width = None
+                height = None
+            
+            elif name == "command":
+                args.append( plugin_usercommand_arg( rest ) )
+            
+            else:
+                plugin_message( "Unknown pipeline step : " + name )
+                return None
+        
+        except ( ValueError, IndexError ):
+            plugin_message( "Bad values for pipeline step : " + name + " " + rest )
+            return None
+        
+        done.append( name )
+    
+    return plugin_argv( args )
+
+#----------------------------------------------------------------------------------
+
+def plugin_pipeline( image, drawable, steps, src, dest ):
 
-def lc_fn2( V, RSC ):
+    arg = plugin_pipeline_arg( steps, image, drawable, plugin_sourcesize( image, src ) )
     
-    ( A, E, F, p, q ) = V
-    ( R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ) = RSC
+    if arg == None:
+        return
     
-    D = E*E
-    B = F*F + D - 2 - 2*A
-    C = 1 - A - B - D
+    # the config file is one value per line
+    plugin_setcfgtag( "default-pipeline", "; ".join( [ ( n + " " + r ).strip() for n, r in plugin_pipeline_steps( steps ) ] ) )
     
-    r = q/(s0-p*c0)
-    eq0 = A*( r**4 ) + B*( r**3 ) + C*( r**2 ) + D*r - R0
-    r = q/(s1-p*c1)
-    eq1 = A*( r**4 ) + B*( r**3 ) + C*( r**2 ) + D*r - R1
-    r = q/(s2-p*c2)
-    eq2 = A*( r**4 ) + B*( r**3 ) + C*( r**2 ) + D*r - R2
-    r = q/(s3-p*c3)
-    eq3 = A*( r**4 ) + B*( r**3 ) + C*( r**2 ) + D*r - R3
-    r = q/(s4-p*c4)
-    eq4 = A*( r**4 ) + B*( r**3 ) + C*( r**2 ) + D*r - R4
+    plugin_runoperation( image, src, dest, "mogrify", arg, "Pipeline" )
 
-    return [ eq0, eq1, eq2, eq3, eq4 ]
+#----------------------------------------------------------------------------------
 
-##__end_devcode
+'''
+The preview entries open a dialog which runs the operation on a small
+copy of the source, the proxy, each time a value is changed.  The proxy
+is made once when the dialog opens, or when the source is changed, by
+letting GIMP scale a copy of it.  Values which are distances, like the
+sketch radius, are scaled down with the proxy so it looks like the full
+size result will.  Redraws wait until the values have stopped changing
+for a moment and run in a thread so the dialog stays responsive.  The
+full size operation only runs when OK is pressed.
+
+Each operation lists its values as ( label, default, lower, upper, step,
+digits, scaled ), the builder for its argument and the operation itself.
+'''
 
-#--------------------------
+plugin_preview_ops = {
+    "sketch"   : ( "Sketch",
+                   [ ( "Radius :", 5.0, 0.1, 100.0, 0.1, 1, True ),
+                     ( "Sigma  :", 1.0, 0.1, 50.0, 0.1, 1, True ),
+                     ( "Angle  :", 45, 0, 360, 5, 0, False ) ],
+                   plugin_sketch_arg,
+                   plugin_sketch ),
+    "charcoal" : ( "Charcoal",
+                   [ ( "Line thickness :", 5.0, 0.1, 100.0, 0.1, 1, True ) ],
+                   plugin_charcoal_arg,
+                   plugin_charcoal ),
+    "sepia"    : ( "Sepia Tone",
+                   [ ( "Threshold :", 80, 0, 100, 5, 0, False ) ],
+                   plugin_sepia_arg,
+                   plugin_sepia )
+    }
 
-def plugin_lc_b( image, drawable, filtertouse , src, dest ):
+#----------------------------------------------------------------------------------
 
-    '''
-    Try to correct lens distortion my matching three points
-    on a curve to R = r*( (1-E+E)*r*r + E*E )
-    '''
+def plugin_previewsize():
 
-    # get points for transform from image
+    size = plugin_getcfgtag( "preview-size" )
     
-    p = getstrokes(image,3)
+    if size != None and size.isdigit():
+        return max( 32, int( size ) )
     
-    if p == None:
-        return
+    return 512
+
+#----------------------------------------------------------------------------------
+
+# Returns the proxy as RGBA bytes with its width and height.  It is made
+# in a temporary image, as in plugin_maketempfile, so GIMP does the
+# scaling and any conversion from gray or indexed.
+
+def plugin_makeproxy( image, src, maxedge ):
+
+    width, height = plugin_sourcesize( image, src )
     
-    # Note that radi are normalized (!)
+    scale = min( 1.0, float( maxedge ) / max( width, height ) )
     
-    cx = image.width / 2.0
-    cy = image.height / 2.0
+    pw = max( 1, int( round( width * scale ) ) )
+    ph = max( 1, int( round( height * scale ) ) )
     
-    norm = cx
-    if cy < norm:
-        norm = cy
+    tempimage = pdb.gimp_image_new( width, height, image.base_type )
     
-    g = ( cx, cy, norm )
+    if image.base_type == INDEXED:
+        num_bytes, colormap = pdb.gimp_image_get_colormap( image )
+        pdb.gimp_image_set_colormap( tempimage, num_bytes, colormap )
     
-    R0, s0, c0 = lc_rsc( p, 0, g )
-    R1, s1, c1 = lc_rsc( p, 1, g )
-    R2, s2, c2 = lc_rsc( p, 2, g )
+    if src == 0:
+        layer = pdb.gimp_layer_new_from_visible( image, tempimage, "visible" )
+    else:
+        layer = pdb.gimp_layer_new_from_drawable( image.active_drawable, tempimage )
     
-    # solve the equation
+    pdb.gimp_image_insert_layer( tempimage, layer, None, 0 )
     
-    # initial estimate for solution
+    pdb.gimp_layer_set_offsets( layer, 0, 0 )
     
-    p0 = ( R2*s2 - R0*s0 ) / ( R2*c2 - R0*c0 )
-    q0 = R0*s0 - p0*R0*c0
+    pdb.gimp_image_scale( tempimage, pw, ph )
     
-    guess = [ 0.0 ,p0, q0 ]
+    if image.base_type != RGB:
+        pdb.gimp_image_convert_rgb( tempimage )
     
-    t = [ R0,s0,c0, R1,s1,c1, R2,s2,c2 ]
+    pdb.gimp_layer_add_alpha( layer )
     
-    V, info, ier, msg = scopt.fsolve( lc_fn_b, guess, t, full_output=True )
+    rgn = layer.get_pixel_rgn( 0, 0, pw, ph, False, False )
     
-    D = V[0]*V[0]
-    B = 1.0 - D
+    data = rgn[ 0:pw, 0:ph ]
     
-    # C now contains the values we need for the ImageMagick barrel distortion correction
+    gimp.delete( tempimage )
     
-    # do the transformation
+    return data, pw, ph, float( pw ) / width
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
-    
-    if tempfilename == None:
-        return
-    
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " -distort Barrel"
-    arg = arg + " \"0.0 " + str(B) + " 0.0 " + str(D) + "\" "
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_start(image)
+# Runs in a thread.  Only the subprocess is touched here, the dialog
+# picks up the result from state on the main thread.
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Barrel" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+def plugin_previewrender( state, arg ):
 
-    pdb.gimp_image_undo_group_end(image)
+    data, pw, ph, scale = state["proxy"]
     
-#--------------------------
-
-def lc_fn_b( V, RSC ):
+    header, inspec = plugin_rawinput( pw, ph, 4 )
     
-    ( E, p, q ) = V
-    ( R0,s0,c0, R1,s1,c1, R2,s2,c2 ) = RSC
+    if state["cmdpath"] == None:
+        state["result"] = ( None, "ImageMagick convert was not found" )
+        return
     
-    D = E*E
+    command = plugin_argv( state["cmdpath"], "-monitor", inspec, arg, "-depth", "8", "pam:-" )
     
-    # fitting R = r*( (1-E*E)*r*r + E*E )
+    try:
+        child = plugin_popen( command )
+    except OSError, e:
+        state["result"] = ( None, str( e ) )
+        return
     
-    r = q/(s0-p*c0)
-    eq0 = ( (1-D)*r*r + D )*r - R0
-    r = q/(s1-p*c1)
-    eq1 = ( (1-D)*r*r + D )*r - R1
-    r = q/(s2-p*c2)
-    eq2 = ( (1-D)*r*r + D )*r - R2
-
-    return [ eq0, eq1, eq2 ]
-
-
-#--------------------------
+    stdoutdata, stderrdata = plugin_communicate( child, header + data, state["progress"] )
+    
+    f = cStringIO.StringIO( stdoutdata )
+    
+    geometry = plugin_readpamheader( f )
+    
+    if geometry == None:
+        state["result"] = ( None, stderrdata.strip() )
+        return
+    
+    w, h, channels, samplebytes = geometry
+    
+    pixels = f.read( w * h * channels * samplebytes )
+    
+    if samplebytes == 2:
+        pixels = pixels[0::2]
+    
+    state["result"] = ( ( plugin_convertpixels( pixels, channels, 4 ), w, h ), stderrdata.strip() )
 
-def plugin_lc_c( image, drawable, filtertouse , src, dest ):
+#----------------------------------------------------------------------------------
 
-    '''
-    Try to correct lens distorion by mapping three points
-    on a curve to a line.
-    Use the model :  R = r*( C*r + 1 - C )
-    '''
+def plugin_previewdialog( image, drawable, op ):
 
-    # get points for transform from image
+    import gtk
+    import gobject
     
-    p = getstrokes(image,3)
+    title, params, argfn, runfn = plugin_preview_ops[op]
     
-    if p == None:
-        return
+    # the worker thread needs the GIL while the dialog waits for events
+    gobject.threads_init()
     
-    # Note that radi are normalized (!)
+    dialog = gtk.Dialog( "IM " + title, None, 0,
+                         ( gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL, gtk.STOCK_OK, gtk.RESPONSE_OK ) )
     
-    cx = image.width / 2.0
-    cy = image.height / 2.0
+    preview = gtk.Image()
+    preview.set_size_request( plugin_previewsize(), plugin_previewsize() )
+    dialog.vbox.pack_start( preview, True, True, 4 )
     
-    norm = cx
-    if cy < norm:
-        norm = cy
+    message = gtk.Label( "" )
+    dialog.vbox.pack_start( message, False, False, 0 )
     
-    g = ( cx, cy, norm )
+    table = gtk.Table( len( params ) + 2, 2 )
+    table.set_col_spacings( 6 )
+    dialog.vbox.pack_start( table, False, False, 4 )
     
-    R0, s0, c0 = lc_rsc( p, 0, g )
-    R1, s1, c1 = lc_rsc( p, 1, g )
-    R2, s2, c2 = lc_rsc( p, 2, g )
+    adjustments = []
     
-    # solve the equation
+    for row in range( len( params ) ):
+        label, default, lower, upper, step, digits, scaled = params[row]
+        
+        adj = gtk.Adjustment( default, lower, upper, step, step * 10 )
+        spin = gtk.SpinButton( adj, 0, digits )
+        
+        table.attach( gtk.Label( label ), 0, 1, row, row+1 )
+        table.attach( spin, 1, 2, row, row+1 )
+        
+        adjustments.append( adj )
     
-    # initial estimate for solution
+    srccombo = gtk.combo_box_new_text()
+    srccombo.append_text( "Visible layers" )
+    srccombo.append_text( "Current layer only" )
+    srccombo.set_active( 0 )
     
-    p0 = ( R2*s2 - R0*s0 ) / ( R2*c2 - R0*c0 )
-    q0 = R0*s0 - p0*R0*c0
+    destcombo = gtk.combo_box_new_text()
+    destcombo.append_text( "New image" )
+    destcombo.append_text( "Current layer" )
+    destcombo.append_text( "New layer" )
+    destcombo.set_active( 0 )
     
-    guess = [ 0.0 ,p0, q0 ]
+    table.attach( gtk.Label( "Source:" ), 0, 1, len( params ), len( params )+1 )
+    table.attach( srccombo, 1, 2, len( params ), len( params )+1 )
+    table.attach( gtk.Label( "Destination:" ), 0, 1, len( params )+1, len( params )+2 )
+    table.attach( destcombo, 1, 2, len( params )+1, len( params )+2 )
     
-    t = [ R0,s0,c0, R1,s1,c1, R2,s2,c2 ]
+    state = { "proxy" : None, "thread" : None, "timer" : None, "pending" : False, "result" : None,
+              "progress" : {}, "cmdpath" : plugin_commandpath( "convert" ) }
     
-    C, info, ier, msg = scopt.fsolve( lc_fn_c, guess, t, full_output=True )
+    def values():
+        return [ adj.get_value() for adj in adjustments ]
     
-    D = 1.0 - C[0]
+    def proxyarg():
+        scale = state["proxy"][3]
+        v = values()
         
-    # C now contains the values we need for the ImageMagick barrel distortion correction
+        for i in range( len( params ) ):
+            if params[i][6]:
+                v[i] = v[i] * scale
+        
+        return argfn( *v )
     
-    # do the transformation
-
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    def poll():
+        if state["thread"].is_alive():
+            progress = state["progress"]
+            
+            if "fraction" in progress:
+                message.set_text( progress["stage"] + " %d%%" % int( 100 * progress["fraction"] ) )
+            
+            return True
+        
+        state["thread"] = None
+        
+        pixels, errors = state["result"]
+        
+        if pixels != None:
+            data, w, h = pixels
+            pixbuf = gtk.gdk.pixbuf_new_from_data( data, gtk.gdk.COLORSPACE_RGB, True, 8, w, h, w * 4 )
+            preview.set_from_pixbuf( pixbuf )
+            message.set_text( "" )
+        else:
+            message.set_text( errors )
+        
+        if state["pending"]:
+            state["pending"] = False
+            render()
+        
+        return False
     
-    if tempfilename == None:
-        return
+    def render():
+        state["timer"] = None
+        
+        if state["thread"] != None:
+            # draw again with the latest values when this one is done
+            state["pending"] = True
+            return False
+        
+        state["progress"] = {}
+        state["thread"] = threading.Thread( target=plugin_previewrender, args=( state, proxyarg() ) )
+        state["thread"].daemon = True
+        state["thread"].start()
+        
+        gobject.timeout_add( 50, poll )
+        
+        return False
     
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " -distort Barrel"
-    arg = arg + " \"0.0 0.0 " + str(C[0]) + " " + str(D) + "\" "
-
-    pdb.gimp_image_undo_group_start(image)
-
-    if plugin_docommand( "mogrify", arg, tempfilename, "Barrel" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
+    def changed( *ignored ):
+        # wait until the values stop changing
+        if state["timer"] != None:
+            gobject.source_remove( state["timer"] )
         
-    plugin_tidyup( tempfilename )
-
-    pdb.gimp_image_undo_group_end(image)
+        state["timer"] = gobject.timeout_add( 200, render )
     
-#--------------------------
-
-def lc_fn_c( V, RSC ):
+    def sourcechanged( *ignored ):
+        state["proxy"] = plugin_makeproxy( image, srccombo.get_active(), plugin_previewsize() )
+        changed()
+    
+    for adj in adjustments:
+        adj.connect( "value-changed", changed )
     
-    ( C, p, q ) = V
-    ( R0,s0,c0, R1,s1,c1, R2,s2,c2 ) = RSC
+    srccombo.connect( "changed", sourcechanged )
     
-    eq0 = C*(q**2) + (1-C)*q*(s0-p*c0) - R0*((s0-p*c0)**2)
-    eq1 = C*(q**2) + (1-C)*q*(s1-p*c1) - R1*((s1-p*c1)**2)
-    eq2 = C*(q**2) + (1-C)*q*(s2-p*c2) - R2*((s2-p*c2)**2)
+    sourcechanged()
+    
+    dialog.show_all()
+    
+    response = dialog.run()
+    
+    v = values()
+    src = srccombo.get_active()
+    dest = destcombo.get_active()
+    
+    if state["timer"] != None:
+        gobject.source_remove( state["timer"] )
+    
+    dialog.destroy()
+    
+    if response == gtk.RESPONSE_OK:
+        runfn( *( [ image, drawable ] + v + [ src, dest ] ) )
 
-    return [ eq0, eq1, eq2 ]
+#----------------------------------------------------------------------------------
 
+def plugin_sketch_preview( image, drawable ):
 
-#--------------------------
+    plugin_previewdialog( image, drawable, "sketch" )
 
-def lc_rsc( p, k, g ):
+#----------------------------------------------------------------------------------
 
-    x = p[6*k] - g[0]
-    y = p[(6*k)+1] - g[1]
-    R = math.sqrt( x*x + y*y )
-    s = y / R
-    c = x / R
-    R = R / g[2]
-    
-    return ( R, s, c )
+def plugin_charcoal_preview( image, drawable ):
 
-#-----------------------------------
+    plugin_previewdialog( image, drawable, "charcoal" )
 
-##__devcode
+#----------------------------------------------------------------------------------
 
-def plugin_lenscorrection_inverse( image, drawable, filtertouse , src, dest ):
+def plugin_sepia_preview( image, drawable ):
 
-    # get points for transform from image
+    plugin_previewdialog( image, drawable, "sepia" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_resource_limits( image, drawable ):
+
+    im_limits = plugin_silentcommand( "mogrify", [ "-list", "resource" ] )
     
-    p = getstrokes(image,5)
+    info = plugin_iminfo()
     
-    if p == None:
-        return
+    im = "ImageMagick :\n\n"
+    im = im + "  Binary     " + str( info["binary"] ) + "\n"
+    im = im + "  " + info["version"] + "\n"
+    im = im + "  Quantum    Q" + str( info["quantum"] ) + "\n"
+    im = im + "  HDRI       " + str( info["hdri"] ) + "\n"
+    im = im + "  OpenMP     " + str( info["openmp"] ) + ", " + str( info["threads"] ) + " threads\n"
+    im = im + "  Delegates  " + " ".join( info["delegates"] ) + "\n"
     
-    # Note that radi are normalized (!)
+    entries = plugin_cacheusage()
     
-    cx = image.width / 2.0
-    cy = image.height / 2.0
+    cache = "Result cache :\n\n"
+    cache = cache + "  Hits    " + str( plugin_getcfgtag( "cache-hits" ) or 0 ) + "\n"
+    cache = cache + "  Misses  " + str( plugin_getcfgtag( "cache-misses" ) or 0 ) + "\n"
+    cache = cache + "  Used    " + str( len( entries ) ) + " results, "
+    cache = cache + str( round( sum( [ e[1] for e in entries ] ) / 1048576.0, 1 ) ) + " of "
+    cache = cache + str( round( plugin_cachebudget() / 1048576.0, 1 ) ) + " MB"
     
-    norm = cx
-    if cy < norm:
-        norm = cy
+    physical = plugin_physicalmemory()
     
-    g = ( cx, cy, norm )
+    policy = "Resource policy :\n\n"
     
-    R0, s0, c0 = lc_rsc( p, 0, g )
-    R1, s1, c1 = lc_rsc( p, 1, g )
-    R2, s2, c2 = lc_rsc( p, 2, g )
-    R3, s3, c3 = lc_rsc( p, 3, g )
-    R4, s4, c4 = lc_rsc( p, 4, g )
+    if physical != None:
+        policy = policy + "  Memory     " + str( physical / 1048576 ) + " MB\n"
     
-    print R0, R1, R2, R3, R4
+    policy = policy + "  Limits     " + " ".join( plugin_limitargs() ) + "\n"
+    policy = policy + "  Too big    " + ( plugin_getcfgtag( "memory-strategy" ) or "warn" ) + "\n"
     
-    # solve the equation
-    #
-    # We wish to obtain values for the transform R = r/( A*r*r*r + B*r*r + C*r*r + D )
-    #
-    # From logical considerations we get :
-    #
-    #   B = E*E - F*F - 2*A
-    #   C = 1 + A + F*F - 2*E*E
-    #   D = E*E
-    #
-    # And we fit to that equation
+    gimp.message( im + "\nMogrify limits :\n\n" + im_limits + "\n" + policy + "\n" + cache )
+
+#----------------------------------------------------------------------------------
+
+'''
+We use a very simple configurationfile format.
+The keys, value pairs are on differnt lines, so
+we can easily find a value by locating it's key
+and then using the following line as a value.
+'''
+
+def plugin_configdir():
+
+    # batch mode can be pointed at a config directory as there is no GIMP
+    if "MM_TOOL_IMAGEMAGICK_DIR" in os.environ:
+        return os.environ["MM_TOOL_IMAGEMAGICK_DIR"]
     
-    # initial estimate for line we map to
+    if gimpfu_imported:
+        return gimp.directory
     
-    p0 = ( R4*s4 - R0*s0 ) / ( R4*c4 - R0*c0 )
-    q0 = R0*s0 - p0*R0*c0
+    return os.path.expanduser( "~" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_getconfig( fname ):
+
+    if not os.path.exists( fname ):
+        return None
     
-    # Note the guess values refer to A,E,F,p,q in that order
-    #
-    guess = [ 0, 1, 1, p0, q0 ]
+    f = open( fname, "r" )
+    # this is fast and simple for small files
+    # it's not suitable for files that are very large
+    # compared to memory, but that's not an issue here.
+    cfg = f.read().splitlines()
+    f.close()
     
-    # print guess
+    # it is tempting to remove empty lines and comments but as long
+    # as they are not used as keys there is not reason to worry about
+    # them.  Keeping them intact lets us write them out later.
     
-    t = [ R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ]
+    return cfg
     
-    # V, covx, info, ier, msg = scopt.leastsq( lc_fninv, guess, t, full_output=True )
-    V, info, ier, msg = scopt.fsolve( lc_fninv, guess, t, full_output=True )
+#----------------------------------------------------------------------------------
+
+# Very unhelpfully index() raises an error when something is
+# not in a list.  As I don't want code peppered by try..except
+# clauses I use this function to instead return a -1 when
+# a tag is not in a list ( which is less drastic ).
+
+def plugin_indexof( tag, cfg ):
+
+    try:
+        pos = cfg.index(tag)
+    except ValueError:
+        pos = -1
     
-    D = V[1]*V[1]
-    A = V[0]
-    B = D - V[2]*V[2] - 2*A
-    C = 1 - A - B - D
+    return pos
+
+#----------------------------------------------------------------------------------
+
+'''
+The file is read once per process.  plugin_config keeps its lines as they
+are and a dict from each tag to the position of its value, which is the
+line after the first time the tag appears, as index() would find it.
+Changes are made in memory and written behind, when the plug-in exits or
+plugin_flushconfig is called.  Writing takes an advisory lock on a .lock
+file beside the config, reads it again so that tags another plug-in has
+changed meanwhile are kept, applies only our changes, and renames a temp
+file over the original so nobody ever reads half a file.  Counters, such
+as the cache hits, are written as what this process added to them, so
+plug-ins running at once do not lose each other's counts.
+'''
+
+plugin_config = {}
+
+def plugin_configfile():
+
+    return os.path.join( plugin_configdir(), "mm_tool_imagemagick.cfg" )
+
+#----------------------------------------------------------------------------------
+
+def plugin_indexconfig( lines ):
+
+    index = {}
     
-    print "co-effs = ", A, B, C, D
+    for pos in range( len( lines ) - 1 ):
+        if lines[pos] not in index:
+            index[ lines[pos] ] = pos + 1
     
-    print info['fvec']
-    print info['nfev']
+    return index
+
+#----------------------------------------------------------------------------------
+
+def plugin_loadconfig():
+
+    global plugin_config
     
-    # C now contains the values we need for the ImageMagick barrel distortion correction
+    fname = plugin_configfile()
     
-    # do the transformation
+    if plugin_config.get( "fname" ) == fname:
+        return plugin_config
+    
+    # the config dir has changed, so finish with the old file first
+    plugin_flushconfig()
+    
+    lines = plugin_getconfig( fname ) or []
+    
+    plugin_config = { "fname" : fname, "lines" : lines,
+                      "index" : plugin_indexconfig( lines ), "dirty" : {}, "counts" : {} }
+    
+    return plugin_config
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+#----------------------------------------------------------------------------------
+
+def plugin_lockconfig( fname ):
+
+    f = open( fname + ".lock", "a+" )
     
-    if tempfilename == None:
-        return
+    try:
+        if sys.platform.startswith( "win" ):
+            import msvcrt
+            # retries for ten seconds before it gives up
+            msvcrt.locking( f.fileno(), msvcrt.LK_LOCK, 1 )
+        else:
+            import fcntl
+            fcntl.flock( f.fileno(), fcntl.LOCK_EX )
+    except ( ImportError, IOError ):
+        # carry on unlocked rather than lose the settings
+        pass
     
-    arg = "-matte -virtual-pixel transparent -filter " + plugin_resize_filters( filtertouse ) + " -distort BarrelInverse"
-    arg = arg + " \""+ str(A) + " " + str(B) + " " + str(C) + " " + str(D) + "\" "
+    return f
 
-    pdb.gimp_image_undo_group_start(image)
+#----------------------------------------------------------------------------------
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Barrel" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+def plugin_unlockconfig( f ):
 
-    pdb.gimp_image_undo_group_end(image)
+    try:
+        if sys.platform.startswith( "win" ):
+            import msvcrt
+            f.seek( 0 )
+            msvcrt.locking( f.fileno(), msvcrt.LK_UNLCK, 1 )
+        else:
+            import fcntl
+            fcntl.flock( f.fileno(), fcntl.LOCK_UN )
+    except ( ImportError, IOError ):
+        pass
     
-    print msg
+    f.close()
 
-#--------------------------
+#----------------------------------------------------------------------------------
 
-def lc_fninv( V, RSC ):
+# Writes a temp file beside fname and renames it over fname, so nobody
+# reading fname sees half of it.  The caller holds the lock.
+
+def plugin_writeatomic( fname, text ):
+
+    part = fname + "." + str( os.getpid() ) + ".part"
     
-    ( A, E, F, p, q ) = V
-    ( R0,s0,c0, R1,s1,c1, R2,s2,c2, R3,s3,c3, R4,s4,c4 ) = RSC
+    f = open( part, "w" )
+    f.write( text )
+    f.close()
     
-    D = E*E
-    B = D - F*F - 2*A
-    C = 1 - A - B - D
+    if sys.platform.startswith( "win" ) and os.path.exists( fname ):
+        # rename will not replace a file on MS Windows
+        os.remove( fname )
     
-    r = q/(s0-p*c0)
-    eq0 = ( r/( A*( r**3 ) + B*( r**2 ) + C*r + D ) ) - R0
-    r = q/(s1-p*c1)
-    eq1 = ( r/( A*( r**3 ) + B*( r**2 ) + C*r + D ) ) - R1
-    r = q/(s2-p*c2)
-    eq2 = ( r/( A*( r**3 ) + B*( r**2 ) + C*r + D ) ) - R2
-    r = q/(s3-p*c3)
-    eq3 = ( r/( A*( r**3 ) + B*( r**2 ) + C*r + D ) ) - R3
-    r = q/(s4-p*c4)
-    eq4 = ( r/( A*( r**3 ) + B*( r**2 ) + C*r + D ) ) - R4
+    os.rename( part, fname )
 
-    return [ eq0, eq1, eq2, eq3, eq4 ]
+#----------------------------------------------------------------------------------
 
-#--------------------------
+def plugin_flushconfig():
+
+    cfg = plugin_config
+    
+    if not cfg or not ( cfg["dirty"] or cfg["counts"] ):
+        return
+    
+    fname = cfg["fname"]
+    
+    try:
+        lock = plugin_lockconfig( fname )
+    except IOError:
+        print "mm_tool_imagemagick could not write " + fname
+        return
+    
+    try:
+        lines = plugin_getconfig( fname ) or []
+        index = plugin_indexconfig( lines )
+        
+        changes = cfg["dirty"].copy()
+        
+        for tag, n in cfg["counts"].items():
+            val = "0"
+            
+            if tag in index:
+                val = lines[ index[tag] ]
+            
+            if not val.isdigit():
+                val = "0"
+            
+            changes[tag] = str( int( val ) + n )
+        
+        for tag, val in changes.items():
+            if tag in index:
+                lines[ index[tag] ] = val
+            else:
+                lines.extend( [ tag, val ] )
+                index[tag] = len( lines ) - 1
+        
+        plugin_writeatomic( fname, "".join( [ g + "\n" for g in lines ] ) )
+        
+        cfg["lines"] = lines
+        cfg["index"] = index
+        cfg["dirty"] = {}
+        cfg["counts"] = {}
+    except ( IOError, OSError ):
+        print "mm_tool_imagemagick could not write " + fname
+    finally:
+        plugin_unlockconfig( lock )
+
+#----------------------------------------------------------------------------------
+
+def plugin_getcfgtag( tag ):
 
-##__end_devcode
+    cfg = plugin_loadconfig()
+    
+    pos = cfg["index"].get( tag )
     
+    if pos == None:
+        return None
+    else:
+        return cfg["lines"][pos]
+
 #----------------------------------------------------------------------------------
 
-def plugin_colorspaceconversion( image, drawable, spaceto, src, dest ):
+def plugin_setcfgtag( tag, val ):
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    cfg = plugin_loadconfig()
     
-    if tempfilename == None:
+    if plugin_getcfgtag( tag ) == val:
         return
     
-    arg = "-colorspace " + plugin_color_spaces(spaceto) + " -set colorspace RGB"
-    
-    print "Color space = ", plugin_color_spaces(spaceto) 
+    pos = cfg["index"].get( tag )
     
-    pdb.gimp_image_undo_group_start(image)
+    if pos == None:
+        cfg["lines"].extend( [ tag, val ] )
+        cfg["index"][tag] = len( cfg["lines"] ) - 1
+    else:
+        cfg["lines"][pos] = val
     
-    if plugin_docommand( "mogrify", arg, tempfilename, "Colorspace Conversion" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
+    if not hasattr( plugin_setcfgtag, "registered" ):
+        plugin_setcfgtag.registered = True
+        atexit.register( plugin_flushconfig )
     
-    plugin_tidyup( tempfilename )
-
-    pdb.gimp_image_undo_group_end(image)
-
+    cfg["dirty"][tag] = val
 
 #----------------------------------------------------------------------------------
 
-def plugin_colordotproduct( image, drawable, src, dest ):
+# Adds one to a counter tag.  The file gets what was added rather than
+# the total, see plugin_flushconfig.
 
-    # get the current foreground color
+def plugin_countcfgtag( tag ):
+
+    cfg = plugin_loadconfig()
     
-    fg = gimp.get_foreground()
+    n = plugin_getcfgtag( tag )
     
-    # use the -fx command to process the image
+    if n == None or not n.isdigit():
+        n = "0"
     
-    arg = "-fx \"(sqrt( u.r*" + str(fg[0]) + " + u.g*" + str(fg[1]) + "+ u.b*" + str(fg[2]) + " ))/15.97\" "
+    pos = cfg["index"].get( tag )
     
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    if pos == None:
+        cfg["lines"].extend( [ tag, str( int( n ) + 1 ) ] )
+        cfg["index"][tag] = len( cfg["lines"] ) - 1
+    else:
+        cfg["lines"][pos] = str( int( n ) + 1 )
     
-    if tempfilename == None:
-        return
+    if not hasattr( plugin_setcfgtag, "registered" ):
+        plugin_setcfgtag.registered = True
+        atexit.register( plugin_flushconfig )
     
-    pdb.gimp_image_undo_group_start(image)
+    cfg["counts"][tag] = cfg["counts"].get( tag, 0 ) + 1
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Color Dot Product" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_end(image)
+'''
+Batch mode applies the operations which don't need a path to a list of
+files or directories without GIMP, for example :
+
+    python mm_tool_imagemagick.py --batch --output out --jobs 8 resize 800 photos/
+
+The arguments are built by the same functions the plug-in uses.  Each
+file gets its own convert, at most --jobs at a time, and is written
+under a temporary name which is renamed once it has succeeded.  Every
+result is appended to a manifest so an interrupted run can simply be
+started again, and it will skip files already done with the same
+arguments.  Failures are listed at the end and in the --report file.
+Results keep the name and format of their input unless --format is
+given, except camera raw files which ImageMagick can not write, these
+become TIFF.
+
+The lensprofile operation takes its arguments from each file, the lens
+profile saved for the camera, lens and focal length in its EXIF data.
+'''
+
+plugin_batch_exts = ( ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".miff", ".pam", ".pnm",
+                      ".ppm", ".pgm", ".bmp", ".gif", ".webp", ".dng", ".cr2", ".nef" )
 
+# camera raw formats ImageMagick can read but not write, their results
+# are written as TIFF unless --format says otherwise
+
+plugin_batch_readonly = ( ".dng", ".cr2", ".nef" )
 
 #----------------------------------------------------------------------------------
 
-def plugin_colordistance( image, drawable, src, dest ):
+def plugin_batch_parser():
 
-    # get the current foreground color
+    import argparse
     
-    fg = gimp.get_foreground()
+    try:
+        jobs = multiprocessing.cpu_count()
+    except NotImplementedError:
+        jobs = 2
     
-    r = float(fg[0])/255.0
-    g = float(fg[1])/255.0
-    b = float(fg[2])/255.0
+    parser = argparse.ArgumentParser( prog="mm_tool_imagemagick.py --batch",
+                                      description="Apply an ImageMagick operation to many files." )
     
-    # use the -fx command to process the image
+    parser.add_argument( "--output", required=True, help="directory for the results" )
+    parser.add_argument( "--jobs", type=int, default=jobs, help="files processed at once" )
+    parser.add_argument( "--timeout", type=float, default=0, help="seconds allowed per file, 0 for no limit" )
+    parser.add_argument( "--manifest", help="manifest file, default is in the output directory" )
+    parser.add_argument( "--report", help="write a JSON failure report here" )
+    parser.add_argument( "--from", dest="listfile", help="file listing the inputs one per line" )
+    parser.add_argument( "--config-dir", help="directory holding mm_tool_imagemagick.cfg" )
+    parser.add_argument( "--format", help="extension for the results, default is the input's, tif for camera raw" )
     
-    arg = "-fx \"(sqrt( ( u.r-" + str(r) + ")^2 + ( u.g-" + str(g) + ")^2 + ( u.b-" + str(b) + ")^2 ))\" "
+    ops = parser.add_subparsers( dest="operation" )
     
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    p = ops.add_parser( "resize" )
+    p.add_argument( "size", type=int, help="longer edge" )
+    p.add_argument( "--filter", help="resize filter, default is the last one used" )
     
-    if tempfilename == None:
-        return
+    p = ops.add_parser( "sketch" )
+    p.add_argument( "--radius", type=float, default=5.0 )
+    p.add_argument( "--sigma", type=float, default=1.0 )
+    p.add_argument( "--angle", type=float, default=45 )
     
-    pdb.gimp_image_undo_group_start(image)
+    p = ops.add_parser( "charcoal" )
+    p.add_argument( "--thickness", type=float, default=5.0 )
+    
+    p = ops.add_parser( "sepia" )
+    p.add_argument( "--threshold", type=float, default=80 )
+    
+    p = ops.add_parser( "colorspace" )
+    p.add_argument( "space" )
+    
+    for name in ( "colordistance", "colordotproduct" ):
+        p = ops.add_parser( name )
+        p.add_argument( "--color", required=True, help="foreground color as R,G,B" )
+    
+    p = ops.add_parser( "command" )
+    p.add_argument( "command", help="mogrify style arguments" )
+    
+    p = ops.add_parser( "pipeline" )
+    p.add_argument( "steps", help="steps separated by ;" )
+    
+    p = ops.add_parser( "lensprofile" )
+    p.add_argument( "--filter", help="resize filter, default is the last one used" )
+    
+    for p in ops.choices.values():
+        p.add_argument( "inputs", nargs="*", help="files or directories" )
+    
+    return parser
 
-    if plugin_docommand( "mogrify", arg, tempfilename, "Color Distance" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_end(image)
+def plugin_batch_filter( opts ):
 
+    filtername = opts.filter
+    
+    if filtername == None:
+        filtername = plugin_getcfgtag( "default-filter" )
+    
+    if filtername == None:
+        filtername = "Lanczos"
+    
+    return filtername
 
 #----------------------------------------------------------------------------------
 
-def plugin_colordistance_lab( image, drawable, src, dest ):
+def plugin_batch_arg( opts ):
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
-    
-    if tempfilename == None:
-        return
+    op = opts.operation
     
-    # get the current foreground color
+    if op == "resize":
+        return plugin_resize_arg( opts.size, plugin_batch_filter( opts ) )
     
-    fg = gimp.get_foreground()
+    elif op == "sketch":
+        return plugin_sketch_arg( opts.radius, opts.sigma, opts.angle )
     
-    # create a new image composed of the foreground color only
+    elif op == "charcoal":
+        return plugin_charcoal_arg( opts.thickness )
     
-    bgfilename = pdb.gimp_temp_name( "tif" )
+    elif op == "sepia":
+        return plugin_sepia_arg( opts.threshold )
     
-    gimp.message( bgfilename )
+    elif op == "colorspace":
+        return plugin_colorspace_arg( opts.space )
     
-    shutil.copy( tempfilename, bgfilename )
+    elif op == "colordistance":
+        return plugin_colordistance_arg( [ int( c ) for c in opts.color.split( "," ) ] )
     
-    arg = "-fill \"rgb(" + str(fg[0]) + "," + str(fg[1]) + "," + str(fg[2]) + ")\" "
+    elif op == "colordotproduct":
+        return plugin_colordotproduct_arg( [ int( c ) for c in opts.color.split( "," ) ] )
     
-    plugin_docommand( "mogrify", arg, bgfilename, "Color Distance LAB creation" )
+    elif op == "command":
+        return plugin_usercommand_arg( opts.command )
     
-    # use the -fx command to process the image
+    elif op == "pipeline":
+        return plugin_pipeline_arg( opts.steps )
     
-    arg = tempfilename + " " + bgfilename
-    arg = arg + " -compose difference "
+    elif op == "lensprofile":
+        # each file has its own, see plugin_batch_filearg
+        return []
     
-    pdb.gimp_image_undo_group_start(image)
+    return None
 
-    if plugin_docommand( "convert", arg, tempfilename, "Color Distance LAB" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
-    
-    plugin_tidyup( bgfilename )
+#----------------------------------------------------------------------------------
 
-    pdb.gimp_image_undo_group_end(image)
+# The arguments for one file and None, or None and why there are none.
+# Only a lens profile depends on the file.
 
+def plugin_batch_filearg( opts, arg, fname ):
 
-#----------------------------------------------------------------------------------
+    if opts.operation == "lensprofile":
+        return plugin_lensprofile_arg( plugin_fileexif( fname ), plugin_batch_filter( opts ) )
+    
+    return ( arg, None )
 
-def plugin_usercommand( image, drawable, src, dest, arg ):
+#----------------------------------------------------------------------------------
 
-    # text may be entered with newlines, so we need to replace them with spaces
-    arg = arg.replace( "\n", " " )
+def plugin_batch_inputs( paths, listfile ):
 
-    tempfilename, tempdrawable, tempimage = plugin_maketempfile( image, src )
+    if listfile != None:
+        f = open( listfile, "r" )
+        paths = paths + [ line.strip() for line in f if line.strip() != "" ]
+        f.close()
     
-    if tempfilename == None:
-        return
+    inputs = []
     
-    pdb.gimp_image_undo_group_start(image)
-
-    if plugin_docommand( "mogrify", arg, tempfilename, "User Command" ) == True:
-        plugin_saveresult( image, dest, tempfilename, tempimage )
-        
-    plugin_tidyup( tempfilename )
-
-    pdb.gimp_image_undo_group_end(image)
+    for p in paths:
+        if os.path.isdir( p ):
+            for name in sorted( os.listdir( p ) ):
+                if os.path.splitext( name )[1].lower() in plugin_batch_exts:
+                    inputs.append( os.path.join( p, name ) )
+        else:
+            inputs.append( p )
+    
+    return inputs
 
 #----------------------------------------------------------------------------------
 
-def plugin_resource_limits( image, drawable ):
+# Output names are the input names, numbered when two inputs from
+# different directories share a name.  Inputs are in a fixed order so
+# the same run always gives the same names.
+
+def plugin_batch_outputs( inputs, outdir, fmt ):
 
-    im_limits = plugin_silentcommand( "mogrify", "-list resource" )
+    used = set()
+    outputs = []
+    
+    for fname in inputs:
+        base, ext = os.path.splitext( os.path.basename( fname ) )
+        
+        if fmt != None:
+            ext = "." + fmt.lstrip( "." )
+        elif ext.lower() in plugin_batch_readonly:
+            ext = ".tif"
+        
+        name = base + ext
+        n = 1
+        while name in used:
+            name = base + "-" + str(n) + ext
+            n = n + 1
+        used.add( name )
+        outputs.append( os.path.join( outdir, name ) )
     
-    gimp.message( "Mogrify limits :\n\n" + im_limits )
+    return outputs
 
 #----------------------------------------------------------------------------------
 
-'''
-We use a very simple configurationfile format.
-The keys, value pairs are on differnt lines, so
-we can easily find a value by locating it's key
-and then using the following line as a value.
-'''
-
-def plugin_getconfig():
+def plugin_batch_done( manifest ):
 
-    fname = os.path.join( gimp.directory, "mm_tool_imagemagick.cfg" )
+    done = set()
     
-    if not os.path.exists( fname ):
-        return None
+    if not os.path.exists( manifest ):
+        return done
     
-    f = open( fname, "r" )
-    # this is fast and simple for small files
-    # it's not suitable for files that are very large
-    # compared to memory, but that's not an issue here.
-    cfg = f.read().splitlines()
-    f.close()
+    f = open( manifest, "r" )
     
-    # it is tempting to remove empty lines and comments but as long
-    # as they are not used as keys there is not reason to worry about
-    # them.  Keeping them intact lets us write them out later.
+    for line in f:
+        try:
+            record = json.loads( line )
+        except ValueError:
+            # a line cut short when a run was killed
+            continue
+        
+        # manifests written before commands were lists hold a string and never match
+        if record.get( "status" ) == "ok" and isinstance( record.get( "arg" ), list ):
+            done.add( ( record["input"], tuple( record["arg"] ) ) )
     
-    return cfg
+    f.close()
     
-#----------------------------------------------------------------------------------
+    return done
 
-# Very unhelpfully index() raises an error when something is
-# not in a list.  As I don't want code peppered by try..except
-# clauses I use this function to instead return a -1 when
-# a tag is not in a list ( which is less drastic ).
+#----------------------------------------------------------------------------------
 
-def plugin_indexof( tag, cfg ):
+def plugin_batch_kill( child, timedout ):
 
-    try:
-        pos = cfg.index(tag)
-    except ValueError:
-        pos = -1
+    timedout.append( True )
     
-    return pos
+    try:
+        if sys.platform.startswith( "win" ):
+            child.kill()
+        elif child.returncode == None:
+            # the whole group, so ImageMagick's delegates go too
+            os.killpg( child.pid, signal.SIGKILL )
+    except OSError:
+        pass
 
 #----------------------------------------------------------------------------------
 
-def plugin_getcfgtag( tag ):
-
-    cfg = plugin_getconfig()
-    
-    if cfg == None:
-        return None
+def plugin_batch_worker( jobs, results, timeout ):
 
-    pos = plugin_indexof(tag, cfg)
-    
-    if pos < 0:
-        return None
-    else:
-        return cfg[pos+1]
+    while True:
+        job = jobs.get()
+        
+        if job == None:
+            break
+        
+        index, command = job
+        
+        start = time.time()
+        
+        try:
+            child = plugin_popen( command )
+        except OSError, e:
+            results.put( ( index, "failed", str( e ), time.time() - start ) )
+            continue
+        
+        timedout = []
+        timer = None
+        
+        if timeout > 0:
+            timer = threading.Timer( timeout, plugin_batch_kill, ( child, timedout ) )
+            timer.start()
+        
+        stdoutdata, stderrdata = child.communicate()
+        
+        if timer != None:
+            timer.cancel()
+            timer.join()
+        
+        if timedout:
+            status = "timeout"
+        elif child.returncode != 0:
+            status = "failed"
+        else:
+            status = "ok"
+        
+        results.put( ( index, status, stderrdata.strip(), time.time() - start ) )
 
 #----------------------------------------------------------------------------------
 
-def plugin_setcfgtag( tag, val ):
+def plugin_batchmain( argv ):
 
-    cfg = plugin_getconfig()
+    opts = plugin_batch_parser().parse_args( argv )
     
-    if cfg == None:
-        cfg = [ tag, val ]
-    else:
-        pos = plugin_indexof(tag, cfg)
+    if opts.config_dir != None:
+        os.environ["MM_TOOL_IMAGEMAGICK_DIR"] = opts.config_dir
+    
+    arg = plugin_batch_arg( opts )
+    
+    if arg == None:
+        return 2
+    
+    cmdpath = plugin_commandpath( "convert" )
+    
+    if cmdpath == None:
+        return 2
+    
+    inputs  = plugin_batch_inputs( opts.inputs, opts.listfile )
+    
+    if not inputs:
+        plugin_message( "mm_tool_imagemagick found no images to process" )
+        return 2
+    
+    outputs = plugin_batch_outputs( inputs, opts.output, opts.format )
+    
+    if not os.path.isdir( opts.output ):
+        os.makedirs( opts.output )
+    
+    manifest = opts.manifest
+    
+    if manifest == None:
+        manifest = os.path.join( opts.output, "mm_tool_imagemagick-batch.jsonl" )
+    
+    done = plugin_batch_done( manifest )
+    
+    jobs    = Queue.Queue()
+    results = Queue.Queue()
+    
+    # share the cores between the files rather than within each file
+    try:
+        threads = max( 1, multiprocessing.cpu_count() / max( 1, opts.jobs ) )
+    except NotImplementedError:
+        threads = 1
+    
+    # the resource policy is shared between the jobs too
+    limits = plugin_limitargs( max( 1, opts.jobs ) )
+    
+    todo = 0
+    skipped = 0
+    fileargs = {}
+    
+    for i in range( len( inputs ) ):
+        filearg, error = plugin_batch_filearg( opts, arg, inputs[i] )
+        
+        if filearg == None:
+            # fails without running anything
+            results.put( ( i, "failed", error, 0.0 ) )
+            todo = todo + 1
+            continue
+        
+        if ( inputs[i], tuple( filearg ) ) in done and os.path.exists( outputs[i] ):
+            skipped = skipped + 1
+            continue
         
-        if pos < 0:
-            cfg.append( tag )
-            cfg.append( val )
+        fileargs[i] = filearg
+        
+        part = os.path.join( opts.output, ".part-" + os.path.basename( outputs[i] ) )
+        
+        command = plugin_argv( cmdpath, inputs[i], "-limit", "thread", threads, limits, filearg, part )
+        
+        jobs.put( ( i, command ) )
+        todo = todo + 1
+    
+    workers = []
+    
+    for n in range( min( max( 1, opts.jobs ), len( fileargs ) ) ):
+        jobs.put( None )
+        t = threading.Thread( target=plugin_batch_worker, args=( jobs, results, opts.timeout ) )
+        t.daemon = True
+        t.start()
+        workers.append( t )
+    
+    mf = open( manifest, "a" )
+    
+    failures = []
+    
+    for n in range( todo ):
+        i, status, error, seconds = results.get()
+        
+        part = os.path.join( opts.output, ".part-" + os.path.basename( outputs[i] ) )
+        
+        if status == "ok":
+            if os.path.exists( outputs[i] ):
+                os.remove( outputs[i] )
+            os.rename( part, outputs[i] )
         else:
-            cfg[pos+1] = val
-
-    f = open( os.path.join( gimp.directory, "mm_tool_imagemagick.cfg" ), "w+" )
+            plugin_tidyup( part )
+            failures.append( { "input" : inputs[i], "status" : status, "error" : error } )
+        
+        record = { "input" : inputs[i], "output" : outputs[i], "arg" : fileargs.get( i ),
+                   "status" : status, "seconds" : round( seconds, 3 ), "time" : time.time() }
+        
+        if status != "ok":
+            record["error"] = error
+        
+        mf.write( json.dumps( record ) + "\n" )
+        mf.flush()
+        
+        sys.stderr.write( "[" + str(n+1) + "/" + str(todo) + "] " + status + " " + inputs[i] + "\n" )
     
-    for g in cfg:
-        f.write( g + "\n" )
+    mf.close()
     
-    f.close()
+    for t in workers:
+        t.join()
     
+    sys.stderr.write( str( todo - len( failures ) ) + " done, " + str( len( failures ) ) + " failed, "
+                      + str( skipped ) + " already done\n" )
+    
+    for failure in failures:
+        sys.stderr.write( failure["status"] + " " + failure["input"] + " : " + failure["error"] + "\n" )
+    
+    if opts.report != None:
+        f = open( opts.report, "w" )
+        json.dump( { "operation" : opts.operation, "arg" : arg, "done" : todo - len( failures ),
+                     "skipped" : skipped, "failures" : failures }, f, indent=1 )
+        f.close()
+    
+    if failures:
+        return 1
+    
+    return 0
+
+#----------------------------------------------------------------------------------
+
+if __name__ == "__main__" and ( sys.argv[1:2] == [ "--batch" ] or not gimpfu_imported ):
+    if sys.argv[1:2] == [ "--batch" ]:
+        sys.exit( plugin_batchmain( sys.argv[2:] ) )
+    else:
+        sys.exit( plugin_batchmain( sys.argv[1:] ) )
 
 #----------------------------------------------------------------------------------
 
@@ -1449,6 +5862,51 @@ register(
                 plugin_sepia,
                 )
 
+register(
+                "python_fu_mm_im_sketch_preview",
+                "Process image using ImageMagick sketch to similuate pencil drawing, with a preview.",
+                "Process image using ImageMagick sketch to similuate pencil drawing, with a preview on a scaled down copy which is updated as the values are changed.",
+                "Stephen Geary, ( sg euroapps com )",
+                "(c) 2014, Stephen Geary",
+                "2014",
+                menubase + "Sketch (preview)",
+                "*",
+                [
+                ],
+                [],
+                plugin_sketch_preview,
+                )
+
+register(
+                "python_fu_mm_im_charcoal_preview",
+                "Process image using ImageMagick sketch to similuate charcoal drawing, with a preview.",
+                "Process image using ImageMagick sketch to similuate charcoal drawing, with a preview on a scaled down copy which is updated as the values are changed.",
+                "Stephen Geary, ( sg euroapps com )",
+                "(c) 2014, Stephen Geary",
+                "2014",
+                menubase + "Charcoal (preview)",
+                "*",
+                [
+                ],
+                [],
+                plugin_charcoal_preview,
+                )
+
+register(
+                "python_fu_mm_im_sepia_preview",
+                "Process image using ImageMagick sepia-tone, with a preview.",
+                "Process image using ImageMagick sepia-tone, with a preview on a scaled down copy which is updated as the values are changed.",
+                "Stephen Geary, ( sg euroapps com )",
+                "(c) 2014, Stephen Geary",
+                "2014",
+                menubase + "Sepia Tone (preview)",
+                "*",
+                [
+                ],
+                [],
+                plugin_sepia_preview,
+                )
+
 register(
                 "python_fu_mm_im_perspective",
                 "Perspective transform using path from image and ImageMagick.",
@@ -1575,6 +6033,28 @@ register(
                 plugin_usercommand,
                 )
 
+pipeline_default = plugin_getcfgtag( "default-pipeline" )
+if pipeline_default == None:
+    pipeline_default = "resize 800; sepia 80"
+
+register(
+                "python_fu_mm_im_pipeline",
+                "Run several operations with a single ImageMagick command.",
+                "Run several operations with a single ImageMagick command, so the image is only exported and loaded back once.  Give one step per line or separate them with ';', e.g. 'resize 1200 Lanczos; rotate; sepia 80'.  Steps are resize, sketch, charcoal, sepia, colorspace, colordistance, colordotproduct, rotate, perspective and command.",
+                "Stephen Geary, ( sg euroapps com )",
+                "(c) 2014, Stephen Geary",
+                "2014",
+                menubase + "Pipeline",
+                "*",
+                [
+                    ( PF_TEXT , "steps" , "Steps:", pipeline_default ),
+                    stdopt_src,
+                    stdopt_dest
+                ],
+                [],
+                plugin_pipeline,
+                )
+
 register(
                 "python_fu_mm_im_list_resources",
                 "List image magick resource limits.",
@@ -1590,6 +6070,24 @@ register(
                 plugin_resource_limits,
                 )
 
+register(
+                "python_fu_mm_im_lensprofile",
+                "Lens distortion correction from a saved lens profile.",
+                "Lens distortion correction from a saved lens profile.  The lens corrections from a path save their coefficients under the camera, lens and focal length in the image's EXIF data, and this applies them to other images from the same camera and lens, interpolating between focal lengths.",
+                "Stephen Geary, ( sg euroapps com )",
+                "(c) 2014, Stephen Geary",
+                "2014",
+                menubase + "Lens Correction/Apply Lens Profile",
+                "*",
+                [
+                    stdopt_filter,
+                    stdopt_src,
+                    stdopt_dest
+                ],
+                [],
+                plugin_applylensprofile,
+                )
+
 ##__devcode
 
 if scipy_imported:
@@ -1638,8 +6136,8 @@ if scipy_imported:
 
     register(
                 "python_fu_mm_im_lc_b",
-                "Simple-B Lens distortion correction using path from image and ImageMagick.  You need to select three points on a path which are on something that should be a straight line but is curved in the image.  Model is quadratic.",
-                "Simple-B Lens distortion correction using path from image and ImageMagick.  You need to select three points on a path which are on something that should be a straight line but is curved in the image.  Model is quadratic.",
+                "Simple-B Lens distortion correction using path from image and ImageMagick.  You need a path with a stroke of three or more points along each thing that should be a straight line but is curved in the image.  Model is quadratic.",
+                "Simple-B Lens distortion correction using path from image and ImageMagick.  You need a path with a stroke of three or more points along each thing that should be a straight line but is curved in the image.  Model is quadratic.",
                 "Stephen Geary, ( sg euroapps com )",
                 "(c) 2014, Stephen Geary",
                 "2014",
@@ -1656,8 +6154,8 @@ if scipy_imported:
 
     register(
                 "python_fu_mm_im_lc_c",
-                "Simple-C distortion correction using path from image and ImageMagick.  You need to select three points on a path which are on something that should be a straight line but is curved in the image.  Correction is to a linear model.",
-                "Simple-C distortion correction using path from image and ImageMagick.  You need to select three points on a path which are on something that should be a straight line but is curved in the image.  Correction is to a linear model.",
+                "Simple-C distortion correction using path from image and ImageMagick.  You need a path with a stroke of three or more points along each thing that should be a straight line but is curved in the image.  Correction is to a linear model.",
+                "Simple-C distortion correction using path from image and ImageMagick.  You need a path with a stroke of three or more points along each thing that should be a straight line but is curved in the image.  Correction is to a linear model.",
                 "Stephen Geary, ( sg euroapps com )",
                 "(c) 2014, Stephen Geary",
                 "2014",